@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+# GNU General Public License v3.0+
+# (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import fcntl
+import hashlib
+import json
+import os
+
+import ansible.constants as C
+from ansible.plugins.action import ActionBase
+
+
+# Runs a Foreman module once for every distinct set of arguments of a task,
+# hosts invoking the task with the same arguments get a copy of the result
+# instead of sending the same requests to Foreman again. Results are kept
+# in the controller's local temporary directory, which is shared by the
+# forks of a playbook run and removed when it ends. The first host holds
+# the lock of the result while the module runs, hosts with the same
+# arguments wait for it. Only successful results are shared, hosts retry
+# failed runs themselves. Results are shared within a batch of hosts of a
+# play (see serial), later batches run the module again as earlier tasks
+# may have changed Foreman in between. With the free strategy hosts of a
+# batch may reach the task after others ran later tasks already, so the
+# plugin should only be used when no later task of the play changes the
+# same domain. This saves repeated runs only: the module is still
+# transferred and run through AnsiballZ once for every distinct set of
+# arguments.
+class ActionModule(ActionBase):
+
+    # Results depend on the task, its (templated) arguments, check mode and
+    # the batch of hosts running the play
+    def _result_path(self, task_vars):
+        key = hashlib.sha256(json.dumps({
+            'task': self._task._uuid,
+            'action': self._task.action,
+            'args': self._task.args,
+            'check_mode': self._play_context.check_mode,
+            'batch': sorted((task_vars or {}).get('ansible_play_batch', [])),
+        }, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+        return os.path.join(C.DEFAULT_LOCAL_TMP, 'theforeman-%s' % (key))
+
+    def run(self, tmp=None, task_vars=None):
+        result = super(ActionModule, self).run(tmp, task_vars)
+        path = self._result_path(task_vars)
+
+        with open(path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(path) as f:
+                        stored = json.load(f)
+                except (IOError, ValueError):
+                    stored = None
+
+                if stored is None:
+                    stored = self._execute_module(
+                        module_name=self._task.action,
+                        module_args=self._task.args,
+                        task_vars=task_vars
+                    )
+                    result.update(stored)
+                    # Failures may be specific to the host (unreachable,
+                    # a transient error), the others run the module again
+                    if not stored.get('failed') and \
+                            not stored.get('unreachable'):
+                        with open(path, 'w') as f:
+                            json.dump(stored, f)
+                    return result
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+        result.update(stored)
+        result['deduplicated'] = True
+        # The change was made by the first host, running the module again
+        # would have found Foreman converged (in check mode nothing was
+        # changed, so the outcome stays the same)
+        if not self._play_context.check_mode:
+            result['changed'] = False
+
+        return result
@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+
+# GNU General Public License v3.0+
+# (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+from ansible.plugins.loader import action_loader
+
+# Deduplicated the same way as theforeman_domain
+ActionModule = action_loader.get('theforeman_domain', class_only=True)
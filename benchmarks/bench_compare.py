@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# This code is part of Ansible, but is an independent component.
+
+"""Micro-benchmark theforeman_compare_values on large association lists.
+
+Times the diff engine on a subnet payload with N domains and locations
+(converged and with one association changed) and, for reference, the
+previous implementation.
+
+    python benchmarks/bench_compare.py --sizes 100,1000,10000,100000
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from run_benchmarks import load_modules # NOQA
+
+
+def legacy_compare_values(query_data, query_out, domains, locations):
+    """Previous algorithm, building ID lists and converting them to sets
+    while walking the payload."""
+    diff_val = 0
+    for i in query_data.keys():
+        set_domains = [d['id'] for d in domains]
+        assigned_domains = [d['id'] for d in query_out['domains']]
+        set_locations = [d['id'] for d in locations]
+        assigned_locations = [d['id'] for d in query_out['locations']]
+        for key, val in query_data[i].items():
+            if key == 'domains':
+                if set(set_domains) != set(assigned_domains):
+                    diff_val = diff_val + 1
+            elif key == 'locations':
+                if set(set_locations) != set(assigned_locations):
+                    diff_val = diff_val + 1
+            elif val != query_out[key]:
+                diff_val = diff_val + 1
+
+    return diff_val
+
+
+def payload(utils, size):
+    domains = [{'id': i} for i in range(size)]
+    locations = [{'id': i} for i in range(size)]
+    data = utils.theforeman_subnet_data(
+        'subnet', '', 'IPv4', '10.0.0.0', '255.255.255.0', '10.0.0.1',
+        '', '', 'DHCP', '', '', '', 'DHCP', None, None, None, domains,
+        locations
+    )
+    current = dict(data['subnet'])
+    current['id'] = 1
+    # Foreman returns associations in its own order with extra fields
+    current['domains'] = [{'id': i, 'name': 'd%d' % i}
+                          for i in reversed(range(size))]
+    current['locations'] = [{'id': i, 'name': 'l%d' % i}
+                            for i in reversed(range(size))]
+
+    return data, current, domains, locations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', default='100,1000,10000,100000')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    utils, library = load_modules()
+
+    print('%-10s %-10s %14s %14s' % ('size', 'case', 'engine (ms)',
+                                     'legacy (ms)'))
+    for size in [int(i) for i in args.sizes.split(',')]:
+        (data, current, domains, locations) = payload(utils, size)
+        changed = dict(current)
+        changed['locations'] = current['locations'][1:]
+
+        for (case, record) in (('converged', current),
+                               ('changed', changed)):
+            number = max(1, 100000 // size)
+            engine = min(timeit.repeat(
+                lambda: utils.theforeman_compare_values(
+                    None, '', data, record, domains, locations),
+                number=number, repeat=args.repeat)) / number
+            legacy = min(timeit.repeat(
+                lambda: legacy_compare_values(data, record, domains,
+                                              locations),
+                number=number, repeat=args.repeat)) / number
+            print('%-10d %-10s %14.3f %14.3f' % (size, case, engine * 1000,
+                                                 legacy * 1000))
+
+
+if __name__ == '__main__':
+    main()
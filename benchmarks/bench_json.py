@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# This code is part of Ansible, but is an independent component.
+
+"""Micro-benchmark the JSON codecs on realistic Foreman payloads.
+
+Payloads are built from the records of a seeded mock server (see
+mock_foreman.py): collection pages of subnets and domains and a subnet
+detail record with many associations. Every installed codec (json,
+simplejson, orjson) is timed for decoding and encoding, as well as the
+theforeman_json_decode/encode helpers using the codec theforeman_utils
+picked at import time.
+
+    python benchmarks/bench_json.py --per-page 1000 --associations 10000
+"""
+
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_foreman import ForemanState, seed # NOQA
+from run_benchmarks import load_modules # NOQA
+
+
+def codecs():
+    found = [('json', json.loads, lambda i: json.dumps(i).encode('utf-8'))]
+    try:
+        import simplejson
+        found.append(('simplejson', simplejson.loads,
+                      lambda i: simplejson.dumps(i).encode('utf-8')))
+    except ImportError:
+        pass
+    try:
+        import orjson
+        found.append(('orjson', orjson.loads, orjson.dumps))
+    except ImportError:
+        pass
+
+    return found
+
+
+def page(state, resource, per_page):
+    records = state.collections[resource][:per_page]
+    return {
+        'total': len(state.collections[resource]),
+        'subtotal': len(state.collections[resource]),
+        'page': 1,
+        'per_page': per_page,
+        'search': None,
+        'sort': {'by': None, 'order': None},
+        'results': [state.list_record(i) for i in records],
+    }
+
+
+def payloads(per_page, associations):
+    state = ForemanState()
+    seed(state, max(per_page, associations))
+
+    subnet = dict(state.collections['subnets'][0])
+    subnet['domains'] = [i['id'] for i in
+                         state.collections['domains'][:associations]]
+    subnet['locations'] = [i['id'] for i in
+                           state.collections['locations'][:associations]]
+
+    return [
+        ('subnets page', page(state, 'subnets', per_page)),
+        ('domains page', page(state, 'domains', per_page)),
+        ('subnet detail', state.detail_record(subnet)),
+    ]
+
+
+def best(func, number, repeat):
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('--per-page', type=int, default=1000,
+                        help='records per collection page')
+    parser.add_argument('--associations', type=int, default=10000,
+                        help='domains and locations of the detail record')
+    parser.add_argument('--number', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    utils, library = load_modules()
+    available = codecs() + [(
+        'utils (%s)' % (utils.THEFOREMAN_JSON_BACKEND),
+        utils.theforeman_json_decode, utils.theforeman_json_encode
+    )]
+
+    print('%-14s %9s  %-18s %12s %12s %9s' % (
+        'payload', 'KiB', 'codec', 'decode (ms)', 'encode (ms)', 'speedup'))
+    for (name, data) in payloads(args.per_page, args.associations):
+        content = json.dumps(data).encode('utf-8')
+        baseline = None
+        for (codec, loads, dumps) in available:
+            assert loads(content) == data
+            decode = best(lambda: loads(content), args.number, args.repeat)
+            encode = best(lambda: dumps(data), args.number, args.repeat)
+            if baseline is None:
+                baseline = decode + encode
+            print('%-14s %9.1f  %-18s %12.3f %12.3f %8.1fx' % (
+                name, len(content) / 1024.0, codec, decode * 1000,
+                encode * 1000, baseline / (decode + encode)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# This code is part of Ansible, but is an independent component.
+
+"""Compare record stores against lists of dicts for cached collections.
+
+Detail records of the subnets, domains and locations of a seeded mock
+server (see mock_foreman.py) are decoded from JSON, as they are when read
+from Foreman or a snapshot file. Each collection is then kept as a list
+of dicts indexed by name, and separately in the TheForemanRecordStore of
+its resource type. The report shows the memory each representation holds,
+its build time and the time of a lookup by name.
+
+    python benchmarks/bench_store.py --size 40000
+"""
+
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_foreman import ForemanState, seed # NOQA
+from run_benchmarks import load_modules # NOQA
+
+
+RESOURCES = ('subnets', 'domains', 'locations')
+
+
+def detail_records(state, resource):
+    return json.dumps([state.detail_record(i)
+                       for i in state.collections[resource]])
+
+
+def as_dicts(utils, resource, content):
+    records = json.loads(content)
+    index = dict((i['name'], i) for i in records)
+    return records, index
+
+
+def as_store(utils, resource, content):
+    return utils.theforeman_store_records(resource, json.loads(content))
+
+
+def measure(build, *args):
+    gc.collect()
+    tracemalloc.start()
+    start = time.time()
+    result = build(*args)
+    elapsed = time.time() - start
+    gc.collect()
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    return result, held, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('--size', type=int, default=40000,
+                        help='records per collection')
+    parser.add_argument('--number', type=int, default=100000,
+                        help='lookups timed per representation')
+    args = parser.parse_args()
+
+    utils, library = load_modules()
+    state = ForemanState()
+    seed(state, args.size)
+
+    print('%-10s %-6s %12s %10s %12s' % (
+        'resource', 'form', 'held (KiB)', 'build (s)', 'lookup (us)'))
+    for resource in RESOURCES:
+        content = detail_records(state, resource)
+        name = state.collections[resource][args.size // 2]['name']
+
+        (dicts, held, elapsed) = measure(as_dicts, utils, resource, content)
+        index = dicts[1]
+        lookup = timeit.timeit(lambda index=index: index.get(name),
+                               number=args.number)
+        print('%-10s %-6s %12d %10.3f %12.3f' % (
+            resource, 'dicts', held / 1024, elapsed,
+            lookup / args.number * 1e6))
+        del dicts, index
+
+        (store, held, elapsed) = measure(as_store, utils, resource, content)
+        assert store.get('name', name)['name'] == name
+        lookup = timeit.timeit(lambda store=store: store.get('name', name),
+                               number=args.number)
+        print('%-10s %-6s %12d %10.3f %12.3f' % (
+            resource, 'store', held / 1024, elapsed,
+            lookup / args.number * 1e6))
+        del store
+
+
+if __name__ == '__main__':
+    main()
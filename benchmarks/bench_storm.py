@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# This code is part of Ansible, but is an independent component.
+
+"""Simulate a fork storm against an overloaded mock Foreman server.
+
+Starts a mock server (see mock_foreman.py) that only handles --capacity
+requests at a time and answers the rest with 503, then runs a scenario of
+run_benchmarks.py in --forks processes at once, like a play with that many
+forks. Reports how many module runs failed, the wall time and how many
+requests the server handled and rejected. Module parameters such as
+max_retries, rate_limit or rate_limit_latency are passed with --param.
+
+    python benchmarks/bench_storm.py --forks 100 --capacity 8
+    python benchmarks/bench_storm.py --param max_retries=0
+    python benchmarks/bench_storm.py --param rate_limit=200 \\
+        --param rate_limit_latency=0.05
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_foreman import start_server # NOQA
+from run_benchmarks import SCENARIOS, BenchmarkModule, load_modules, \
+    server_call # NOQA
+
+
+def fork(scenario, url, size, params, barrier, queue):
+    utils, library = load_modules()
+    module = BenchmarkModule(utils, url=url, **params)
+    func = dict(SCENARIOS)[scenario]
+
+    # Start every fork at the same time
+    barrier.wait()
+    try:
+        func(library, module, url, size)
+        queue.put(None)
+    except Exception as e:
+        queue.put('%s: %s' % (type(e).__name__, e))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('--forks', type=int, default=100)
+    parser.add_argument('--capacity', type=int, default=8,
+                        help='requests the server handles at once')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='seconds the server takes per request')
+    parser.add_argument('--size', type=int, default=1000)
+    parser.add_argument('--scenario', default='subnet_converged')
+    parser.add_argument('--param', action='append', default=[],
+                        help='module parameter as key=JSON value '
+                             '(repeatable), e.g. max_retries=0')
+    args = parser.parse_args()
+
+    params = {}
+    for i in args.param:
+        (key, value) = i.split('=', 1)
+        try:
+            params[key] = json.loads(value)
+        except ValueError:
+            params[key] = value
+
+    process, url = start_server(args.size, args.latency,
+                                capacity=args.capacity)
+    try:
+        server_call(url, '/__reset', 'POST')
+        queue = multiprocessing.Queue()
+        barrier = multiprocessing.Barrier(args.forks + 1)
+        forks = [multiprocessing.Process(
+            target=fork,
+            args=(args.scenario, url, args.size, params, barrier, queue)
+        ) for i in range(args.forks)]
+        for i in forks:
+            i.start()
+        barrier.wait()
+        start = time.time()
+        errors = [queue.get() for i in forks]
+        wall_time = time.time() - start
+        for i in forks:
+            i.join()
+        stats = server_call(url, '/__stats')
+    finally:
+        process.terminate()
+        process.join()
+
+    failed = [i for i in errors if i]
+    print('forks %d, failed %d, wall time %.2fs, requests %d, rejected %d' % (
+        args.forks, len(failed), wall_time, stats['requests'],
+        stats['rejected']))
+    for i in sorted(set(failed)):
+        print('  %s' % (i[:120]))
+
+
+if __name__ == '__main__':
+    main()
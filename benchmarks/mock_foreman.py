@@ -0,0 +1,520 @@
+# This code is part of Ansible, but is an independent component.
+
+"""Stand-in Foreman API server used by the benchmarks.
+
+The server keeps seeded collections in memory and implements the subset of
+the Foreman API used by the modules: paginated collections, exact scoped
+search on name/description/title (OR-ed terms), detail records with their
+associations, POST/PUT/DELETE, audits of those writes (searchable by
+"id > N"), ETag revalidation of reads and gzip compression of larger
+responses (as Apache's mod_deflate in front of a Foreman server does).
+With a capacity, requests beyond that many in flight are rejected with 503
+like an overloaded Passenger queue. Requests need Basic auth credentials
+(any password is accepted) or the cookie of the session opened when
+credentials were verified, as Foreman does. Verifications can be made to
+cost --auth-cost seconds. Requests are counted per endpoint and can be
+read or reset through GET /__stats and POST /__reset.
+"""
+
+import gzip
+import hashlib
+import json
+import multiprocessing
+import re
+import uuid
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+
+SEARCH_TERM = re.compile(r'^\s*(\w+)\s*=\s*"([^"]*)"\s*$')
+AUDIT_SEARCH = re.compile(r'^\s*id\s*>\s*(\d+)\s*$')
+
+# Fields that can be used in scoped searches, per resource type
+SEARCHABLE = {
+    'architectures': ('name',),
+    'domains': ('name', 'fullname'),
+    'locations': ('name', 'title', 'description'),
+    'operatingsystems': ('name', 'title', 'description'),
+    'organizations': ('name', 'title', 'description'),
+    'smart_proxies': ('name', 'url'),
+    'subnets': ('name', 'network'),
+}
+
+# Responses smaller than this are sent uncompressed
+COMPRESS_MIN_SIZE = 1024
+
+# Auditable type of the records of each resource type
+AUDITABLE_TYPES = {
+    'architectures': 'Architecture',
+    'domains': 'Domain',
+    'locations': 'Location',
+    'operatingsystems': 'Operatingsystem',
+    'organizations': 'Organization',
+    'smart_proxies': 'SmartProxy',
+    'subnets': 'Subnet::Ipv4',
+}
+
+# Association fields only returned by detail requests, and the resource
+# type they refer to
+ASSOCIATIONS = {
+    'domains': 'domains',
+    'locations': 'locations',
+    'organizations': 'organizations',
+    'operatingsystems': 'operatingsystems',
+}
+
+
+class ForemanState(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.collections = dict((i, []) for i in SEARCHABLE)
+        self.by_id = dict((i, {}) for i in SEARCHABLE)
+        self.next_id = 1
+        self.stats = {}
+        self.requests = 0
+        self.bytes = 0
+        self.rejected = 0
+        self.in_flight = 0
+        self.authentications = 0
+        self.sessions = set()
+        self.audits = []
+        self.auditing = False
+
+    def add(self, resource, record):
+        record = dict(record)
+        record['id'] = self.next_id
+        self.next_id += 1
+        record.setdefault('created_at', '2017-01-01 00:00:00 UTC')
+        record['updated_at'] = time.strftime('%Y-%m-%d %H:%M:%S UTC',
+                                             time.gmtime())
+        for key in ASSOCIATIONS:
+            if key in record:
+                record[key] = self.normalize_ids(record[key])
+        self.collections[resource].append(record)
+        self.by_id[resource][record['id']] = record
+        self.audit(resource, record, 'create')
+        return record
+
+    def remove(self, resource, record):
+        self.collections[resource].remove(record)
+        del self.by_id[resource][record['id']]
+        self.audit(resource, record, 'destroy')
+
+    def audit(self, resource, record, action):
+        if not self.auditing:
+            return
+        self.audits.append({
+            'id': len(self.audits) + 1,
+            'auditable_type': AUDITABLE_TYPES[resource],
+            'auditable_id': record['id'],
+            'auditable_name': record.get('name'),
+            'action': action,
+            'created_at': time.strftime('%Y-%m-%d %H:%M:%S UTC',
+                                        time.gmtime()),
+        })
+
+    def find(self, resource, key):
+        if key.isdigit() and int(key) in self.by_id[resource]:
+            return self.by_id[resource][int(key)]
+        for record in self.collections[resource]:
+            if record.get('name') == key:
+                return record
+        return None
+
+    @staticmethod
+    def normalize_ids(values):
+        ids = []
+        for i in values or []:
+            if isinstance(i, dict):
+                i = i.get('id')
+            if i not in (None, ''):
+                ids.append(int(i))
+        return ids
+
+    def list_record(self, record):
+        return dict((k, v) for k, v in record.items()
+                    if k not in ASSOCIATIONS)
+
+    def detail_record(self, record):
+        out = self.list_record(record)
+        for key, resource in ASSOCIATIONS.items():
+            if key in record:
+                out[key] = []
+                for i in record[key]:
+                    ref = self.by_id[resource].get(i)
+                    if ref:
+                        out[key].append({'id': i, 'name': ref['name']})
+        return out
+
+
+def seed(state, size):
+    """Seed every collection with size records (and a few dependencies)."""
+    small = max(1, min(size, 100))
+
+    for i in range(small):
+        state.add('organizations', {'name': 'organization-%d' % i,
+                                    'title': 'organization-%d' % i,
+                                    'description': ''})
+        state.add('operatingsystems', {'name': 'os-%d' % i,
+                                       'title': 'OS %d' % i,
+                                       'description': 'OS %d' % i,
+                                       'major': str(i), 'minor': '0',
+                                       'family': 'Redhat'})
+
+    for i in range(size):
+        state.add('locations', {'name': 'location-%d' % i,
+                                'title': 'location-%d' % i,
+                                'description': ''})
+        state.add('smart_proxies', {'name': 'proxy-%d' % i,
+                                    'url': 'https://proxy-%d:8443' % i})
+        state.add('architectures', {'name': 'arch-%d' % i,
+                                    'operatingsystems': []})
+
+    location_ids = [i['id'] for i in state.collections['locations']]
+    for i in range(size):
+        state.add('domains', {'name': 'domain-%d.example.com' % i,
+                              'fullname': '', 'dns_id': None,
+                              'locations': location_ids[i:i + 2]})
+
+    domain_ids = [i['id'] for i in state.collections['domains']]
+    for i in range(size):
+        state.add('subnets', {
+            'name': 'subnet-%d' % i,
+            'description': '',
+            'network_type': 'IPv4',
+            'network': '10.%d.%d.0' % (i // 256 % 256, i % 256),
+            'mask': '255.255.255.0',
+            'cidr': 24,
+            'gateway': None,
+            'dns_primary': None,
+            'dns_secondary': None,
+            'ipam': 'DHCP',
+            'from': None,
+            'to': None,
+            'vlanid': None,
+            'boot_mode': 'DHCP',
+            'dhcp_id': None,
+            'dns_id': None,
+            'tftp_id': None,
+            'domains': domain_ids[i:i + 2],
+            'locations': location_ids[i:i + 2],
+            'organizations': [],
+        })
+
+
+class ForemanHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    state = None
+    latency = 0
+    compress = True
+    capacity = 0
+    auth_cost = 0
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status, obj, headers=None):
+        body = json.dumps(obj).encode('utf-8')
+        extra = ''.join('%s: %s\r\n' % i for i in (headers or {}).items())
+        if getattr(self, 'session', None):
+            extra += 'Set-Cookie: _session_id=%s; path=/; HttpOnly\r\n' % (
+                self.session)
+        # Answer conditional reads like Rails' ETag middleware does
+        if status == 200 and self.command == 'GET':
+            etag = 'W/"%s"' % (hashlib.md5(body).hexdigest())
+            extra += 'ETag: %s\r\n' % (etag)
+            if self.headers.get('If-None-Match') == etag:
+                status = 304
+                body = b''
+        accept = self.headers.get('Accept-Encoding') or ''
+        if self.compress and len(body) >= COMPRESS_MIN_SIZE and \
+                'gzip' in [i.split(';')[0].strip() for i in accept.split(',')]:
+            body = gzip.compress(body, 6)
+            extra += 'Content-Encoding: gzip\r\nVary: Accept-Encoding\r\n'
+        head = ('HTTP/1.1 %d %s\r\n'
+                'Content-Type: application/json; charset=utf-8\r\n'
+                'Content-Length: %d\r\n'
+                '%s'
+                '\r\n' % (status, self.responses[status][0], len(body),
+                          extra))
+        # Count before sending so /__stats never misses a finished response
+        if not self.path.startswith('/__'):
+            with self.state.lock:
+                self.state.bytes += len(body)
+        # Send headers and body in one write to avoid delayed ACK stalls
+        self.wfile.write(head.encode('ascii') + body)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        try:
+            return json.loads(self.rfile.read(length).decode('utf-8'))
+        except ValueError:
+            return {}
+
+    def authenticate(self):
+        """Check the session cookie or else verify the credentials."""
+        self.session = None
+        for i in (self.headers.get('Cookie') or '').split(';'):
+            (name, value) = (i.strip().split('=', 1) + [''])[:2]
+            if name == '_session_id' and value in self.state.sessions:
+                return True
+
+        if not (self.headers.get('Authorization') or '').startswith(
+                'Basic '):
+            return False
+
+        if self.auth_cost:
+            time.sleep(self.auth_cost)
+        with self.state.lock:
+            self.state.authentications += 1
+            self.session = uuid.uuid4().hex
+            self.state.sessions.add(self.session)
+        return True
+
+    def count(self, method, path):
+        endpoint = '%s %s' % (method, re.sub(r'/[^/]+$', '/:id', path)
+                              if path.count('/') > 2 else path)
+        with self.state.lock:
+            self.state.requests += 1
+            self.state.stats[endpoint] = self.state.stats.get(endpoint, 0) + 1
+
+    def search(self, resource, records, search):
+        terms = []
+        for term in re.split(r'\s+or\s+', search):
+            match = SEARCH_TERM.match(term)
+            if not match or match.group(1) not in SEARCHABLE[resource]:
+                return None
+            terms.append(match.groups())
+
+        wanted = {}
+        for (field, value) in terms:
+            wanted.setdefault(field, set()).add(value)
+
+        return [i for i in records
+                if any(i.get(f) in v for f, v in wanted.items())]
+
+    def handle_api(self, method):
+        parsed = urlparse(self.path)
+        query = parse_qs(parsed.query)
+        parts = [i for i in parsed.path.split('/') if i]
+        body = self.read_json() if method != 'GET' else {}
+
+        if parsed.path == '/__stats':
+            with self.state.lock:
+                stats = {
+                    'requests': self.state.requests,
+                    'rejected': self.state.rejected,
+                    'authentications': self.state.authentications,
+                    'bytes': self.state.bytes,
+                    'endpoints': dict(self.state.stats),
+                }
+            return self.send_json(200, stats)
+        if parsed.path == '/__sessions' and method == 'DELETE':
+            with self.state.lock:
+                self.state.sessions.clear()
+            return self.send_json(200, {})
+        if parsed.path == '/__reset':
+            with self.state.lock:
+                self.state.requests = 0
+                self.state.rejected = 0
+                self.state.authentications = 0
+                self.state.bytes = 0
+                self.state.stats = {}
+            return self.send_json(200, {})
+
+        with self.state.lock:
+            overloaded = self.capacity and \
+                self.state.in_flight >= self.capacity
+            if overloaded:
+                self.state.rejected += 1
+            else:
+                self.state.in_flight += 1
+        if overloaded:
+            return self.send_json(503, {'error': {
+                'message': 'Service Unavailable'}}, {'Retry-After': '1'})
+
+        try:
+            self.count(method, parsed.path)
+            if self.latency:
+                time.sleep(self.latency)
+            if not self.authenticate():
+                return self.send_json(401, {'error': {
+                    'message': 'Unable to authenticate user'}})
+            return self.handle_resource(method, parsed, query, parts, body)
+        finally:
+            with self.state.lock:
+                self.state.in_flight -= 1
+
+    def handle_audits(self, query):
+        audits = self.state.audits
+        search = query.get('search', [''])[0]
+        if search:
+            match = AUDIT_SEARCH.match(search)
+            if not match:
+                return self.send_json(422, {'error': {
+                    'message': 'Invalid search query'}})
+            audits = [i for i in audits if i['id'] > int(match.group(1))]
+        if query.get('order', [''])[0].split()[-1:] != ['ASC']:
+            audits = audits[::-1]
+        per_page = int(query.get('per_page', ['20'])[0])
+        page = int(query.get('page', ['1'])[0])
+        start = (page - 1) * per_page
+        return self.send_json(200, {
+            'total': len(self.state.audits),
+            'subtotal': len(audits),
+            'page': page,
+            'per_page': per_page,
+            'search': search or None,
+            'results': audits[start:start + per_page],
+        })
+
+    def handle_resource(self, method, parsed, query, parts, body):
+
+        if parts == ['api', 'audits'] and method == 'GET':
+            return self.handle_audits(query)
+
+        if len(parts) < 2 or parts[0] != 'api' or \
+                parts[1] not in SEARCHABLE:
+            return self.send_json(404, {'error': {'message': 'Not found'}})
+
+        resource = parts[1]
+        state = self.state
+
+        if len(parts) == 2:
+            if method == 'GET':
+                records = state.collections[resource]
+                search = query.get('search', [''])[0]
+                if search:
+                    records = self.search(resource, records, search)
+                    if records is None:
+                        return self.send_json(422, {'error': {
+                            'message': 'Invalid search query'}})
+                per_page = int(query.get('per_page', ['20'])[0])
+                page = int(query.get('page', ['1'])[0])
+                start = (page - 1) * per_page
+                return self.send_json(200, {
+                    'total': len(state.collections[resource]),
+                    'subtotal': len(records),
+                    'page': page,
+                    'per_page': per_page,
+                    'search': search or None,
+                    'sort': {'by': None, 'order': None},
+                    'results': [state.list_record(i) for i in
+                                records[start:start + per_page]],
+                })
+            if method == 'POST':
+                values = list(body.values())[0] if body else {}
+                with state.lock:
+                    record = state.add(resource, values)
+                return self.send_json(201, state.detail_record(record))
+            return self.send_json(405, {'error': {'message': 'Not allowed'}})
+
+        record = state.find(resource, parts[2])
+        if record is None:
+            return self.send_json(404, {'error': {'message': 'Not found'}})
+
+        if method == 'GET':
+            return self.send_json(200, state.detail_record(record))
+        if method == 'PUT':
+            values = list(body.values())[0] if body else {}
+            with state.lock:
+                for key, value in values.items():
+                    if key in ASSOCIATIONS:
+                        value = state.normalize_ids(value)
+                    record[key] = value
+                record['updated_at'] = time.strftime(
+                    '%Y-%m-%d %H:%M:%S UTC', time.gmtime())
+                state.audit(resource, record, 'update')
+            return self.send_json(200, state.detail_record(record))
+        if method == 'DELETE':
+            with state.lock:
+                state.remove(resource, record)
+            return self.send_json(200, state.detail_record(record))
+
+        return self.send_json(405, {'error': {'message': 'Not allowed'}})
+
+    def do_GET(self):
+        self.handle_api('GET')
+
+    def do_POST(self):
+        self.handle_api('POST')
+
+    def do_PUT(self):
+        self.handle_api('PUT')
+
+    def do_DELETE(self):
+        self.handle_api('DELETE')
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def make_server(size, latency=0, host='127.0.0.1', port=0, compress=True,
+                capacity=0, auth_cost=0):
+    state = ForemanState()
+    seed(state, size)
+    state.auditing = True
+
+    handler = type('SeededForemanHandler', (ForemanHandler,), {
+        'state': state,
+        'latency': latency,
+        'compress': compress,
+        'capacity': capacity,
+        'auth_cost': auth_cost,
+    })
+
+    return ThreadingServer((host, port), handler)
+
+
+def _serve(size, latency, compress, capacity, auth_cost, conn):
+    server = make_server(size, latency, compress=compress, capacity=capacity,
+                         auth_cost=auth_cost)
+    conn.send(server.server_address[1])
+    conn.close()
+    server.serve_forever()
+
+
+def start_server(size, latency=0, compress=True, capacity=0, auth_cost=0):
+    """Start a seeded server in a child process, returns (process, url)."""
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_serve,
+                                      args=(size, latency, compress, capacity,
+                                            auth_cost, child))
+    process.daemon = True
+    process.start()
+    port = parent.recv()
+
+    return process, 'http://127.0.0.1:%d' % (port)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--port', type=int, default=3000)
+    parser.add_argument('--no-compression', action='store_true',
+                        help='never gzip responses')
+    parser.add_argument('--capacity', type=int, default=0,
+                        help='reject requests beyond this many in flight '
+                             'with 503')
+    parser.add_argument('--auth-cost', type=float, default=0,
+                        help='seconds a credential verification takes')
+    args = parser.parse_args()
+
+    server = make_server(args.size, args.latency, port=args.port,
+                         compress=not args.no_compression,
+                         capacity=args.capacity,
+                         auth_cost=args.auth_cost)
+    print('Serving mock Foreman with %d records per collection on port %d'
+          % (args.size, args.port))
+    server.serve_forever()
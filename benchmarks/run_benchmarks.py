@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+# This code is part of Ansible, but is an independent component.
+
+"""Benchmark the Foreman modules against a local mock Foreman server.
+
+For every collection size a fresh mock server (see mock_foreman.py) is
+seeded and the create()/remove() paths of the modules in library/ are run
+end to end. Each scenario reports the number of requests the server saw,
+the bytes it sent, wall time and peak Python memory of the module code.
+
+The modules are loaded the way Ansible loads them, so ansible (or
+ansible-core) must be importable. Each scenario runs with freshly loaded
+modules, mimicking a separate module process per task.
+
+Examples:
+
+    python benchmarks/run_benchmarks.py --sizes 100,1000,10000
+    python benchmarks/run_benchmarks.py --latency 0.02 --output new.json
+    python benchmarks/run_benchmarks.py --baseline old.json \\
+        --max-regression 0.25
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+from urllib.request import Request, urlopen
+
+import ansible.module_utils
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_foreman import start_server # NOQA
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class BenchmarkFailure(Exception):
+    pass
+
+
+class BenchmarkModule(object):
+    """Minimal stand-in for AnsibleModule used to call create()/remove()."""
+
+    def __init__(self, utils, check_mode=False, **params):
+        self.params = dict(
+            (k, v.get('default'))
+            for k, v in utils.theforeman_argument_spec().items()
+        )
+        self.params.update(url_password='changeme', force_basic_auth=True)
+        self.params.update(params)
+        self.check_mode = check_mode
+
+    def fail_json(self, **kwargs):
+        raise BenchmarkFailure(kwargs.get('msg'))
+
+    def exit_json(self, **kwargs):
+        pass
+
+
+def load_source(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+
+    return module
+
+
+def load_modules():
+    """Load module_utils and library modules as a fresh module run would."""
+    utils = load_source('ansible.module_utils.theforeman_utils',
+                        os.path.join(ROOT, 'module_utils',
+                                     'theforeman_utils.py'))
+    ansible.module_utils.theforeman_utils = utils
+
+    library = {}
+    for name in os.listdir(os.path.join(ROOT, 'library')):
+        if name.startswith('theforeman_') and name.endswith('.py'):
+            library[name[:-3]] = load_source(
+                'benchmark_' + name[:-3],
+                os.path.join(ROOT, 'library', name)
+            )
+
+    return utils, library
+
+
+def server_call(url, path, method='GET'):
+    request = Request(url + path, data=b'' if method == 'POST' else None)
+    return json.loads(urlopen(request).read().decode('utf-8'))
+
+
+def subnet_args(name, index, domains, locations, proxy):
+    return [
+        name, '', 'IPv4', '10.%d.%d.0' % (index // 256 % 256, index % 256),
+        '255.255.255.0', '', '', '', 'DHCP', '', '', '', 'DHCP', proxy,
+        proxy, proxy, domains, locations, [],
+    ]
+
+
+# Scenarios run for every size, each gets the loaded library, a module
+# stand-in, the server URL and the collection size
+def domain_converged(lib, module, url, size):
+    i = size // 2
+    return lib['theforeman_domain'].create(
+        module, 'domain-%d.example.com' % i, '',
+        ['location-%d' % i, 'location-%d' % (i + 1)], url
+    )
+
+
+def domain_create(lib, module, url, size):
+    return lib['theforeman_domain'].create(
+        module, 'new-domain.example.com', '', ['location-0'], url
+    )
+
+
+def domain_remove(lib, module, url, size):
+    return lib['theforeman_domain'].remove(
+        module, 'new-domain.example.com', '', [], url
+    )
+
+
+def location_converged(lib, module, url, size):
+    return lib['theforeman_location'].create(
+        module, 'location-%d' % (size // 2), '', url
+    )
+
+
+def location_create(lib, module, url, size):
+    return lib['theforeman_location'].create(module, 'new-location', '', url)
+
+
+def architecture_converged(lib, module, url, size):
+    return lib['theforeman_architecture'].create(
+        module, 'arch-%d' % (size // 2), [], url
+    )
+
+
+def smart_proxy_converged(lib, module, url, size):
+    i = size // 2
+    return lib['theforeman_smart_proxy'].create(
+        module, 'proxy-%d' % i, 'https://proxy-%d:8443' % i, url
+    )
+
+
+def subnet_converged(lib, module, url, size):
+    i = size // 2
+    args = subnet_args('subnet-%d' % i, i,
+                       ['domain-%d.example.com' % i,
+                        'domain-%d.example.com' % (i + 1)],
+                       ['location-%d' % i, 'location-%d' % (i + 1)], None)
+    return lib['theforeman_subnet'].create(module, *(args + [url]))
+
+
+def subnet_create(lib, module, url, size):
+    args = subnet_args('new-subnet', size + 1, ['domain-0.example.com'],
+                       ['location-0'], 'proxy-0')
+    return lib['theforeman_subnet'].create(module, *(args + [url]))
+
+
+SCENARIOS = [
+    ('domain_converged', domain_converged),
+    ('domain_create', domain_create),
+    ('domain_remove', domain_remove),
+    ('location_converged', location_converged),
+    ('location_create', location_create),
+    ('architecture_converged', architecture_converged),
+    ('smart_proxy_converged', smart_proxy_converged),
+    ('subnet_converged', subnet_converged),
+    ('subnet_create', subnet_create),
+]
+
+
+def run_scenario(func, url, size, params):
+    utils, library = load_modules()
+    module = BenchmarkModule(utils, url=url, **params)
+
+    server_call(url, '/__reset', 'POST')
+    tracemalloc.start()
+    start = time.time()
+    error = None
+    try:
+        (rc, query_out, changed) = func(library, module, url, size)
+    except Exception as e:
+        error = '%s: %s' % (type(e).__name__, e)
+        changed = None
+    wall_time = time.time() - start
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    stats = server_call(url, '/__stats')
+
+    for client in utils.THEFOREMAN_CLIENTS.values():
+        client.close()
+
+    result = {
+        'requests': stats['requests'],
+        'authentications': stats['authentications'],
+        'bytes': stats['bytes'],
+        'endpoints': stats['endpoints'],
+        'wall_time': wall_time,
+        'peak_memory': peak_memory,
+        'changed': changed,
+    }
+    if error:
+        result['error'] = error
+
+    return result
+
+
+def run(sizes, latency, params, scenarios, compress=True):
+    results = {}
+    for size in sizes:
+        process, url = start_server(size, latency, compress)
+        try:
+            for (name, func) in SCENARIOS:
+                if scenarios and name not in scenarios:
+                    continue
+                results['%s/%d' % (name, size)] = run_scenario(
+                    func, url, size, params
+                )
+        finally:
+            process.terminate()
+            process.join()
+
+    return results
+
+
+def report(results):
+    print('%-32s %9s %12s %10s %12s  %s' % (
+        'scenario/size', 'requests', 'bytes', 'wall (s)', 'peak mem',
+        'changed'))
+    for key, i in sorted(results.items(),
+                         key=lambda i: (i[0].split('/')[0],
+                                        int(i[0].split('/')[1]))):
+        print('%-32s %9d %12d %10.3f %12d  %s' % (
+            key, i['requests'], i['bytes'], i['wall_time'],
+            i['peak_memory'], i.get('error', i['changed'])))
+
+
+def compare(results, baseline, max_regression):
+    """Return the list of regressions against a previous run."""
+    regressions = []
+    for key, i in sorted(results.items()):
+        if key not in baseline:
+            continue
+        old = baseline[key]
+        if 'error' in i and 'error' not in old:
+            regressions.append('%s: now fails with %s' % (key, i['error']))
+            continue
+        if i['requests'] > old['requests']:
+            regressions.append('%s: requests %d -> %d' % (
+                key, old['requests'], i['requests']))
+        for metric in ('wall_time', 'peak_memory', 'bytes'):
+            if old[metric] and \
+                    i[metric] > old[metric] * (1 + max_regression):
+                regressions.append('%s: %s %s -> %s' % (
+                    key, metric, old[metric], i[metric]))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('--sizes', default='100,1000,10000,100000',
+                        help='comma separated collection sizes')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds the mock server waits per request')
+    parser.add_argument('--no-compression', action='store_true',
+                        help='make the mock server send uncompressed '
+                             'responses')
+    parser.add_argument('--scenario', action='append', default=[],
+                        help='only run the given scenario (repeatable)')
+    parser.add_argument('--param', action='append', default=[],
+                        help='module parameter as key=JSON value '
+                             '(repeatable), e.g. per_page=1000')
+    parser.add_argument('--output', help='write results as JSON')
+    parser.add_argument('--baseline', help='JSON results of a previous run')
+    parser.add_argument('--max-regression', type=float, default=0.2,
+                        help='allowed relative increase of time, memory '
+                             'and bytes against the baseline')
+    args = parser.parse_args()
+
+    params = {}
+    for i in args.param:
+        (key, value) = i.split('=', 1)
+        try:
+            params[key] = json.loads(value)
+        except ValueError:
+            params[key] = value
+
+    sizes = [int(i) for i in args.sizes.split(',')]
+    results = run(sizes, args.latency, params, args.scenario,
+                  not args.no_compression)
+    report(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.max_regression)
+        for i in regressions:
+            print('REGRESSION %s' % (i))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
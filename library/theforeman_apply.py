@@ -0,0 +1,132 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# (c) 2017, Steven Bambling <smbambling@gmail.com>
+# GNU General Public License v3.0+
+# (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+
+ANSIBLE_METADATA = {'metadata_version': '1.1',
+                    'status': ['preview'],
+                    'supported_by': 'community'}
+
+DOCUMENTATION = '''
+---
+module: theforeman_apply
+version_added: "2.4"
+author: Steven Bambling(@smbambling)
+
+Brings locations, smart proxies, domains, architectures and subnets to a
+desired state in a single task. The desired state takes the same format as
+theforeman_plan. Only the resources named in it and the resources they
+reference are looked up, then the plan is applied level by level: every
+level only holds resources whose references already exist, and runs on at
+most workers concurrent requests. IDs of created resources are used by the
+resources referencing them without looking them up again. Nothing is
+applied when a reference can't be resolved.
+'''
+
+EXAMPLES = '''
+- theforeman_apply:
+    url: https://foreman.example.com
+    url_password: secret
+    workers: 8
+    desired:
+      locations:
+        - name: dc1
+      smart_proxies:
+        - name: proxy.dc1.example.com
+          smart_proxy_url: https://proxy.dc1.example.com:8443
+      domains:
+        - name: dc1.example.com
+          locations:
+            - dc1
+      subnets:
+        - name: dmz
+          network_type: IPv4
+          network: 10.0.0.0
+          mask: 255.255.255.0
+          dhcp_proxy: proxy.dc1.example.com
+          domains:
+            - dc1.example.com
+          locations:
+            - dc1
+'''
+
+RETURN = '''
+result:
+  description: Applied actions with the resource type, name, action
+    (create, update or delete), ID of the resource and level it ran in,
+    the plan of theforeman_plan in check mode
+  returned: always
+  type: list
+summary:
+  description: Number of resources to create, update, delete and left
+    unchanged
+  returned: always
+  type: dict
+'''
+
+try:
+    import json
+except ImportError:
+    import simplejson as json # NOQA
+
+# Ignore PEP8 QA here as it does not conform Ansible requirements
+from ansible.module_utils.basic import AnsibleModule # NOQA
+from ansible.module_utils.theforeman_utils import theforeman_argument_spec, \
+    theforeman_api_stats, theforeman_desired_document, \
+    theforeman_desired_params, theforeman_desired_snapshot, \
+    theforeman_plan, theforeman_apply_plan, THEFOREMAN_LOOKUP_WORKERS # NOQA
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=theforeman_argument_spec(
+            desired=dict(type='dict', required=False),
+            desired_file=dict(type='path', required=False),
+            workers=dict(type='int', required=False,
+                         default=THEFOREMAN_LOOKUP_WORKERS),
+            lookup_workers=dict(type='int', required=False,
+                                default=THEFOREMAN_LOOKUP_WORKERS),
+        ),
+        required_one_of=[['desired', 'desired_file']],
+        mutually_exclusive=[['desired', 'desired_file']],
+        supports_check_mode=True
+    )
+
+    desired = theforeman_desired_params(module,
+                                        theforeman_desired_document(module))
+    url = module.params['url']
+    module.params['force_basic_auth'] = True
+    module.params['url_username']
+    module.params['url_password']
+
+    # url_username and url_password on auto passed into TheForemanClient
+    snapshot = theforeman_desired_snapshot(module, url, desired)
+    (plan, summary) = theforeman_plan(snapshot, desired)
+
+    unresolved = []
+    for action in plan:
+        unresolved.extend([i for i in action.get('unresolved', [])
+                           if i not in unresolved])
+    if unresolved:
+        module.fail_json(msg="Unable to resolve %s" % (', '.join(unresolved)),
+                         plan=plan)
+
+    changed = len(plan) > 0
+    if module.check_mode:
+        result = plan
+    else:
+        result = theforeman_apply_plan(module, url, plan, snapshot, desired,
+                                       module.params['workers'])
+
+    module.exit_json(msg="success", result=result, summary=summary,
+                     changed=changed, **theforeman_api_stats(module))
+
+
+if __name__ == '__main__':
+    main()
@@ -34,10 +34,11 @@ except ImportError:
 
 # Ignore PEP8 QA here as it does not conform Ansible requirements
 from ansible.module_utils.basic import AnsibleModule # NOQA
-from ansible.module_utils.urls import fetch_url # NOQA
 from ansible.module_utils.theforeman_utils import theforeman_query, \
-    theforeman_compare_values, theforeman_obtain_resource_id, \
-    theforeman_gen_os_ids # NOQA
+    theforeman_argument_spec, theforeman_api_stats, \
+    theforeman_compare_values, theforeman_obtain_resource, \
+    theforeman_current_values, theforeman_gen_os_ids, \
+    theforeman_architecture_data, THEFOREMAN_ARCHITECTURE_SPEC # NOQA
 
 
 def create(module, name, operatingsystems, url):
@@ -47,22 +48,17 @@ def create(module, name, operatingsystems, url):
 
     # Query Foreman API for current Domains
     myurl = url + "/api/architectures"
-    data = {
-        "architecture": {
-          "name": name,
-          "operatingsystems": set_operatingsystems
-        }
-    }
+    data = theforeman_architecture_data(name, set_operatingsystems)
     method = 'GET'
     search_parameter = 'name'
     search_value = name
 
-    # Obtain Foreman resource ID
-    resource_id = theforeman_obtain_resource_id(module, myurl, data, method,
-                                                search_parameter, search_value)
+    # Obtain Foreman resource
+    resource = theforeman_obtain_resource(module, myurl, data, method,
+                                          search_parameter, search_value)
 
     # Create architecture if it does not exist
-    if resource_id == 'None' or resource_id == '':
+    if not resource:
         if not module.check_mode:
             myurl = url + "/api/architectures"
             method = 'POST'
@@ -71,9 +67,10 @@ def create(module, name, operatingsystems, url):
         else:
             return False, "Architecture %s will be created" % (name), True
     else:
-        # Obtain current Foreman resource values
-        myurl = url + "/api/architectures/%s" % (resource_id)
-        (query_out, info) = theforeman_query(module, myurl, data, method)
+        # Obtain current Foreman resource values, the collection record is
+        # reused unless association fields need checking
+        myurl = url + "/api/architectures/%s" % (resource['id'])
+        query_out = theforeman_current_values(module, myurl, data, resource)
 
         # Update architecture if set/return values differ
         (diff_val, diff_data) = theforeman_compare_values(module, url, data,
@@ -112,13 +109,8 @@ def remove(module, name, operatingsystems, url):
 
 def main():
     module = AnsibleModule(
-        argument_spec=dict(
-            name=dict(type='str', required=True),
-            operatingsystems=dict(type='list', default=[]),
-            url=dict(required=False, default='https://127.0.01:443'),
-            url_username=dict(type='str', default='admin'),
-            url_password=dict(type='str', no_log=True, required=True),
-            state=dict(default='present', choices=['present', 'absent']),
+        argument_spec=theforeman_argument_spec(
+            **THEFOREMAN_ARCHITECTURE_SPEC
         ),
         supports_check_mode=True
     )
@@ -130,7 +122,7 @@ def main():
     module.params['url_username']
     module.params['url_password']
 
-    # url_username and url_password on auto passed into fetch_url
+    # url_username and url_password on auto passed into TheForemanClient
     state = module.params['state']
 
     if state == 'present':
@@ -145,7 +137,8 @@ def main():
 
     if rc != 0:
         module.fail_json(msg="failed", result=query_out)
-    module.exit_json(msg="success", result=query_out, changed=changed)
+    module.exit_json(msg="success", result=query_out, changed=changed,
+                     **theforeman_api_stats(module))
 
 
 if __name__ == '__main__':
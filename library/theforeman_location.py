@@ -36,31 +36,28 @@ except ImportError:
 
 # Ignore PEP8 QA here as it does not conform Ansible requirements
 from ansible.module_utils.basic import AnsibleModule # NOQA
-from ansible.module_utils.urls import fetch_url # NOQA
 from ansible.module_utils.theforeman_utils import theforeman_query, \
-    theforeman_compare_values, theforeman_obtain_resource_id # NOQA
+    theforeman_argument_spec, theforeman_api_stats, \
+    theforeman_compare_values, theforeman_obtain_resource, \
+    theforeman_current_values, theforeman_location_data, \
+    THEFOREMAN_LOCATION_SPEC # NOQA
 
 
 def create(module, name, description, url):
 
     # Query Foreman API for current Domains
     myurl = url + "/api/locations"
-    data = {
-        "location": {
-          "name": name,
-          "description": description,
-        }
-    }
+    data = theforeman_location_data(name, description)
     method = 'GET'
     search_parameter = 'name'
     search_value = name
 
-    # Obtain Foreman resource ID
-    resource_id = theforeman_obtain_resource_id(module, myurl, data, method,
-                                                search_parameter, search_value)
+    # Obtain Foreman resource
+    resource = theforeman_obtain_resource(module, myurl, data, method,
+                                          search_parameter, search_value)
 
     # Create location if it does not exist
-    if resource_id == 'None' or resource_id == '':
+    if not resource:
         if not module.check_mode:
             myurl = url + "/api/locations"
             method = 'POST'
@@ -69,9 +66,10 @@ def create(module, name, description, url):
         else:
             return False, "Domain %s will be created" % (name), True
     else:
-        # Obtain current Foreman resource values
-        myurl = url + "/api/locations/%s" % (resource_id)
-        (query_out, info) = theforeman_query(module, myurl, data, method)
+        # Obtain current Foreman resource values, the collection record is
+        # reused unless association fields need checking
+        myurl = url + "/api/locations/%s" % (resource['id'])
+        query_out = theforeman_current_values(module, myurl, data, resource)
 
         # Update location if set/return values differ
         (diff_val, diff_data) = theforeman_compare_values(module, url, data,
@@ -107,14 +105,7 @@ def remove(module, name, description, url):
 
 def main():
     module = AnsibleModule(
-        argument_spec=dict(
-            name=dict(type='str', required=True),
-            description=dict(type='str', default=""),
-            url=dict(required=False, default='https://127.0.01:443'),
-            url_username=dict(type='str', default='admin'),
-            url_password=dict(type='str', no_log=True, required=True),
-            state=dict(default='present', choices=['present', 'absent']),
-        ),
+        argument_spec=theforeman_argument_spec(**THEFOREMAN_LOCATION_SPEC),
         supports_check_mode=True
     )
 
@@ -125,7 +116,7 @@ def main():
     module.params['url_username']
     module.params['url_password']
 
-    # url_username and url_password on auto passed into fetch_url
+    # url_username and url_password on auto passed into TheForemanClient
     state = module.params['state']
 
     if state == 'present':
@@ -140,7 +131,8 @@ def main():
 
     if rc != 0:
         module.fail_json(msg="failed", result=query_out)
-    module.exit_json(msg="success", result=query_out, changed=changed)
+    module.exit_json(msg="success", result=query_out, changed=changed,
+                     **theforeman_api_stats(module))
 
 
 if __name__ == '__main__':
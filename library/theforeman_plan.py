@@ -0,0 +1,115 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# (c) 2017, Steven Bambling <smbambling@gmail.com>
+# GNU General Public License v3.0+
+# (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+
+ANSIBLE_METADATA = {'metadata_version': '1.1',
+                    'status': ['preview'],
+                    'supported_by': 'community'}
+
+DOCUMENTATION = '''
+---
+module: theforeman_plan
+version_added: "2.4"
+author: Steven Bambling(@smbambling)
+
+Computes the changes needed to reach a desired state from a snapshot
+written by theforeman_snapshot, without any request to Foreman. The
+desired state maps resource types (locations, smart_proxies, domains,
+architectures, subnets) to lists of items taking the same parameters as
+the matching theforeman_* module, plus an optional state (present or
+absent). Items are compared the same way the modules compare them.
+'''
+
+EXAMPLES = '''
+- theforeman_plan:
+    snapshot: /var/tmp/foreman.snapshot
+    desired:
+      locations:
+        - name: dc1
+      domains:
+        - name: dc1.example.com
+          locations:
+            - dc1
+      subnets:
+        - name: dmz
+          network_type: IPv4
+          network: 10.0.0.0
+          mask: 255.255.255.0
+          domains:
+            - dc1.example.com
+        - name: legacy
+          state: absent
+    plan_file: /var/tmp/foreman.plan
+'''
+
+RETURN = '''
+plan:
+  description: Actions in the order they can be applied, each with the
+    resource type, name, action (create, update or delete), the ID of the
+    existing record, the payload to send (data), the current values of the
+    changed fields (before), references to resources created by the plan
+    (depends_on) and references missing from the snapshot (unresolved)
+  returned: always
+  type: list
+summary:
+  description: Number of resources to create, update, delete and left
+    unchanged
+  returned: always
+  type: dict
+'''
+
+try:
+    import json
+except ImportError:
+    import simplejson as json # NOQA
+
+# Ignore PEP8 QA here as it does not conform Ansible requirements
+from ansible.module_utils.basic import AnsibleModule # NOQA
+from ansible.module_utils.theforeman_utils import theforeman_json_encode, \
+    theforeman_snapshot_load, theforeman_desired_document, \
+    theforeman_desired_params, theforeman_plan # NOQA
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            snapshot=dict(type='path', required=True),
+            desired=dict(type='dict', required=False),
+            desired_file=dict(type='path', required=False),
+            plan_file=dict(type='path', required=False),
+        ),
+        required_one_of=[['desired', 'desired_file']],
+        mutually_exclusive=[['desired', 'desired_file']],
+        supports_check_mode=True
+    )
+
+    snapshot = theforeman_snapshot_load(module.params['snapshot'])
+    if snapshot is None:
+        module.fail_json(msg="Unable to read snapshot %s" % (
+            module.params['snapshot']))
+
+    desired = theforeman_desired_params(module,
+                                        theforeman_desired_document(module))
+    (plan, summary) = theforeman_plan(snapshot, desired)
+
+    if module.params['plan_file'] and not module.check_mode:
+        try:
+            with open(module.params['plan_file'], 'wb') as f:
+                f.write(theforeman_json_encode(plan))
+        except (IOError, OSError) as e:
+            module.fail_json(msg="Unable to write plan %s: %s" % (
+                module.params['plan_file'], e))
+
+    module.exit_json(msg="success", changed=False, plan=plan,
+                     summary=summary, snapshot_time=snapshot['time'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# (c) 2017, Steven Bambling <smbambling@gmail.com>
+# GNU General Public License v3.0+
+# (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+
+ANSIBLE_METADATA = {'metadata_version': '1.1',
+                    'status': ['preview'],
+                    'supported_by': 'community'}
+
+DOCUMENTATION = '''
+---
+module: theforeman_snapshot
+version_added: "2.4"
+author: Steven Bambling(@smbambling)
+
+Reads the Foreman collections of the given resource types once and writes
+them to a local snapshot file. Detail records are fetched for resource
+types whose associations (domains, locations, operating systems) are only
+returned by detail requests. The snapshot is the input of theforeman_plan.
+
+When the snapshot file already exists it is refreshed incrementally: only
+the records Foreman audited since the snapshot was taken are fetched again,
+so refreshing costs requests in proportion to the changes rather than the
+inventory size. The snapshot is taken again when audits can't be read.
+'''
+
+EXAMPLES = '''
+- theforeman_snapshot:
+    url: https://foreman.example.com
+    url_password: secret
+    path: /var/tmp/foreman.snapshot
+'''
+
+RETURN = '''
+incremental:
+  description: Whether the existing snapshot was refreshed from audits
+  returned: always
+  type: bool
+refreshed:
+  description: Number of records fetched again by an incremental refresh
+  returned: always
+  type: int
+removed:
+  description: Number of records removed by an incremental refresh
+  returned: always
+  type: int
+resources:
+  description: Number of records read per resource type
+  returned: always
+  type: dict
+'''
+
+try:
+    import json
+except ImportError:
+    import simplejson as json # NOQA
+
+# Ignore PEP8 QA here as it does not conform Ansible requirements
+from ansible.module_utils.basic import AnsibleModule # NOQA
+from ansible.module_utils.theforeman_utils import theforeman_argument_spec, \
+    theforeman_api_stats, theforeman_snapshot, theforeman_snapshot_save, \
+    theforeman_snapshot_load, theforeman_snapshot_refresh, \
+    THEFOREMAN_SNAPSHOT_RESOURCES, THEFOREMAN_LOOKUP_WORKERS # NOQA
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=theforeman_argument_spec(
+            path=dict(type='path', required=True),
+            resources=dict(type='list',
+                           default=THEFOREMAN_SNAPSHOT_RESOURCES),
+            incremental=dict(type='bool', default=True),
+            lookup_workers=dict(type='int', required=False,
+                                default=THEFOREMAN_LOOKUP_WORKERS),
+        ),
+        supports_check_mode=True
+    )
+
+    path = module.params['path']
+    resources = module.params['resources']
+    url = module.params['url']
+    module.params['force_basic_auth'] = True
+    module.params['url_username']
+    module.params['url_password']
+
+    # url_username and url_password on auto passed into TheForemanClient
+    snapshot = None
+    counts = None
+    if module.params['incremental']:
+        snapshot = theforeman_snapshot_load(path)
+    if snapshot and set(snapshot['resources']) == set(resources):
+        counts = theforeman_snapshot_refresh(module, url, snapshot)
+
+    if counts is None:
+        snapshot = theforeman_snapshot(module, url, resources)
+        changed = True
+        (refreshed, removed) = (0, 0)
+    else:
+        (refreshed, removed) = counts
+        changed = refreshed + removed > 0
+
+    if not module.check_mode:
+        try:
+            theforeman_snapshot_save(path, snapshot)
+        except (IOError, OSError) as e:
+            module.fail_json(msg="Unable to write snapshot %s: %s" % (
+                path, e))
+
+    module.exit_json(msg="success", changed=changed, path=path,
+                     incremental=counts is not None, refreshed=refreshed,
+                     removed=removed,
+                     resources=dict((k, len(v)) for k, v in
+                                    snapshot['resources'].items()),
+                     **theforeman_api_stats(module))
+
+
+if __name__ == '__main__':
+    main()
@@ -33,11 +33,14 @@ except ImportError:
 
 # Ignore PEP8 QA here as it does not conform Ansible requirements
 from ansible.module_utils.basic import AnsibleModule # NOQA
-from ansible.module_utils.urls import fetch_url # NOQA
 from ansible.module_utils.theforeman_utils import theforeman_query, \
+    theforeman_argument_spec, theforeman_api_stats, \
     theforeman_generate_locations_dict, theforeman_generate_domains_dict, \
-    theforeman_generate_organizations_dict, theforeman_compare_values, \
-    theforeman_obtain_resource_id # NOQA
+    theforeman_compare_values, \
+    theforeman_obtain_resource_id, theforeman_obtain_resource, \
+    theforeman_current_values, theforeman_subnet_data, \
+    theforeman_run_concurrently, THEFOREMAN_SUBNET_SPEC, \
+    THEFOREMAN_LOOKUP_WORKERS # NOQA
 
 
 def create(
@@ -47,80 +50,52 @@ def create(
            locations, organizations, url
           ):
 
-    # Create list of domain dictionaries
-    set_domains = theforeman_generate_domains_dict(module, url, domains)
+    # Get resource ID for Foreman DHCP,DNS,TFTP proxies
+    myurl = url + "/api/smart_proxies"
+    data = {}
+    method = 'GET'
+    search_parameter = 'name'
 
-    # Create list of locations dictionaries
-    set_locations = theforeman_generate_locations_dict(module, url, locations)
+    proxy_calls = []
+    for proxy in [dhcp_proxy, dns_proxy, tftp_proxy]:
+        if proxy:
+            proxy_calls.append((theforeman_obtain_resource_id,
+                                (myurl, data, method, search_parameter,
+                                 proxy)))
 
-    # Create list of organizations dictionaries
-    set_organizations = theforeman_generate_organizations_dict(module, url,
-                                                            organizations)
+    # Run the independent lookups concurrently
+    results = theforeman_run_concurrently(module, [
+        # Create list of domain dictionaries
+        (theforeman_generate_domains_dict, (url, domains)),
+        # Create list of locations dictionaries
+        (theforeman_generate_locations_dict, (url, locations)),
+    ] + proxy_calls)
 
-    # Get resource ID for Foreman DHCP,DNS,TFTP proxies
-    if dhcp_proxy or dns_proxy or tftp_proxy:
-        myurl = url + "/api/smart_proxies"
-        data = {}
-        method = 'GET'
-        search_parameter = 'name'
-    if dhcp_proxy:
-        search_value = dhcp_proxy
-        dhcp_proxy_id = theforeman_obtain_resource_id(module, myurl, data, method,
-                                                   search_parameter,
-                                                   search_value)
-    else:
-        dhcp_proxy_id = None
+    set_domains = results.pop(0)
+    set_locations = results.pop(0)
 
-    if dns_proxy:
-        search_value = dns_proxy
-        dns_proxy_id = theforeman_obtain_resource_id(module, myurl, data, method,
-                                                  search_parameter,
-                                                  search_value)
-    else:
-        dns_proxy_id = None
-
-    if tftp_proxy:
-        search_value = tftp_proxy
-        tftp_proxy_id = theforeman_obtain_resource_id(module, myurl, data, method,
-                                                   search_parameter,
-                                                   search_value)
-    else:
-        tftp_proxy_id = None
+    dhcp_proxy_id = results.pop(0) if dhcp_proxy else None
+    dns_proxy_id = results.pop(0) if dns_proxy else None
+    tftp_proxy_id = results.pop(0) if tftp_proxy else None
 
     # Query Foreman API for current Domains
     myurl = url + "/api/subnets"
-    data = {
-        'subnet': {
-          "name": name,
-          "description": description,
-          "network_type": network_type,
-          "network": network,
-          "mask": mask,
-          "gateway": gateway,
-          "dns_primary": dns_primary,
-          "dns_secondary": dns_secondary,
-          "ipam": ipam,
-          "from": ip_from,
-          "to": ip_to,
-          "vlanid": vlanid,
-          "boot_mode": boot_mode,
-          "dhcp_id": dhcp_proxy_id,
-          "dns_id": dns_proxy_id,
-          "tftp_id": tftp_proxy_id,
-          "domains": set_domains,
-          "locations": set_locations,
-        }
-    }
+    data = theforeman_subnet_data(
+        name, description, network_type, network, mask, gateway,
+        dns_primary, dns_secondary, ipam, ip_from, ip_to, vlanid,
+        boot_mode, dhcp_proxy_id, dns_proxy_id, tftp_proxy_id, set_domains,
+        set_locations
+    )
     method = 'GET'
     search_parameter = 'name'
     search_value = name
 
-    # Obtain Foreman resource ID
-    resource_id = theforeman_obtain_resource_id(module, myurl, data, method,
-                                             search_parameter, search_value)
+    # Obtain Foreman resource
+    resource = theforeman_obtain_resource(module, myurl, data, method,
+                                          search_parameter, search_value)
 
     # Create subnet if it does not exist
-    if resource_id == 'None' or resource_id == '':
+    if not resource:
         if not module.check_mode:
             myurl = url + "/api/subnets"
             method = 'POST'
@@ -129,16 +104,16 @@ def create(
         else:
             return False, "Subnet %s will be created" % (name), True
     else:
-        # Obtain current Foreman resouce values
-        myurl = url + "/api/subnets/%s" % (resource_id)
-        (query_out, info) = theforeman_query(module, myurl, data, method)
+        # Obtain current Foreman resouce values, the collection record is
+        # reused unless association fields need checking
+        myurl = url + "/api/subnets/%s" % (resource['id'])
+        query_out = theforeman_current_values(module, myurl, data, resource)
 
         # Update domain if set/return values differ
         (diff_val, diff_data) = theforeman_compare_values(module, url, data,
                                                           query_out,
                                                           set_domains,
-                                                          set_locations,
-                                                          set_organizations)
+                                                          set_locations)
         if diff_val != 0:
             method = 'PUT'
             (query_out, info) = theforeman_query(module, myurl, diff_data, method)
@@ -153,34 +128,10 @@ def remove(module, name, description, locations, url):
 
 def main():
     module = AnsibleModule(
-        argument_spec=dict(
-            name=dict(type='str', required=True),
-            description=dict(type='str', default=''),
-            network_type=dict(type='str', required=True,
-                              choices=['IPv4', 'IPv6']),
-            network=dict(type='str', required=True),
-            mask=dict(type='str', required=True),
-            gateway=dict(type='str', required=False, default=''),
-            dns_primary=dict(type='str', required=False, default=''),
-            dns_secondary=dict(type='str', required=False, default=''),
-            ipam=dict(type='str', required=False,
-                      choices=['DHCP', 'Internal DB', 'None'],
-                      default='DHCP'),
-            ip_from=dict(type='str', required=False, default=''),
-            ip_to=dict(type='str', required=False, default=''),
-            vlanid=dict(type='str', required=False, default=''),
-            boot_mode=dict(type='str', required=False,
-                           choices=['DHCP', 'Static'], default='DHCP'),
-            dhcp_proxy=dict(type='str', required=False, default=None),
-            dns_proxy=dict(type='str', required=False, default=None),
-            tftp_proxy=dict(type='str', required=False, default=None),
-            domains=dict(type='list', required=False, default=[]),
-            locations=dict(type='list', required=False, default=[]),
-            organizations=dict(type='list', required=False, default=[]),
-            url=dict(required=False, default='https://127.0.01:443'),
-            url_username=dict(type='str', default='admin'),
-            url_password=dict(type='str', no_log=True, required=True),
-            state=dict(default='present', choices=['present', 'absent']),
+        argument_spec=theforeman_argument_spec(
+            lookup_workers=dict(type='int', required=False,
+                                default=THEFOREMAN_LOOKUP_WORKERS),
+            **THEFOREMAN_SUBNET_SPEC
         ),
         supports_check_mode=True
     )
@@ -206,7 +157,7 @@ def main():
     organizations = module.params['organizations']
     url = module.params['url']
     module.params['force_basic_auth'] = True
-    # url_username and url_password on auto passed into fetch_url
+    # url_username and url_password on auto passed into TheForemanClient
     module.params['url_username']
     module.params['url_password']
     state = module.params['state']
@@ -229,7 +180,8 @@ def main():
 
     if rc != 0:
         module.fail_json(msg="failed", result=query_out)
-    module.exit_json(msg="success", result=query_out, changed=changed)
+    module.exit_json(msg="success", result=query_out, changed=changed,
+                     **theforeman_api_stats(module))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,221 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# (c) 2017, Steven Bambling <smbambling@gmail.com>
+# GNU General Public License v3.0+
+# (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+
+ANSIBLE_METADATA = {'metadata_version': '1.1',
+                    'status': ['preview'],
+                    'supported_by': 'community'}
+
+DOCUMENTATION = '''
+---
+module: theforeman_subnets_bulk
+version_added: "2.4"
+author: Steven Bambling(@smbambling)
+
+Reconciles a list of subnets in a single task. Every item of subnets takes
+the same parameters as the theforeman_subnet module. Names of domains,
+locations, smart-proxies and subnets are resolved once for the whole list
+and only the subnets that differ are created or updated. Details of
+existing subnets are only fetched when their domains or locations need
+checking.
+'''
+
+EXAMPLES = '''
+- theforeman_subnets_bulk:
+    url: https://foreman.example.com
+    url_password: secret
+    subnets:
+      - name: dmz
+        network_type: IPv4
+        network: 10.0.0.0
+        mask: 255.255.255.0
+        domains:
+          - dmz.example.com
+      - name: backend
+        network_type: IPv4
+        network: 10.0.1.0
+        mask: 255.255.255.0
+'''
+
+RETURN = '''
+result:
+  description: Per subnet report with the name, changed and action
+    (created, updated or unchanged) of every item
+  returned: always
+  type: list
+'''
+
+try:
+    import json
+except ImportError:
+    import simplejson as json # NOQA
+
+# Ignore PEP8 QA here as it does not conform Ansible requirements
+from ansible.module_utils.basic import AnsibleModule # NOQA
+from ansible.module_utils.theforeman_utils import theforeman_query, \
+    theforeman_argument_spec, theforeman_api_stats, \
+    theforeman_resolve_resources, theforeman_resource_ids, \
+    theforeman_current_values, theforeman_compare_values, \
+    theforeman_subnet_params, theforeman_subnet_data, \
+    theforeman_verify_resources, theforeman_verify_references # NOQA
+
+
+# Resolve all names referenced by the subnets for one resource type to
+# their collection records
+def resolve_resources(module, url, resource, search_parameter, subnets,
+                      keys):
+    names = []
+    for subnet in subnets:
+        for key in keys:
+            values = subnet[key]
+            if not isinstance(values, list):
+                values = [values]
+            for i in values:
+                if i and i not in names:
+                    names.append(i)
+
+    if not names:
+        return {}
+
+    myurl = url + "/api/" + resource
+    data = {}
+    method = 'GET'
+
+    return theforeman_resolve_resources(module, myurl, data, method,
+                                        search_parameter, names)
+
+
+# Resolve all names referenced by the subnets for one resource type to IDs,
+# cached IDs are checked with one lookup
+def resolve_ids(module, url, resource, search_parameter, subnets, keys):
+    resources = resolve_resources(module, url, resource, search_parameter,
+                                  subnets, keys)
+
+    return theforeman_resource_ids(theforeman_verify_references(
+        module, url + "/api/" + resource, {}, 'GET', search_parameter,
+        resources
+    ))
+
+
+def create(module, subnets, url):
+
+    # Resolve every referenced resource with one lookup per resource type
+    domain_ids = resolve_ids(module, url, 'domains', 'name', subnets,
+                             ['domains'])
+    location_ids = resolve_ids(module, url, 'locations', 'name', subnets,
+                               ['locations'])
+    proxy_ids = resolve_ids(module, url, 'smart_proxies', 'name', subnets,
+                            ['dhcp_proxy', 'dns_proxy', 'tftp_proxy'])
+
+    # Obtain Foreman collection records of all subnets at once
+    resources = resolve_resources(module, url, 'subnets', 'name', subnets,
+                                  ['name'])
+    # Cached IDs of subnets removed or renamed since are looked up again
+    resources = theforeman_verify_resources(module, url + "/api/subnets", {},
+                                            'GET', 'name', resources)
+
+    results = []
+    changed = False
+    for subnet in subnets:
+        name = subnet['name']
+        set_domains = [{"id": domain_ids[i]} for i in subnet['domains']]
+        set_locations = [{"id": location_ids[i]}
+                         for i in subnet['locations']]
+
+        data = theforeman_subnet_data(
+            name, subnet['description'], subnet['network_type'],
+            subnet['network'], subnet['mask'], subnet['gateway'],
+            subnet['dns_primary'], subnet['dns_secondary'], subnet['ipam'],
+            subnet['ip_from'], subnet['ip_to'], subnet['vlanid'],
+            subnet['boot_mode'], proxy_ids.get(subnet['dhcp_proxy']),
+            proxy_ids.get(subnet['dns_proxy']),
+            proxy_ids.get(subnet['tftp_proxy']), set_domains, set_locations
+        )
+
+        resource = resources[name]
+
+        # Create subnet if it does not exist
+        if not resource:
+            if not module.check_mode:
+                myurl = url + "/api/subnets"
+                method = 'POST'
+                (query_out, info) = theforeman_query(module, myurl, data,
+                                                     method)
+            results.append(dict(name=name, changed=True, action='created'))
+            changed = True
+            continue
+
+        # Obtain current Foreman resouce values, the collection record is
+        # reused unless association fields need checking
+        myurl = url + "/api/subnets/%s" % (resource['id'])
+        query_out = theforeman_current_values(module, myurl, data, resource)
+
+        # Update subnet if set/return values differ
+        (diff_val, diff_data) = theforeman_compare_values(module, url, data,
+                                                          query_out,
+                                                          set_domains,
+                                                          set_locations)
+        if diff_val != 0:
+            if not module.check_mode:
+                method = 'PUT'
+                (query_out, info) = theforeman_query(module, myurl,
+                                                     diff_data, method)
+            results.append(dict(name=name, changed=True, action='updated'))
+            changed = True
+        else:
+            results.append(dict(name=name, changed=False,
+                                action='unchanged'))
+
+    return False, results, changed
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=theforeman_argument_spec(
+            subnets=dict(type='list', required=True),
+            state=dict(default='present', choices=['present']),
+        ),
+        supports_check_mode=True
+    )
+
+    subnets = []
+    names = set()
+    for i in module.params['subnets']:
+        if not isinstance(i, dict):
+            module.fail_json(msg="Every item of subnets must be a dict")
+        subnet = theforeman_subnet_params(module, i)
+        if subnet['name'] in names:
+            module.fail_json(
+                msg="Subnet %s is listed more than once" % (subnet['name'])
+            )
+        names.add(subnet['name'])
+        subnets.append(subnet)
+
+    url = module.params['url']
+    module.params['force_basic_auth'] = True
+    module.params['url_username']
+    module.params['url_password']
+
+    # url_username and url_password on auto passed into TheForemanClient
+    state = module.params['state']
+
+    if state == 'present':
+        (rc, query_out, changed) = create(
+            module, subnets, url
+        )
+
+    if rc != 0:
+        module.fail_json(msg="failed", result=query_out)
+    module.exit_json(msg="success", result=query_out, changed=changed,
+                     **theforeman_api_stats(module))
+
+
+if __name__ == '__main__':
+    main()
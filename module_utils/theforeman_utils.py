@@ -5,21 +5,1214 @@ try:
 except ImportError:
     import simplejson as json
 
-from ansible.module_utils.urls import fetch_url
+import base64
+import codecs
+import errno
+import fcntl
+import hashlib
+import marshal
+import os
+import random
+import re
+import socket
+import ssl
+import sys
+import tempfile
+import threading
+import time
+import zlib
 
+from email.utils import mktime_tz, parsedate_tz
 
-# Submit query to Foreman API
-def theforeman_query(module, url, data, method):
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
+try:
+    import ipaddress
+except ImportError:
+    ipaddress = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from ansible.module_utils._text import to_bytes, to_native, to_text
+from ansible.module_utils.six import string_types
+from ansible.module_utils.six.moves import http_client
+from ansible.module_utils.six.moves.urllib.parse import quote, urlparse
+from ansible.module_utils.six.moves.urllib.request import getproxies, \
+    proxy_bypass
+
+# Number of values OR-ed together in a single scoped search query
+THEFOREMAN_SEARCH_BATCH = 50
+
+# Default number of records fetched per page of a collection
+THEFOREMAN_PER_PAGE = 250
+
+# Default number of seconds resource IDs are kept in the on-disk cache
+THEFOREMAN_CACHE_TTL = 300
+
+# Number of seconds stored GET responses are kept after they were last used
+THEFOREMAN_BODY_CACHE_TTL = 86400
+
+# Default number of lookups run concurrently by theforeman_run_concurrently
+THEFOREMAN_LOOKUP_WORKERS = 4
+
+# Size of the chunks responses are read and decompressed in
+THEFOREMAN_CHUNK_SIZE = 65536
+
+# Default number of times an idempotent request is retried and the base
+# delay in seconds of the exponential backoff between attempts
+THEFOREMAN_MAX_RETRIES = 3
+THEFOREMAN_RETRY_BACKOFF = 1.0
+# Longest delay in seconds between two attempts, even if Foreman asks for
+# a longer one
+THEFOREMAN_RETRY_MAX_DELAY = 60
+
+# Methods that can be sent again without changing the outcome, and the
+# statuses of responses worth retrying them for
+THEFOREMAN_IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE'])
+THEFOREMAN_RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+# Lowest rate the adaptive rate limit backs off to, as a fraction of the
+# configured rate
+THEFOREMAN_RATE_LIMIT_FLOOR = 0.05
+
+# Name of the codec used for JSON request and response bodies, orjson is
+# several times faster than the json module when it is installed
+THEFOREMAN_JSON_BACKEND = 'orjson' if orjson else json.__name__
+
+
+# Encode a request body as JSON
+def theforeman_json_encode(data):
+    if orjson:
+        try:
+            return orjson.dumps(data)
+        except TypeError:
+            # e.g. keys other than strings or integers not fitting in 64
+            # bits, which the json module can encode
+            pass
+
+    return to_bytes(json.dumps(data))
+
+
+# Decode a JSON response body, raises ValueError for invalid JSON
+def theforeman_json_decode(content):
+    if orjson:
+        return orjson.loads(content)
+
+    return json.loads(to_text(content))
+
+
+# Raised when a non-strict collection query is rejected by Foreman
+class TheForemanRequestError(Exception):
+    def __init__(self, info):
+        Exception.__init__(self, info.get('msg', ''))
+        self.info = info
+
+
+# Raised instead of failing the module from a concurrently run lookup
+class TheForemanDeferredFailure(Exception):
+    def __init__(self, kwargs):
+        Exception.__init__(self, kwargs.get('msg', ''))
+        self.kwargs = kwargs
+
+
+# Module wrapper handed to concurrently run lookups, failures are raised so
+# the calling thread can report them in a deterministic order
+class TheForemanDeferredModule(object):
+    def __init__(self, module):
+        self.module = module
+
+    def __getattr__(self, name):
+        return getattr(self.module, name)
+
+    def fail_json(self, **kwargs):
+        raise TheForemanDeferredFailure(kwargs)
+
+
+# Argument spec shared by all Foreman modules
+def theforeman_argument_spec(**kwargs):
+    argument_spec = dict(
+        url=dict(required=False, default='https://127.0.01:443'),
+        url_username=dict(type='str', default='admin'),
+        url_password=dict(type='str', no_log=True, required=False),
+        api_token=dict(type='str', no_log=True, required=False),
+        session_cache=dict(type='bool', required=False, default=False),
+        state=dict(default='present', choices=['present', 'absent']),
+        per_page=dict(type='int', required=False,
+                      default=THEFOREMAN_PER_PAGE),
+        cache_dir=dict(type='path', required=False, default=None),
+        cache_ttl=dict(type='int', required=False,
+                       default=THEFOREMAN_CACHE_TTL),
+        api_stats=dict(type='bool', required=False, default=False),
+        trace_file=dict(type='path', required=False, default=None),
+        rate_limit=dict(type='float', required=False, default=None),
+        rate_limit_burst=dict(type='int', required=False, default=None),
+        rate_limit_latency=dict(type='float', required=False, default=None),
+        max_retries=dict(type='int', required=False,
+                         default=THEFOREMAN_MAX_RETRIES),
+        retry_backoff=dict(type='float', required=False,
+                           default=THEFOREMAN_RETRY_BACKOFF),
+    )
+    argument_spec.update(kwargs)
+
+    return argument_spec
+
+
+# HTTPS connection resuming the TLS session of previous connections
+class TheForemanHTTPSConnection(http_client.HTTPSConnection):
+    def __init__(self, host, port, client, timeout):
+        http_client.HTTPSConnection.__init__(self, host, port,
+                                             timeout=timeout,
+                                             context=client.ssl_context)
+        self.client = client
+
+    def connect(self):
+        sock = socket.create_connection((self.host, self.port),
+                                        self.timeout)
+        server_hostname = self.host
+        if self._tunnel_host:
+            self.sock = sock
+            self._tunnel()
+            server_hostname = self._tunnel_host
+
+        kwargs = {'server_hostname': server_hostname}
+        if self.client.tls_session is not None:
+            kwargs['session'] = self.client.tls_session
+
+        try:
+            self.sock = self.client.ssl_context.wrap_socket(sock, **kwargs)
+        except TypeError:
+            # Python versions without TLS session support
+            kwargs.pop('session', None)
+            self.sock = self.client.ssl_context.wrap_socket(sock, **kwargs)
+
+        self.client.tls_session = getattr(self.sock, 'session', None)
+
+
+# Token bucket limiting the rate of requests to a Foreman server, shared
+# by every module process on the host through a locked state file. Tokens
+# are reserved ahead, so waiting processes are served in order instead of
+# racing for the next token. With a latency target the rate adapts: it is
+# halved when Foreman answers slowly and grows back to the configured rate
+# while it answers quickly. 429/503 responses always halve it. The rate is
+# halved at most once per second, as the responses to requests sent at the
+# same time report the same overload.
+class TheForemanRateLimiter(object):
+    def __init__(self, path, rate, burst=None, latency=None):
+        self.path = path
+        self.max_rate = float(rate)
+        self.burst = burst or max(1, int(rate))
+        self.latency = latency
+
+    # Update the bucket under its lock, func gets the refilled tokens and
+    # the current rate and returns them updated with a result
+    def _update(self, func):
+        result = []
+
+        def update(contents):
+            now = time.time()
+            rate = min(contents.get('rate') or self.max_rate, self.max_rate)
+            tokens = contents.get('tokens', self.burst)
+            elapsed = max(0, now - contents.get('time', now))
+            tokens = min(self.burst, tokens + elapsed * rate)
+
+            (tokens, new_rate, value) = func(tokens, rate)
+            result.append(value)
+
+            throttled = contents.get('throttled', 0)
+            if new_rate < rate:
+                if now - throttled < 1:
+                    new_rate = rate
+                else:
+                    throttled = now
+            return {'tokens': tokens, 'rate': new_rate, 'time': now,
+                    'throttled': throttled}
+
+        theforeman_cache_update(self.path, update)
+        return result[0]
+
+    # Wait until the next request may be sent
+    def acquire(self):
+        def reserve(tokens, rate):
+            tokens = tokens - 1
+            return tokens, rate, -tokens / rate if tokens < 0 else 0
+
+        wait = self._update(reserve)
+        if wait > 0:
+            time.sleep(wait)
+
+    # Adapt the rate to a response, status is -1 if the request failed
+    def feedback(self, status, latency):
+        throttled = status in (429, 503) or \
+            bool(self.latency and latency > self.latency)
+        if not throttled and not self.latency:
+            return
+
+        def adapt(tokens, rate):
+            if throttled:
+                rate = max(self.max_rate * THEFOREMAN_RATE_LIMIT_FLOOR,
+                           rate / 2)
+            elif 0 < status < 500:
+                rate = min(self.max_rate, rate + self.max_rate / 10)
+            return tokens, rate, None
+
+        self._update(adapt)
+
+
+# Obtain path of the state file of the rate limit for the Foreman server of
+# the given URL. It is kept in a directory only the user can access, in the
+# cache directory if one is set and in a per-user temporary directory
+# otherwise, so other users cannot replace it or redirect it with symlinks.
+def theforeman_rate_limit_path(module, url):
+    cache_dir = module.params.get('cache_dir')
+    if cache_dir:
+        directory = os.path.join(cache_dir, 'ratelimit')
+    else:
+        directory = os.path.join(tempfile.gettempdir(),
+                                 'theforeman-%s' % os.getuid())
+
+    try:
+        try:
+            os.makedirs(directory, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        stat = os.lstat(directory)
+    except OSError as e:
+        module.fail_json(msg='Cannot create rate limit directory %s: %s' % (
+            directory, to_native(e)))
+
+    if not os.path.isdir(directory) or os.path.islink(directory) or \
+            stat.st_uid != os.getuid() or stat.st_mode & 0o077:
+        module.fail_json(msg='Rate limit directory %s must be a directory '
+                         'owned and only accessible by the user' % directory)
+
+    return os.path.join(directory, '%s.ratelimit' % theforeman_server_id(url))
+
+
+# Parse a Set-Cookie header, returns the name and value of the cookie and
+# whether it was expired (removed) by the server
+def theforeman_parse_cookie(header):
+    parts = [i.strip() for i in header.split(';')]
+    (name, value) = (parts[0].split('=', 1) + [''])[:2]
+
+    expired = value == ''
+    for i in parts[1:]:
+        (key, attr) = (i.split('=', 1) + [''])[:2]
+        if key.lower() == 'max-age' and attr.strip() in ('0', '-1'):
+            expired = True
+        elif key.lower() == 'expires':
+            date = parsedate_tz(attr)
+            if date and mktime_tz(date) < time.time():
+                expired = True
+
+    return name.strip(), value.strip(), expired
+
+
+# Obtain path of the file caching the session cookies of a user between
+# module runs, returns None without a cache directory. The name must not
+# depend on the password, a session Foreman rejects is opened again.
+def theforeman_session_path(module, url, username):
+    cache_dir = module.params.get('cache_dir')
+    if not cache_dir:
+        return None
+
+    return os.path.join(cache_dir, 'sessions', hashlib.sha256(to_bytes(
+        '%s %s' % (theforeman_server_id(url), username)
+    )).hexdigest())
+
+
+# Load cached session cookies, files that other users could read or modify
+# are ignored
+def theforeman_session_load(path):
+    if not path:
+        return {}
+
+    try:
+        with open(path) as f:
+            stat = os.fstat(f.fileno())
+            if stat.st_uid != os.getuid() or stat.st_mode & 0o077:
+                return {}
+            cookies = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+    if not isinstance(cookies, dict):
+        return {}
+
+    return cookies
+
+
+# Save session cookies, readable by the owner only
+def theforeman_session_save(path, cookies):
+    try:
+        try:
+            os.makedirs(os.path.dirname(path), 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        tmp_path = '%s.%s.%s.tmp' % (path, os.getpid(),
+                                     threading.current_thread().ident)
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(cookies, f)
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        # The session cache is an optimization only
+        pass
+
+
+# Number of seconds to wait before retrying a request, Retry-After of the
+# response is honoured, otherwise the delay is exponential with full jitter
+def theforeman_retry_delay(attempt, info, backoff):
+    retry_after = info.get('retry-after')
+    if retry_after:
+        try:
+            delay = int(retry_after)
+        except ValueError:
+            date = parsedate_tz(retry_after)
+            delay = mktime_tz(date) - time.time() if date else None
+        if delay is not None:
+            return min(max(delay, 0), THEFOREMAN_RETRY_MAX_DELAY)
+
+    return random.uniform(0, min(backoff * 2 ** attempt,
+                                 THEFOREMAN_RETRY_MAX_DELAY))
+
+
+# Keep-alive HTTP client shared by all requests to a Foreman server during
+# a module run, idle connections are pooled and reused between requests
+class TheForemanClient(object):
+    def __init__(self, module, url):
+        parsed = urlparse(url)
+
+        self.module = module
+        self.scheme = parsed.scheme
+        self.host = parsed.hostname
+        self.port = parsed.port or (443 if self.scheme == 'https' else 80)
+        self.timeout = module.params.get('timeout') or 10
+        self.tls_session = None
+        self.pool = []
+        self.lock = threading.Lock()
+
+        params = module.params
+        self.max_retries = params.get('max_retries')
+        if self.max_retries is None:
+            self.max_retries = THEFOREMAN_MAX_RETRIES
+        self.retry_backoff = params.get('retry_backoff')
+        if self.retry_backoff is None:
+            self.retry_backoff = THEFOREMAN_RETRY_BACKOFF
+
+        self.limiter = None
+        if params.get('rate_limit'):
+            self.limiter = TheForemanRateLimiter(
+                theforeman_rate_limit_path(module, url),
+                params['rate_limit'], params.get('rate_limit_burst'),
+                params.get('rate_limit_latency')
+            )
+
+        self.ssl_context = None
+        if self.scheme == 'https':
+            self.ssl_context = ssl.create_default_context()
+            if not module.params.get('validate_certs', True):
+                self.ssl_context.check_hostname = False
+                self.ssl_context.verify_mode = ssl.CERT_NONE
+
+        self.proxy = None
+        proxy = getproxies().get(self.scheme)
+        if proxy and not proxy_bypass(self.host):
+            self.proxy = urlparse(proxy)
+
+        # Collections are highly compressible JSON
+        self.headers = {'Accept-Encoding': 'gzip, deflate'}
+
+        # A Personal Access Token is sent in place of the password
+        self.authorization = None
+        username = params.get('url_username')
+        password = params.get('api_token') or params.get('url_password')
+        if username and not password:
+            module.fail_json(msg="One of url_password or api_token is "
+                                 "required")
+        if username:
+            credentials = '%s:%s' % (username, password)
+            self.authorization = 'Basic %s' % (
+                to_native(base64.b64encode(to_bytes(credentials)))
+            )
+
+        # Cookies of the session Foreman opens once it verified the
+        # credentials, they are sent instead of the credentials as long as
+        # Foreman accepts them
+        self.cookies = {}
+        self.session_path = None
+        if self.authorization and params.get('session_cache'):
+            self.session_path = theforeman_session_path(module, url,
+                                                        username)
+            self.cookies = theforeman_session_load(self.session_path)
+
+    # Create a new connection to the server (or through the proxy)
+    def _connect(self):
+        if self.proxy:
+            host = self.proxy.hostname
+            port = self.proxy.port or 8080
+        else:
+            host = self.host
+            port = self.port
+
+        if self.scheme == 'https':
+            conn = TheForemanHTTPSConnection(host, port, self, self.timeout)
+            if self.proxy:
+                conn.set_tunnel(self.host, self.port)
+        else:
+            conn = http_client.HTTPConnection(host, port,
+                                              timeout=self.timeout)
+
+        return conn
+
+    def _acquire(self, reuse=True):
+        with self.lock:
+            if self.pool and reuse:
+                return self.pool.pop(), True
+
+        return self._connect(), False
+
+    def _release(self, conn):
+        with self.lock:
+            self.pool.append(conn)
+
+    def close(self):
+        with self.lock:
+            while self.pool:
+                self.pool.pop().close()
+
+    # Read the response body in chunks, decompressing it on the fly when
+    # the server compressed it. The number of bytes read from the wire is
+    # added to wire_bytes.
+    def iter_content(self, response, wire_bytes):
+        encoding = (response.getheader('Content-Encoding') or '').lower()
+        decompressor = None
+        if encoding in ('gzip', 'x-gzip'):
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS)
+
+        first = True
+        while True:
+            chunk = response.read(THEFOREMAN_CHUNK_SIZE)
+            if not chunk:
+                break
+            wire_bytes[0] = wire_bytes[0] + len(chunk)
+
+            if decompressor is None:
+                yield chunk
+                continue
+
+            try:
+                data = decompressor.decompress(chunk)
+            except zlib.error:
+                # Some servers send raw deflate data without zlib header
+                if not first or encoding != 'deflate':
+                    raise
+                decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                data = decompressor.decompress(chunk)
+            first = False
+            if data:
+                yield data
+
+        if decompressor is not None:
+            data = decompressor.flush()
+            if data:
+                yield data
+
+    # Send a request and wait for the response headers, returns the
+    # connection and response (None if the request failed) and a fetch_url
+    # style info dict
+    def _send(self, method, url, body=None, headers=None):
+        parsed = urlparse(url)
+        path = parsed.path or '/'
+        if parsed.query:
+            path = path + '?' + parsed.query
+
+        # Plain HTTP proxies expect the absolute URL in the request line
+        if self.proxy and self.scheme == 'http':
+            path = url
+
+        request_headers = dict(self.headers)
+        request_headers.update(headers or {})
+
+        # The server may close an idle keep-alive connection after it read a
+        # request, so only idempotent requests are sent on reused connections
+        # and sent again if that fails
+        idempotent = method in THEFOREMAN_IDEMPOTENT_METHODS
+
+        info = {'url': url, 'status': -1, 'msg': '', 'body': ''}
+        for attempt in range(2):
+            conn, reused = self._acquire(idempotent)
+            try:
+                conn.request(method, path, body, request_headers)
+                response = conn.getresponse()
+            except (http_client.HTTPException, socket.error) as e:
+                conn.close()
+                if reused and attempt == 0:
+                    continue
+                info['msg'] = 'Request failed: %s' % (to_native(e))
+                return None, None, info
+            break
+
+        cookies = {}
+        for key, val in response.getheaders():
+            info[key.lower()] = val
+            if key.lower() == 'set-cookie':
+                (name, value, expired) = theforeman_parse_cookie(val)
+                cookies[name] = None if expired else value
+        info['cookies'] = cookies
+        info['status'] = response.status
+        info['msg'] = 'OK'
+        if response.status >= 400:
+            info['msg'] = 'HTTP Error %s: %s' % (response.status,
+                                                 response.reason)
+
+        return conn, response, info
+
+    # Read the body of a response and hand the connection back to the pool
+    # once it is fully read. A partially read body is drained when little
+    # of it is left, otherwise the connection is dropped.
+    def _read(self, conn, response, info):
+        wire_bytes = [0]
+        done = False
+        try:
+            for chunk in self.iter_content(response, wire_bytes):
+                yield chunk
+            done = True
+        finally:
+            info['wire_bytes'] = wire_bytes[0]
+            if not done and response.length is not None and \
+                    response.length <= THEFOREMAN_CHUNK_SIZE:
+                try:
+                    response.read()
+                    done = True
+                except (http_client.HTTPException, socket.error):
+                    pass
+            if done and not response.will_close:
+                self._release(conn)
+            else:
+                conn.close()
+
+    # Store the cookies set by a response, None values remove a cookie.
+    # With expected, cookies are only removed if they were not replaced in
+    # the meantime. Changed cookies are saved when sessions are cached.
+    def _update_cookies(self, cookies, expected=None):
+        if not cookies:
+            return
+
+        with self.lock:
+            before = dict(self.cookies)
+            for name, value in cookies.items():
+                if value is not None:
+                    self.cookies[name] = value
+                elif expected is None or \
+                        self.cookies.get(name) == expected.get(name):
+                    self.cookies.pop(name, None)
+            changed = self.cookies != before
+            after = dict(self.cookies)
+
+        if changed and self.session_path:
+            theforeman_session_save(self.session_path, after)
+
+    # Send a request and return an iterator over the (decompressed) chunks
+    # of the response body, or None if the request failed, with a fetch_url
+    # style info dict. Reading the body may raise zlib.error,
+    # http_client.HTTPException or socket.error. Idempotent requests are
+    # retried on connection errors and 429/5xx responses, the number of
+    # retries is returned as retries in info. The credentials are only sent
+    # while there is no session, or once more when Foreman rejects it.
+    def stream(self, method, url, body=None, headers=None):
+        attempt = 0
+        authenticated = False
+        while True:
+            if self.limiter:
+                self.limiter.acquire()
+
+            with self.lock:
+                cookies = dict(self.cookies)
+            request_headers = dict(headers or {})
+            if cookies:
+                request_headers['Cookie'] = '; '.join(
+                    ['%s=%s' % i for i in sorted(cookies.items())]
+                )
+            elif self.authorization:
+                request_headers['Authorization'] = self.authorization
+
+            start = time.time()
+            (conn, response, info) = self._send(method, url, body,
+                                                request_headers)
+            if self.limiter:
+                self.limiter.feedback(info['status'], time.time() - start)
+
+            if response is not None:
+                self._update_cookies(info['cookies'])
+
+            # The session expired or was revoked, authenticate again
+            if cookies and info['status'] == 401 and self.authorization \
+                    and not authenticated:
+                self.read(self._read(conn, response, info), info)
+                self._update_cookies(dict.fromkeys(cookies), cookies)
+                authenticated = True
+                continue
+
+            if method not in THEFOREMAN_IDEMPOTENT_METHODS or \
+                    attempt >= self.max_retries or \
+                    (response is not None and
+                     info['status'] not in THEFOREMAN_RETRY_STATUSES):
+                break
+
+            # Read the error body so the connection can be reused
+            if response is not None:
+                self.read(self._read(conn, response, info), info)
+            time.sleep(theforeman_retry_delay(attempt, info,
+                                              self.retry_backoff))
+            attempt = attempt + 1
+
+        info['retries'] = attempt
+        if response is None:
+            return None, info
+
+        return self._read(conn, response, info), info
+
+    # Send a request and return the response body with a fetch_url style
+    # info dict
+    def request(self, method, url, body=None, headers=None):
+        (chunks, info) = self.stream(method, url, body, headers)
+        if chunks is None:
+            return None, info
+
+        return self.read(chunks, info)
+
+    # Read the rest of a streamed response body
+    def read(self, chunks, info):
+        try:
+            content = b''.join(chunks)
+        except zlib.error as e:
+            info['status'] = -1
+            info['msg'] = 'Invalid compressed response: %s' % (to_native(e))
+            return None, info
+        except (http_client.HTTPException, socket.error) as e:
+            info['status'] = -1
+            info['msg'] = 'Request failed: %s' % (to_native(e))
+            return None, info
+
+        if info['status'] >= 400:
+            info['body'] = content
+        else:
+            info['msg'] = 'OK (%s bytes)' % (len(content))
+
+        return content, info
+
+
+# Clients by Foreman server, reused for every request of the module run
+THEFOREMAN_CLIENTS = {}
+THEFOREMAN_CLIENTS_LOCK = threading.Lock()
+
+
+# Obtain the shared client for the Foreman server of the given URL
+def theforeman_client(module, url):
+    parsed = urlparse(url)
+    key = (parsed.scheme, parsed.netloc)
+
+    with THEFOREMAN_CLIENTS_LOCK:
+        if key not in THEFOREMAN_CLIENTS:
+            THEFOREMAN_CLIENTS[key] = TheForemanClient(module, url)
+
+        return THEFOREMAN_CLIENTS[key]
+
+
+# Split the path of an API URL after the API prefix, e.g. ['subnets', '1']
+def theforeman_api_path(url):
+    parts = [i for i in urlparse(url).path.split('/') if i]
+
+    if 'api' in parts:
+        parts = parts[parts.index('api') + 1:]
+        # Skip the API version if it is part of the URL
+        if parts and parts[0] in ('v1', 'v2'):
+            parts = parts[1:]
+
+    return parts
+
+
+# Obtain the resource type (e.g. 'subnets') an API URL refers to
+def theforeman_resource_type(url):
+    parts = theforeman_api_path(url)
+
+    if not parts:
+        return ''
+
+    return parts[0].strip()
+
+
+# Obtain a file name safe identifier of the Foreman server of the given URL
+def theforeman_server_id(url):
+    parsed = urlparse(url)
+
+    return hashlib.sha1(
+        to_bytes('%s://%s' % (parsed.scheme, parsed.netloc))
+    ).hexdigest()
+
+
+# Obtain path of the on-disk resource ID cache for the resource type of the
+# given URL, returns None when caching is disabled
+def theforeman_cache_path(module, url):
+    cache_dir = module.params.get('cache_dir')
+    if not cache_dir:
+        return None
+
+    return os.path.join(cache_dir, '%s-%s.json' % (
+        theforeman_server_id(url), theforeman_resource_type(url)
+    ))
+
+
+# Run func on the contents of a cache file while holding its lock, the
+# file is rewritten if func returns new contents
+def theforeman_cache_update(path, func):
+    try:
+        os.makedirs(os.path.dirname(path), 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            try:
+                with open(path) as f:
+                    contents = json.load(f)
+            except (IOError, ValueError):
+                contents = {}
+
+            new_contents = func(contents)
+            if new_contents is not None:
+                tmp_path = '%s.%s.tmp' % (path, os.getpid())
+                with open(tmp_path, 'w') as f:
+                    json.dump(new_contents, f)
+                os.rename(tmp_path, path)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+    return contents
+
+
+# Obtain cached resource IDs for the given values, only values with a
+# cached ID that has not expired are returned
+def theforeman_cache_get(module, url, search_parameter, search_values):
+    path = theforeman_cache_path(module, url)
+    if not path or not os.path.exists(path):
+        return {}
+
+    contents = theforeman_cache_update(path, lambda contents: None)
+
+    ttl = module.params.get('cache_ttl') or THEFOREMAN_CACHE_TTL
+    now = time.time()
+    resource_ids = {}
+    for value in search_values:
+        entry = contents.get('%s=%s' % (search_parameter, value))
+        if entry and now - entry[1] < ttl:
+            resource_ids[value] = entry[0]
+
+    return resource_ids
+
+
+# Store resolved resource IDs in the cache, dropping expired entries
+def theforeman_cache_set(module, url, search_parameter, resource_ids):
+    path = theforeman_cache_path(module, url)
+    if not path:
+        return
+
+    ttl = module.params.get('cache_ttl') or THEFOREMAN_CACHE_TTL
+    now = time.time()
+
+    def update(contents):
+        contents = dict(
+            (k, v) for k, v in contents.items() if now - v[1] < ttl
+        )
+        for value, resource_id in resource_ids.items():
+            if resource_id != '':
+                key = '%s=%s' % (search_parameter, value)
+                contents[key] = [resource_id, now]
+        return contents
+
+    theforeman_cache_update(path, update)
+
+
+# Drop every cached ID of the resource type of the given URL
+def theforeman_cache_invalidate(module, url):
+    path = theforeman_cache_path(module, url)
+    if not path or not os.path.exists(path):
+        return
+
+    theforeman_cache_update(path, lambda contents: {})
+
+
+# Drop the cached IDs pointing at the given resource IDs of the resource
+# type of the given URL
+def theforeman_cache_forget(module, url, resource_ids):
+    path = theforeman_cache_path(module, url)
+    if not path or not os.path.exists(path) or not resource_ids:
+        return
+
+    def update(contents):
+        return dict(
+            (k, v) for k, v in contents.items() if v[0] not in resource_ids
+        )
+
+    theforeman_cache_update(path, update)
+
+
+# Requests sent to Foreman during the module run, see theforeman_api_stats
+THEFOREMAN_API_CALLS = []
+# URLs of GET requests answered from memoized responses
+THEFOREMAN_API_MEMO_HITS = []
+THEFOREMAN_API_CALLS_LOCK = threading.Lock()
+
+
+# Record timing and size of a request and append it to the trace file
+def theforeman_record_call(module, method, url, info, latency, size,
+                           decode_time):
+    path = urlparse(url).path
+    call = {
+        'method': method,
+        'path': path,
+        'endpoint': '%s %s' % (method, re.sub(r'/\d+(?=/|$)', '/:id', path)),
+        'status': info['status'],
+        'latency': latency,
+        'bytes': size,
+        'wire_bytes': info.get('wire_bytes', size),
+        'decode_time': decode_time,
+        'retries': info.get('retries', 0),
+    }
+
+    with THEFOREMAN_API_CALLS_LOCK:
+        THEFOREMAN_API_CALLS.append(call)
+
+        trace_file = module.params.get('trace_file')
+        if trace_file:
+            trace = dict(call)
+            trace['time'] = time.time()
+            trace['pid'] = os.getpid()
+            # Single appends of a line are atomic between task processes
+            with open(trace_file, 'a') as f:
+                f.write(json.dumps(trace) + '\n')
+
+
+# Summarize the requests sent to Foreman, returned as api_stats by the
+# modules when the api_stats option is set
+def theforeman_api_stats(module):
+    if not module.params.get('api_stats'):
+        return {}
+
+    with THEFOREMAN_API_CALLS_LOCK:
+        calls = list(THEFOREMAN_API_CALLS)
+        memo_hits = len(THEFOREMAN_API_MEMO_HITS)
+
+    latencies = sorted([i['latency'] for i in calls])
+    p95 = 0
+    if latencies:
+        p95 = latencies[max(0, -(-len(latencies) * 95 // 100) - 1)]
+
+    endpoints = {}
+    for i in calls:
+        endpoint = endpoints.setdefault(i['endpoint'], {
+            'count': 0, 'latency': 0, 'bytes': 0,
+        })
+        endpoint['count'] = endpoint['count'] + 1
+        endpoint['latency'] = endpoint['latency'] + i['latency']
+        endpoint['bytes'] = endpoint['bytes'] + i['bytes']
+
+    return {'api_stats': {
+        'requests': len(calls),
+        'memo_hits': memo_hits,
+        'latency_total': sum(latencies),
+        'latency_p95': p95,
+        'bytes': sum([i['bytes'] for i in calls]),
+        'wire_bytes': sum([i['wire_bytes'] for i in calls]),
+        'decode_time': sum([i['decode_time'] for i in calls]),
+        'retries': sum([i['retries'] for i in calls]),
+        'endpoints': endpoints,
+    }}
+
+
+# Obtain path of the on-disk copy of a GET response, returns None when
+# caching is disabled. Only collection and search pages are stored, detail
+# records would leave a file per resource behind.
+def theforeman_body_cache_path(module, url):
+    cache_dir = module.params.get('cache_dir')
+    if not cache_dir:
+        return None
+
+    if len(theforeman_api_path(url)) != 1:
+        return None
+
+    # Responses depend on the permissions of the user, and marshal data on
+    # the Python version
+    key = hashlib.sha1(to_bytes('%s %s %s' % (
+        module.params.get('url_username'), sys.version_info[:2], url
+    ))).hexdigest()
+
+    return os.path.join(cache_dir, 'responses', key)
+
+
+# Load the stored validators and decoded body of a GET response
+def theforeman_body_cache_get(module, url):
+    path = theforeman_body_cache_path(module, url)
+    if not path:
+        return None
+
+    try:
+        with open(path, 'rb') as f:
+            stored = marshal.load(f)
+        # Keep the copy from being pruned while it is used
+        os.utime(path, None)
+        return stored
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        return None
+
+
+# Whether stored GET responses were pruned during the module run
+THEFOREMAN_BODY_CACHE_PRUNED = []
+
+
+# Remove the stored GET responses that haven't been used for
+# THEFOREMAN_BODY_CACHE_TTL seconds, once per module run
+def theforeman_body_cache_prune(directory):
+    if THEFOREMAN_BODY_CACHE_PRUNED:
+        return
+    THEFOREMAN_BODY_CACHE_PRUNED.append(True)
+
+    expired = time.time() - THEFOREMAN_BODY_CACHE_TTL
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            if os.path.getmtime(path) < expired:
+                os.remove(path)
+        except OSError:
+            # Removed or being replaced by another process
+            pass
+
+
+# Store the decoded body of a GET response with its validators, marshal is
+# used so the body does not need to be parsed again when it is reused
+def theforeman_body_cache_set(module, url, info, json_out):
+    path = theforeman_body_cache_path(module, url)
+    if not path or not (info.get('etag') or info.get('last-modified')):
+        return
+
+    entry = {
+        'etag': info.get('etag'),
+        'last_modified': info.get('last-modified'),
+        'body': json_out,
+    }
+
+    try:
+        try:
+            os.makedirs(os.path.dirname(path), 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        tmp_path = '%s.%s.%s.tmp' % (path, os.getpid(),
+                                     threading.current_thread().ident)
+        with open(tmp_path, 'wb') as f:
+            marshal.dump(entry, f)
+        os.rename(tmp_path, path)
+
+        theforeman_body_cache_prune(os.path.dirname(path))
+    except (IOError, OSError, ValueError):
+        # The cache is an optimization only
+        pass
+
+
+# Build the headers turning a GET request into a conditional one for the
+# stored copy of its response
+def theforeman_conditional_headers(stored):
+    headers = {}
+    if stored and stored.get('etag'):
+        headers['If-None-Match'] = stored['etag']
+    if stored and stored.get('last_modified'):
+        headers['If-Modified-Since'] = stored['last_modified']
+
+    return headers
+
+
+# Send a request to Foreman and decode the response. GET requests are sent
+# as conditional requests when a validated copy of the response is stored,
+# a 304 response is then answered from the stored copy.
+def theforeman_send(module, url, data, method):
     headers = {
         'Content-Type': 'application/json',
         'Accept': 'application/json',
     }
 
-    url = url + '?per_page=9999999999'
+    # Foreman ignores request bodies of reads
+    body = None
+    stored = None
+    if method != 'GET':
+        body = theforeman_json_encode(data)
+    else:
+        stored = theforeman_body_cache_get(module, url)
+        headers.update(theforeman_conditional_headers(stored))
 
-    response, info = fetch_url(
-        module, url, method=method, headers=headers, data=json.dumps(data)
-    )
+    client = theforeman_client(module, url)
+    start = time.time()
+    (content, info) = client.request(method, url, body, headers)
+    latency = time.time() - start
+
+    if stored and info['status'] == 304:
+        theforeman_record_call(module, method, url, info, latency, 0, 0)
+        info['status'] = 200
+        info['msg'] = 'OK (not modified)'
+        info['not_modified'] = True
+        return stored['body'], info
+
+    start = time.time()
+    try:
+        json_out = theforeman_json_decode(content)
+    except:
+        json_out = ''
+    decode_time = time.time() - start
+
+    theforeman_record_call(module, method, url, info, latency,
+                           len(content or ''), decode_time)
+
+    if method == 'GET' and info['status'] == 200:
+        theforeman_body_cache_set(module, url, info, json_out)
+
+    return json_out, info
+
+
+# Responses of GET requests by URL, reused for the rest of the module run
+# until the resource type is written to. Callers must not modify them.
+THEFOREMAN_MEMO = {}
+# Events of GET requests in flight by URL, set once the response is known
+THEFOREMAN_MEMO_INFLIGHT = {}
+# Number of writes by resource type, guards against memoizing responses
+# that were read while the resource type was written to
+THEFOREMAN_MEMO_WRITES = {}
+THEFOREMAN_MEMO_LOCK = threading.Lock()
+# Record stores of collections read in full by lookups scanning them, by
+# collection URL along with the fields they were read with
+THEFOREMAN_STORES = {}
+# URLs of collections a lookup has scanned to the end without keeping them
+THEFOREMAN_SCANNED = set()
+
+
+# Forget memoized responses of the resource type of the given URL
+def theforeman_memo_invalidate(url):
+    resource_type = theforeman_resource_type(url)
+
+    with THEFOREMAN_MEMO_LOCK:
+        THEFOREMAN_MEMO_WRITES[resource_type] = \
+            THEFOREMAN_MEMO_WRITES.get(resource_type, 0) + 1
+        for key in list(THEFOREMAN_MEMO.keys()):
+            if theforeman_resource_type(key) == resource_type:
+                del THEFOREMAN_MEMO[key]
+        for key in list(THEFOREMAN_STORES.keys()):
+            if theforeman_resource_type(key) == resource_type:
+                del THEFOREMAN_STORES[key]
+        for key in list(THEFOREMAN_SCANNED):
+            if theforeman_resource_type(key) == resource_type:
+                THEFOREMAN_SCANNED.discard(key)
+
+
+# Look up the memoized response of a GET request, waiting for an identical
+# request in flight. Returns (response, event, writes): response is the
+# memoized (json_out, info) if there is one. Otherwise the caller sends the
+# request itself, and when event is not None it has to pass its response
+# with writes to theforeman_memo_set and call theforeman_memo_done after.
+def theforeman_memo_claim(url):
+    resource_type = theforeman_resource_type(url)
+
+    with THEFOREMAN_MEMO_LOCK:
+        if url in THEFOREMAN_MEMO:
+            THEFOREMAN_API_MEMO_HITS.append(url)
+            return THEFOREMAN_MEMO[url], None, None
+
+        event = THEFOREMAN_MEMO_INFLIGHT.get(url)
+        if event is None:
+            event = threading.Event()
+            THEFOREMAN_MEMO_INFLIGHT[url] = event
+            return None, event, THEFOREMAN_MEMO_WRITES.get(resource_type, 0)
+
+    # Wait for the identical request in flight, the caller sends its own if
+    # the response could not be memoized
+    event.wait()
+    with THEFOREMAN_MEMO_LOCK:
+        if url in THEFOREMAN_MEMO:
+            THEFOREMAN_API_MEMO_HITS.append(url)
+            return THEFOREMAN_MEMO[url], None, None
+
+    return None, None, None
+
+
+# Memoize a successful GET response unless the resource type was written to
+# since the request was sent
+def theforeman_memo_set(url, writes, json_out, info):
+    resource_type = theforeman_resource_type(url)
+
+    with THEFOREMAN_MEMO_LOCK:
+        if writes == THEFOREMAN_MEMO_WRITES.get(resource_type, 0):
+            THEFOREMAN_MEMO[url] = (json_out, info)
+
+
+# Mark a claimed GET request as answered
+def theforeman_memo_done(url, event):
+    with THEFOREMAN_MEMO_LOCK:
+        del THEFOREMAN_MEMO_INFLIGHT[url]
+    event.set()
+
+
+# Send a GET request unless the same request was already answered during
+# the module run, identical requests in flight are coalesced into one
+def theforeman_memo_get(module, url, data):
+    (memoized, event, writes) = theforeman_memo_claim(url)
+    if memoized:
+        return memoized
+    if event is None:
+        return theforeman_send(module, url, data, 'GET')
+
+    try:
+        (json_out, info) = theforeman_send(module, url, data, 'GET')
+        if info['status'] == 200:
+            theforeman_memo_set(url, writes, json_out, info)
+    finally:
+        theforeman_memo_done(url, event)
+
+    return json_out, info
+
+
+# Submit request to Foreman API without checking the returned status
+def theforeman_request(module, url, data, method, params=''):
+    if params:
+        url = url + '?' + params
+
+    if method == 'GET':
+        return theforeman_memo_get(module, url, data)
+
+    (json_out, info) = theforeman_send(module, url, data, method)
+
+    # Memoized responses and cached IDs of the resource type may no longer
+    # be valid after a write
+    theforeman_memo_invalidate(url)
+    if info['status'] in (200, 201, 202, 204):
+        theforeman_cache_invalidate(module, url)
+
+    return json_out, info
+
+
+# Submit query to Foreman API
+def theforeman_query(module, url, data, method, params=''):
+    (json_out, info) = theforeman_request(module, url, data, method, params)
 
     if (
         info['status'] != 201 and
@@ -30,109 +1223,715 @@ def theforeman_query(module, url, data, method):
             msg="%s \n %s" % (info['msg'], info['body'])
         )
 
-    try:
-        json_out = json.loads(response.read())
-    except:
-        json_out = ''
+    return json_out, info
+
+
+# Limit a record to the given keys (all keys if fields is None)
+def theforeman_project_record(record, fields):
+    if fields is None:
+        return record
+
+    return dict((i, record[i]) for i in fields if i in record)
+
+
+# Incremental decoder of Foreman collection responses. Iterating over it
+# reads the response from an iterator of byte chunks and yields the records
+# of the results array one at a time, so only a single record is decoded at
+# once. The other top level keys (total, subtotal, ...) are available in
+# meta, complete tells whether the whole response was decoded.
+class TheForemanResultsDecoder(object):
+    def __init__(self, chunks, fields=None):
+        self.chunks = chunks
+        self.fields = fields
+        self.meta = {}
+        self.complete = False
+        self.size = 0
+        self.decode_time = 0
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+
+    # Append the next chunk to the buffer, returns False at the end of the
+    # response
+    def _fill(self):
+        if self.eof:
+            return False
+
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.eof = True
+            text = self.utf8.decode(b'', True)
+        else:
+            self.size = self.size + len(chunk)
+            text = self.utf8.decode(chunk)
+
+        self.buf = self.buf[self.pos:] + text
+        self.pos = 0
+        return True
+
+    # Skip whitespace and return the next character ('' at the end)
+    def _peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n':
+                self.pos = self.pos + 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+
+    def _expect(self, chars):
+        char = self._peek()
+        if char == '' or char not in chars:
+            raise ValueError('Expecting %s at offset %d of the response' % (
+                ' or '.join(chars), self.size - len(self.buf) + self.pos))
+        self.pos = self.pos + 1
+
+        return char
+
+    # Decode the JSON value at the current position
+    def _value(self):
+        self._peek()
+        while True:
+            start = time.time()
+            try:
+                (value, end) = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                # The value may continue in the next chunk
+                end = None
+            self.decode_time = self.decode_time + time.time() - start
+
+            # A number is only complete once it is followed by a delimiter,
+            # "1." or "1e" decode as 1 but may continue in the next chunk
+            if end is None or end == len(self.buf) or \
+                    self.buf[end] not in ' \t\r\n,:]}':
+                if self._fill():
+                    continue
+                if end is None:
+                    raise ValueError('Truncated or invalid response')
+
+            self.pos = end
+            return value
+
+    def __iter__(self):
+        self._expect('{')
+        if self._peek() == '}':
+            self.pos = self.pos + 1
+            self.complete = True
+            return
+
+        while True:
+            key = self._value()
+            self._expect(':')
+
+            if key == 'results' and self._peek() == '[':
+                self.pos = self.pos + 1
+                if self._peek() == ']':
+                    self.pos = self.pos + 1
+                else:
+                    while True:
+                        yield theforeman_project_record(self._value(),
+                                                        self.fields)
+                        if self._expect(',]') == ']':
+                            break
+            else:
+                self.meta[key] = self._value()
+
+            if self._expect(',}') == '}':
+                break
+
+        self.complete = True
+
+
+# Send a GET request for a page of a Foreman collection and yield its
+# records while the response is decoded, the other top level keys of the
+# response are stored in meta. Raises TheForemanRequestError if the request
+# fails or its response can't be decoded. Only pages consumed completely
+# without projecting fields are memoized and stored for revalidation, the
+# generator has to be consumed or closed as identical requests wait for it.
+def theforeman_stream_results(module, url, meta, fields=None):
+    (memoized, event, writes) = theforeman_memo_claim(url)
+    if memoized:
+        (json_out, info) = memoized
+        meta.update(json_out)
+        for i in meta.pop('results', []):
+            yield theforeman_project_record(i, fields)
+        return
+
+    try:
+        headers = {'Accept': 'application/json'}
+        stored = theforeman_body_cache_get(module, url)
+        headers.update(theforeman_conditional_headers(stored))
+
+        client = theforeman_client(module, url)
+        start = time.time()
+        (chunks, info) = client.stream('GET', url, None, headers)
+        latency = time.time() - start
+
+        if stored and info['status'] == 304:
+            client.read(chunks, info)
+            theforeman_record_call(module, 'GET', url, info, latency, 0, 0)
+            info['status'] = 200
+            info['msg'] = 'OK (not modified)'
+            info['not_modified'] = True
+            if event is not None:
+                theforeman_memo_set(url, writes, stored['body'], info)
+            meta.update(stored['body'])
+            for i in meta.pop('results', []):
+                yield theforeman_project_record(i, fields)
+            return
+
+        if chunks is None or info['status'] != 200:
+            content = None
+            if chunks is not None:
+                (content, info) = client.read(chunks, info)
+            theforeman_record_call(module, 'GET', url, info, latency,
+                                   len(content or ''), 0)
+            raise TheForemanRequestError(info)
+
+        decoder = TheForemanResultsDecoder(chunks, fields)
+        records = [] if fields is None else None
+        try:
+            for i in decoder:
+                if records is not None:
+                    records.append(i)
+                yield i
+        except (ValueError, zlib.error, http_client.HTTPException,
+                socket.error) as e:
+            info['status'] = -1
+            info['msg'] = 'Reading response failed: %s' % (to_native(e))
+            raise TheForemanRequestError(info)
+        finally:
+            # Stopping early drops or drains the rest of the response
+            chunks.close()
+            latency = time.time() - start
+            theforeman_record_call(module, 'GET', url, info, latency,
+                                   decoder.size, decoder.decode_time)
+            meta.update(decoder.meta)
+
+        if records is not None:
+            json_out = dict(decoder.meta, results=records)
+            if event is not None:
+                theforeman_memo_set(url, writes, json_out, info)
+            theforeman_body_cache_set(module, url, info, json_out)
+    finally:
+        if event is not None:
+            theforeman_memo_done(url, event)
+
+
+# Iterate over the records of a Foreman collection one page at a time,
+# only fetching the next page once the previous one has been consumed.
+# Records are decoded while the page is read, fields limits the records to
+# the given keys.
+def theforeman_iter_results(module, url, params='', per_page=None,
+                            strict=True, fields=None):
+    page = 1
+
+    if not per_page:
+        per_page = module.params.get('per_page') or THEFOREMAN_PER_PAGE
+
+    while True:
+        page_params = 'page=%s&per_page=%s' % (page, per_page)
+        if params:
+            page_params = page_params + '&' + params
+
+        meta = {}
+        count = 0
+        records = theforeman_stream_results(module, url + '?' + page_params,
+                                            meta, fields)
+        try:
+            for i in records:
+                count = count + 1
+                yield i
+        except TheForemanRequestError as e:
+            if not strict:
+                raise
+            if e.info['status'] == 404:
+                return
+            module.fail_json(
+                msg="%s \n %s" % (e.info['msg'], e.info['body'])
+            )
+        finally:
+            records.close()
+
+        total = meta.get('subtotal', meta.get('total'))
+        if count < per_page or (total and page * per_page >= total):
+            return
+
+        page = page + 1
+
+
+# Fields kept by record stores of resource types without a registered
+# description in THEFOREMAN_RESOURCES
+THEFOREMAN_STORE_FIELDS = ('id', 'name', 'title', 'description')
+
+# Placeholder of fields missing from a stored record
+THEFOREMAN_MISSING = object()
+
+
+# Compact store of the records of a Foreman collection. Every record is kept
+# as a tuple holding only the given fields, association lists are reduced
+# to tuples of IDs and repeated strings are stored once. Records can be
+# looked up by ID and by every indexed field, the first record holding a
+# value wins like with the lookups against the API. Looked up and iterated
+# records are returned as dicts.
+class TheForemanRecordStore(object):
+    def __init__(self, fields, indexes=('name',)):
+        self.fields = tuple(['id'] + [i for i in fields if i != 'id'])
+        self.positions = dict((v, i) for i, v in enumerate(self.fields))
+        self.associations = [i for i in self.fields
+                             if i in THEFOREMAN_ASSOCIATIONS]
+        self.indexes = dict((i, {}) for i in indexes
+                            if i != 'id' and i in self.positions)
+        self.rows = {}
+        self.strings = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        for row in list(self.rows.values()):
+            yield self.record(row)
+
+    def compact(self, field, value):
+        if isinstance(value, string_types):
+            return self.strings.setdefault(value, value)
+        if isinstance(value, list) and field in THEFOREMAN_ASSOCIATIONS:
+            return tuple(i['id'] if isinstance(i, dict) else i
+                         for i in value)
+        return value
+
+    def record(self, row):
+        record = dict(zip(self.fields, row))
+        for field in self.associations:
+            if isinstance(record[field], tuple):
+                record[field] = [{'id': i} for i in record[field]]
+        if THEFOREMAN_MISSING in row:
+            for field, value in list(record.items()):
+                if value is THEFOREMAN_MISSING:
+                    del record[field]
+        return record
+
+    def add(self, record):
+        self.remove(record['id'])
+
+        row = tuple(self.compact(i, record.get(i, THEFOREMAN_MISSING))
+                    for i in self.fields)
+        self.rows[row[0]] = row
+        for field, index in self.indexes.items():
+            value = row[self.positions[field]]
+            if value is not None and value is not THEFOREMAN_MISSING:
+                index.setdefault(value, row[0])
+
+    def remove(self, resource_id):
+        row = self.rows.pop(resource_id, None)
+        if row is None:
+            return False
+
+        for field, index in self.indexes.items():
+            value = row[self.positions[field]]
+            if index.get(value) == resource_id:
+                del index[value]
+        return True
+
+    def get(self, field, value):
+        if field == 'id':
+            row = self.rows.get(value)
+        else:
+            row = self.rows.get(self.indexes[field].get(value))
+
+        if row is None:
+            return None
+        return self.record(row)
+
+    def indexed(self, field):
+        return field == 'id' or field in self.indexes
+
+    # Remove the given IDs from an association field of every record
+    def discard_associations(self, field, resource_ids):
+        if field not in self.positions:
+            return
+
+        position = self.positions[field]
+        for key, row in list(self.rows.items()):
+            value = row[position]
+            if isinstance(value, tuple) and \
+                    not resource_ids.isdisjoint(value):
+                value = tuple(i for i in value if i not in resource_ids)
+                self.rows[key] = row[:position] + (value,) + \
+                    row[position + 1:]
+
+    # Serializable form of the store, see theforeman_store_load
+    def dump(self):
+        rows = []
+        for row in self.rows.values():
+            rows.append([None if i is THEFOREMAN_MISSING else i
+                         for i in row])
+        return {
+            'fields': list(self.fields),
+            'indexes': sorted(self.indexes),
+            'rows': rows,
+        }
+
+
+# Obtain the fields kept and indexed by the record store of a resource
+# type: the fields compared against payloads, and the name along with the
+# fields other resource types reference it by
+def theforeman_store_spec(resource_type):
+    indexes = set(['name'])
+    for spec in THEFOREMAN_RESOURCES.values():
+        for (referenced, field) in spec['references'].values():
+            if referenced == resource_type:
+                indexes.add(field)
+
+    fields = THEFOREMAN_RESOURCES.get(resource_type, {}).get(
+        'fields', THEFOREMAN_STORE_FIELDS)
+
+    return list(fields) + sorted(indexes - set(fields)), sorted(indexes)
+
+
+# Create an empty record store for a resource type
+def theforeman_store(resource_type):
+    (fields, indexes) = theforeman_store_spec(resource_type)
+    return TheForemanRecordStore(fields, indexes)
+
+
+# Create a record store holding the given records of a resource type
+def theforeman_store_records(resource_type, records):
+    store = theforeman_store(resource_type)
+    for i in records:
+        store.add(i)
+    return store
+
+
+# Obtain the record store of a collection read in full by a scan, if it is
+# indexed by the search parameter and holds the given fields (None for the
+# fields of theforeman_store_spec)
+def theforeman_stored_collection(url, search_parameter, fields):
+    entry = THEFOREMAN_STORES.get(url)
+    if entry is None:
+        return None
+
+    (store, stored_fields) = entry
+    if not store.indexed(search_parameter):
+        return None
+    if fields is None and stored_fields is not None:
+        return None
+    if fields is not None and not set(fields) <= set(store.fields):
+        return None
+
+    return store
+
+
+# Keep the record store of a collection read in full unless the resource
+# type has been written to since the number of writes was read. Without a
+# store, only remember that the collection was scanned to the end.
+def theforeman_store_collection(url, store, fields, writes):
+    resource_type = theforeman_resource_type(url)
+
+    with THEFOREMAN_MEMO_LOCK:
+        if THEFOREMAN_MEMO_WRITES.get(resource_type, 0) == writes:
+            if store is None:
+                THEFOREMAN_SCANNED.add(url)
+            else:
+                THEFOREMAN_STORES[url] = (store, fields)
+
+
+# Recreate a record store from its serialized form
+def theforeman_store_load(data):
+    store = TheForemanRecordStore(data['fields'], data['indexes'])
+    for row in data['rows']:
+        store.add(dict(zip(data['fields'], row)))
+    return store
+
+
+# Build scoped search parameter matching any of the values exactly
+def theforeman_search_params(search_parameter, search_values):
+    # Values containing quotes can't be expressed as a scoped search
+    for i in search_values:
+        if '"' in i:
+            return ''
+
+    search = ' or '.join(
+        ['%s = "%s"' % (search_parameter, i) for i in search_values]
+    )
+
+    return 'search=' + quote(to_bytes(search), safe='')
+
+
+# Resolve a list of values to the matching Foreman collection records with
+# as few queries as possible, returns a dict of value to record (None if it
+# can't be found). Values resolved from the ID cache map to a record only
+# holding the ID, unless cache is False. fields limits the records of a
+# full collection scan to the given keys, the search parameter and ID are
+# always kept.
+def theforeman_resolve_resources(module, url, data, method,
+                                 search_parameter, search_values,
+                                 fields=None, cache=True):
+    # Values are compared as text, on Python 2 module parameters are byte
+    # strings while records are decoded to unicode
+    values = dict((to_text(i), i) for i in search_values)
+    resources = theforeman_resolve_text_resources(
+        module, url, data, method, search_parameter, list(values), fields,
+        cache
+    )
+
+    return dict((values[k], v) for k, v in resources.items())
+
+
+# Resolve a list of text values like theforeman_resolve_resources
+def theforeman_resolve_text_resources(module, url, data, method,
+                                      search_parameter, search_values,
+                                      fields, cache):
+    resources = dict.fromkeys(search_values)
+
+    # Collections scanned in full before are looked up without any request
+    store = theforeman_stored_collection(url, search_parameter, fields)
+    if store is not None:
+        for value in search_values:
+            resources[value] = store.get(search_parameter, value)
+        return resources
+
+    # Only query Foreman for values without a cached ID
+    cached_ids = {}
+    if cache:
+        cached_ids = theforeman_cache_get(module, url, search_parameter,
+                                          resources.keys())
+    for value, resource_id in cached_ids.items():
+        resources[value] = {'id': resource_id}
+    wanted = [i for i in resources.keys() if i not in cached_ids]
+    if not wanted:
+        return resources
+
+    try:
+        # Let Foreman filter the collection and only return matching records,
+        # splitting the OR-ed query to keep the request URL to a sane length
+        for n in range(0, len(wanted), THEFOREMAN_SEARCH_BATCH):
+            batch = wanted[n:n + THEFOREMAN_SEARCH_BATCH]
+            params = theforeman_search_params(search_parameter, batch)
+            if not params:
+                raise TheForemanRequestError({})
+
+            # The search only returns matching records, reading the page to
+            # the end lets it be memoized for identical lookups
+            pending = set(batch)
+            for i in theforeman_iter_results(module, url, params,
+                                             strict=False):
+                value = to_text(i[search_parameter])
+                if value in pending:
+                    resources[value] = i
+                    pending.discard(value)
+
+        theforeman_cache_set(module, url, search_parameter,
+                             theforeman_resource_ids(resources))
+        return resources
+    except TheForemanRequestError:
+        pass
+
+    # Fall back to scanning the whole collection if search is not supported,
+    # only matching values exactly like the search does and stopping as
+    # soon as every value has been matched. Once a lookup had to scan the
+    # collection to the end, it is expected to be scanned again: the next
+    # scan reads it to the end into a record store for later lookups.
+    if fields is not None:
+        fields = set(fields) | set(['id', search_parameter])
+    store = None
+    if url in THEFOREMAN_SCANNED:
+        if fields is not None:
+            store_fields = sorted(fields)
+        else:
+            store_fields = theforeman_store_spec(
+                theforeman_resource_type(url))[0]
+            if search_parameter not in store_fields:
+                store_fields.append(search_parameter)
+        store = TheForemanRecordStore(store_fields, [search_parameter])
+    writes = THEFOREMAN_MEMO_WRITES.get(theforeman_resource_type(url), 0)
+
+    pending = set(wanted)
+    complete = True
+    for i in theforeman_iter_results(module, url, fields=fields):
+        if store is not None:
+            store.add(i)
+        value = to_text(i[search_parameter])
+        if value in pending:
+            resources[value] = i
+            pending.discard(value)
+            if not pending and store is None:
+                complete = False
+                break
+
+    if complete:
+        theforeman_store_collection(url, store, fields, writes)
+
+    theforeman_cache_set(module, url, search_parameter,
+                         theforeman_resource_ids(resources))
+    return resources
+
 
-    return json_out, info
+# Map resolved records to their IDs ('' for records that weren't found)
+def theforeman_resource_ids(resources):
+    return dict(
+        (k, v['id'] if v else '') for k, v in resources.items()
+    )
+
+
+# Resolve a list of values to Foreman resource IDs with as few queries as
+# possible, returns a dict of value to ID ('' if the ID can't be found)
+def theforeman_resolve_resource_ids(module, url, data, method,
+                                    search_parameter, search_values):
+    resources = theforeman_resolve_resources(
+        module, url, data, method, search_parameter, search_values, ()
+    )
+
+    return theforeman_resource_ids(theforeman_verify_references(
+        module, url, data, method, search_parameter, resources
+    ))
 
 
 # Obtain ID of Foreman resource based on specified parameter
 def theforeman_obtain_resource_id(module, url, data, method,
                                   search_parameter, search_value):
-    (query_out, info) = theforeman_query(module, url, data, method)
-
-    for i in query_out['results']:
-        if search_value in i[search_parameter]:
-            return i['id']
+    resource_ids = theforeman_resolve_resource_ids(module, url, data, method,
+                                                   search_parameter,
+                                                   [search_value])
 
     # return nothing if ID can't be found
-    return ''
+    return resource_ids[search_value]
 
 
-# Generate list of domains dicts
-def theforeman_generate_domains_dict(module, url, domains):
-    set_domains = []
-    myurl = url + "/api/domains"
-    data = {}
-    method = 'GET'
-    search_parameter = 'name'
+# Check the records resolved from the ID cache (only holding the ID) still
+# exist under the resolved value, replacing them with their detail records.
+# Stale cached IDs are forgotten and their values resolved again.
+def theforeman_verify_resources(module, url, data, method,
+                                search_parameter, resources):
+    stale = []
+    for value, record in resources.items():
+        if not record or set(record) != set(['id']):
+            continue
 
-    if domains:
-        for i in domains:
-            search_value = i
-            domain_id = theforeman_obtain_resource_id(module, myurl, data,
-                                                      method,
-                                                      search_parameter,
-                                                      search_value)
-            domain_dict = {"id": domain_id}
-            set_domains.append(domain_dict.copy())
+        myurl = url + "/%s" % (record['id'])
+        (query_out, info) = theforeman_request(module, myurl, {}, 'GET')
+        if info['status'] == 404 or (
+                info['status'] == 200 and
+                query_out.get(search_parameter) != to_text(value)):
+            stale.append(value)
+        elif info['status'] == 200:
+            resources[value] = query_out
 
-    return set_domains
+    if stale:
+        theforeman_cache_forget(module, url, set(
+            resources[i]['id'] for i in stale))
+        resources.update(theforeman_resolve_resources(
+            module, url, data, method, search_parameter, stale
+        ))
 
+    return resources
 
-# Generate list of locations dicts
-def theforeman_generate_locations_dict(module, url, locations):
-    set_locations = []
-    myurl = url + "/api/locations"
-    data = {}
-    method = 'GET'
-    search_parameter = 'name'
 
-    if locations:
-        for i in locations:
-            search_value = i
-            location_id = theforeman_obtain_resource_id(module, myurl, data,
-                                                        method,
-                                                        search_parameter,
-                                                        search_value)
-            location_dict = {"id": location_id}
-            set_locations.append(location_dict.copy())
+# Check the records of referenced resources resolved from the ID cache
+# (only holding the ID) with one lookup bypassing the cache, as referenced
+# resources are not read in detail. IDs of resources that were removed or
+# renamed since are forgotten and replaced by the current ones.
+def theforeman_verify_references(module, url, data, method,
+                                 search_parameter, resources):
+    cached = [k for k, v in resources.items() if v and set(v) == set(['id'])]
+    if not cached:
+        return resources
 
-    return set_locations
+    found = theforeman_resolve_resources(module, url, data, method,
+                                         search_parameter, cached, (),
+                                         cache=False)
+    stale = set(resources[i]['id'] for i in cached
+                if not found[i] or found[i]['id'] != resources[i]['id'])
+    if stale:
+        theforeman_cache_forget(module, url, stale)
+    resources.update(found)
 
+    return resources
 
-# Generate list of organizations dicts
-def theforeman_generate_organizations_dict(module, url, organizations):
-    set_organizations = []
-    myurl = url + "/api/organizations"
-    data = {}
-    method = 'GET'
-    search_parameter = 'name'
 
-    if organizations:
-        for i in organizations:
-            search_value = i
-            organization_id = theforeman_obtain_resource_id(module, myurl,
-                                                            data, method,
-                                                            search_parameter,
-                                                            search_value)
-            organization_dict = {"id": organization_id}
-            set_organizations.append(organization_dict.copy())
+# Obtain the collection record of a Foreman resource based on specified
+# parameter, returns None if it can't be found
+def theforeman_obtain_resource(module, url, data, method,
+                               search_parameter, search_value):
+    resources = theforeman_resolve_resources(module, url, data, method,
+                                             search_parameter,
+                                             [search_value])
+    resources = theforeman_verify_resources(module, url, data, method,
+                                            search_parameter, resources)
 
-    return set_organizations
+    return resources[search_value]
 
 
-# Generate list of operatingsystem IDs
-def theforeman_gen_os_ids(module, url, operatingsystems):
-    set_operatingsystems = []
-    myurl = url + "/api/operatingsystems"
+# Generate list of resource ID dicts for the given names
+def theforeman_generate_ids_dict(module, url, resource, search_parameter,
+                                 search_values):
+    set_resources = []
+    myurl = url + "/api/" + resource
     data = {}
     method = 'GET'
-    search_parameter = 'description'
 
-    if operatingsystems:
-        for i in operatingsystems:
-            search_value = i
-            operatingsystem_id = theforeman_obtain_resource_id(module, myurl,
-                                                               data, method,
-                                                               search_parameter, # NOQA
-                                                               search_value)
-            operatingsystem_dict = {"id": operatingsystem_id}
-            set_operatingsystems.append(operatingsystem_dict.copy())
+    if search_values:
+        resource_ids = theforeman_resolve_resource_ids(module, myurl, data,
+                                                       method,
+                                                       search_parameter,
+                                                       search_values)
+        for i in search_values:
+            set_resources.append({"id": resource_ids[i]})
+
+    return set_resources
+
+
+# Run independent lookups on a bounded thread pool, each call is a tuple of
+# a function and its arguments (without the module) and the results are
+# returned in the order of the calls. The module fails with the error of
+# the first failing call, just like running the calls one after another.
+def theforeman_run_concurrently(module, calls, workers=None):
+    if workers is None:
+        workers = module.params.get('lookup_workers') or \
+            THEFOREMAN_LOOKUP_WORKERS
+
+    if workers <= 1 or len(calls) <= 1 or ThreadPoolExecutor is None:
+        return [func(module, *args) for (func, args) in calls]
+
+    deferred = TheForemanDeferredModule(module)
+    with ThreadPoolExecutor(max_workers=min(workers, len(calls))) as pool:
+        futures = [pool.submit(func, deferred, *args)
+                   for (func, args) in calls]
+
+    results = []
+    for future in futures:
+        try:
+            results.append(future.result())
+        except TheForemanDeferredFailure as e:
+            module.fail_json(**e.kwargs)
+
+    return results
+
 
-    return set_operatingsystems
+# Generate list of domains dicts
+def theforeman_generate_domains_dict(module, url, domains):
+    return theforeman_generate_ids_dict(module, url, 'domains', 'name',
+                                        domains)
+
+
+# Generate list of locations dicts
+def theforeman_generate_locations_dict(module, url, locations):
+    return theforeman_generate_ids_dict(module, url, 'locations', 'name',
+                                        locations)
+
+
+# Generate list of organizations dicts
+def theforeman_generate_organizations_dict(module, url, organizations):
+    return theforeman_generate_ids_dict(module, url, 'organizations', 'name',
+                                        organizations)
+
+
+# Generate list of operatingsystem IDs
+def theforeman_gen_os_ids(module, url, operatingsystems):
+    return theforeman_generate_ids_dict(module, url, 'operatingsystems',
+                                        'description', operatingsystems)
 
 
 # Parse input to generate list of resource IDs
@@ -146,87 +1945,1029 @@ def theforeman_parse_resource_id(resources):
     return resource_ids
 
 
-# Compare current values against provided values
+# Association fields holding lists of {"id": ...} dicts
+THEFOREMAN_ASSOCIATIONS = frozenset([
+    'domains', 'locations', 'organizations', 'operatingsystems',
+])
+
+# Association fields left untouched when the desired list is empty
+THEFOREMAN_KEPT_ASSOCIATIONS = frozenset(['domains'])
+
+
+# Normalize an association list into a frozenset of IDs
+def theforeman_association_ids(resources):
+    if not resources:
+        return frozenset()
+
+    try:
+        return frozenset([i['id'] for i in resources])
+    except TypeError:
+        # Plain lists of IDs
+        return frozenset([i['id'] if isinstance(i, dict) else i
+                          for i in resources])
+
+
+# Check whether an association list of a Foreman record holds exactly the
+# wanted IDs, Foreman never lists an association twice so matching lengths
+# and membership are enough
+def theforeman_same_associations(wanted, resources):
+    resources = resources or []
+    if len(wanted) != len(resources):
+        return False
+
+    try:
+        for i in resources:
+            if i['id'] not in wanted:
+                return False
+    except TypeError:
+        return wanted == theforeman_association_ids(resources)
+
+    return True
+
+
+# Compare a resource payload against the current Foreman record in a single
+# pass, returns a dict holding only the fields that differ. normalizers maps
+# field names to functions applied to both sides of a scalar comparison.
+def theforeman_diff_record(desired, current, normalizers=None):
+    normalizers = normalizers or {}
+    diff = {}
+
+    for key, val in desired.items():
+        if key in THEFOREMAN_ASSOCIATIONS:
+            wanted = theforeman_association_ids(val)
+            if not wanted and key in THEFOREMAN_KEPT_ASSOCIATIONS:
+                continue
+            if not theforeman_same_associations(wanted, current.get(key)):
+                diff[key] = val
+            continue
+
+        normalize = normalizers.get(key)
+        if normalize:
+            if normalize(val) != normalize(current.get(key)):
+                diff[key] = val
+        elif val != current.get(key):
+            diff[key] = val
+
+    return diff
+
+
+# Check whether a record holds every field compared against the payload
+def theforeman_record_covers(query_data, record):
+    for desired in query_data.values():
+        for key, val in desired.items():
+            if key in THEFOREMAN_KEPT_ASSOCIATIONS and \
+                    not theforeman_association_ids(val):
+                continue
+            if key not in record:
+                return False
+
+    return True
+
+
+# Obtain current values of a resource to compare the payload against. The
+# collection record is used when it holds every compared field, otherwise
+# (e.g. for association lists) the detail record is fetched from url.
+def theforeman_current_values(module, url, query_data, record):
+    if record and theforeman_record_covers(query_data, record):
+        return record
+
+    method = 'GET'
+    (query_out, info) = theforeman_query(module, url, query_data, method)
+    if info['status'] == 404:
+        module.fail_json(msg="Foreman resource %s no longer exists" % (url))
+
+    return query_out
+
+
+# Compare current values against provided values, returns the number of
+# differing fields and a payload holding only the differing fields. The
+# association lists of query_data are compared, the association arguments
+# are kept for existing callers.
 def theforeman_compare_values(module, url, query_data, query_out,
                               domains=[], locations=[],
                               organizations=[], operatingsystems=[]):
-
-    # Set update trigger variable
+    diff_data = {}
     diff_val = 0
 
-    for i in query_data.keys():
-        if domains:
-            set_domains = theforeman_parse_resource_id(domains)
-            assigned_domains = theforeman_parse_resource_id(query_out['domains']) # NOQA
-        else:
-            set_domains = []
-            if 'domain' in query_data[i].keys():
-                assigned_domains = theforeman_parse_resource_id(query_out['domains']) # NOQA
-                query_data.update({"domains": [{"id": ""}]})
-            else:
-                assigned_domains = []
-
-        if locations:
-            set_locations = theforeman_parse_resource_id(locations)
-            assigned_locations = theforeman_parse_resource_id(query_out['locations']) # NOQA
-        else:
-            set_locations = []
-            if 'locations' in query_data[i].keys():
-                assigned_locations = theforeman_parse_resource_id(query_out['locations']) # NOQA
-                query_data.update({"locations": [{"id": ""}]})
-            else:
-                assigned_locations = []
-
-        if operatingsystems:
-            set_operatingsystems = theforeman_parse_resource_id(operatingsystems) # NOQA
-            assigned_operatingsystems = theforeman_parse_resource_id(query_out['operatingsystems']) # NOQA
-        else:
-            set_operatingsystems = []
-            if 'operatingsystems' in query_data[i].keys():
-                assigned_operatingsystems = theforeman_parse_resource_id(query_out['operatingsystems']) # NOQA
-                query_data.update({"operatingsystems": [{"id": ""}]})
-            else:
-                assigned_operatingsystems = []
-
-        for key, val in query_data[i].iteritems():
-            if key == 'domains':
-                if set(set_domains) != set(assigned_domains):
-                    diff_val = diff_val + 1
-            elif key == 'locations':
-                if set(set_locations) != set(assigned_locations):
-                    diff_val = diff_val + 1
-            elif key == 'operatingsystems':
-                if set(set_operatingsystems) != set(assigned_operatingsystems):
-                    diff_val = diff_val + 1
-            else:
-                if val != query_out[key]:
-                    diff_val = diff_val + 1
+    for i, desired in query_data.items():
+        diff_data[i] = theforeman_diff_record(
+            desired, query_out, THEFOREMAN_NORMALIZERS.get(i)
+        )
+        diff_val = diff_val + len(diff_data[i])
 
-    return diff_val, query_data
+    return diff_val, diff_data
 
 
 # Generate list of avilable location IDs
 def theforeman_query_location_ids(module, url):
     url = url + '/api/locations'
-    data = {}
-    method = 'GET'
 
-    json_out = theforeman_query(module, url, data, method)
+    location_ids = []
+    for i in theforeman_iter_results(module, url, fields=('id',)):
+        location_ids.append(i['id'])
 
-    if json_out == 'None' or json_out == '':
+    if not location_ids:
         module.fail_json(
             msg="""
                 No locations returned in query response from Foreman from %s
-            """
+            """ % (url)
         )
 
-    location_ids = []
-    for i in json_out['results']:
-        location_ids.append(i['id'])
-
     return location_ids
 
 
 # Calculate CIDR network prefix from networok mask
 def theforeman_calculate_cidr(netmask):
     return sum([bin(int(x)).count('1') for x in netmask.split('.')])
+
+
+# Treat empty strings like unset values, Foreman returns null for both
+def theforeman_normalize_empty(value):
+    if value is None:
+        return None
+
+    if not isinstance(value, (int, float, bool)):
+        value = to_text(value).strip()
+        if value == '':
+            return None
+
+    return value
+
+
+# Compare numbers regardless of being passed as strings
+def theforeman_normalize_int(value):
+    value = theforeman_normalize_empty(value)
+    if value is None or isinstance(value, bool):
+        return value
+
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+# Compare IP addresses in their canonical form
+def theforeman_normalize_ip(value):
+    value = theforeman_normalize_empty(value)
+    if value is None or ipaddress is None:
+        return value
+
+    try:
+        return to_text(ipaddress.ip_address(value))
+    except ValueError:
+        return value
+
+
+# Compare network masks as prefix length, accepts dotted masks, IPv6 masks
+# and prefix lengths with or without a leading slash
+def theforeman_normalize_mask(value):
+    value = theforeman_normalize_empty(value)
+    if value is None:
+        return value
+
+    value = to_text(value).lstrip('/')
+    if value.isdigit():
+        return int(value)
+
+    try:
+        if ipaddress is not None and ':' in value:
+            return bin(int(ipaddress.ip_address(value))).count('1')
+        return theforeman_calculate_cidr(value)
+    except ValueError:
+        return value
+
+
+# Normalizers applied before comparing the fields of each resource payload
+THEFOREMAN_NORMALIZERS = {
+    'architecture': {},
+    'domain': {
+        'fullname': theforeman_normalize_empty,
+    },
+    'location': {
+        'description': theforeman_normalize_empty,
+    },
+    'smart_proxy': {
+        'url': theforeman_normalize_empty,
+    },
+    'subnet': {
+        'description': theforeman_normalize_empty,
+        'network': theforeman_normalize_ip,
+        'mask': theforeman_normalize_mask,
+        'gateway': theforeman_normalize_ip,
+        'dns_primary': theforeman_normalize_ip,
+        'dns_secondary': theforeman_normalize_ip,
+        'from': theforeman_normalize_ip,
+        'to': theforeman_normalize_ip,
+        'vlanid': theforeman_normalize_int,
+        'dhcp_id': theforeman_normalize_int,
+        'dns_id': theforeman_normalize_int,
+        'tftp_id': theforeman_normalize_int,
+    },
+}
+
+
+# Options describing each resource type, shared by its module and the
+# desired state documents of theforeman_plan
+THEFOREMAN_ARCHITECTURE_SPEC = dict(
+    name=dict(type='str', required=True),
+    operatingsystems=dict(type='list', default=[]),
+)
+
+THEFOREMAN_DOMAIN_SPEC = dict(
+    name=dict(type='str', required=True),
+    fullname=dict(type='str', default=""),
+    locations=dict(type='list', default=[]),
+)
+
+THEFOREMAN_LOCATION_SPEC = dict(
+    name=dict(type='str', required=True),
+    description=dict(type='str', default=""),
+)
+
+THEFOREMAN_SMART_PROXY_SPEC = dict(
+    name=dict(type='str', required=True),
+    smart_proxy_url=dict(type='str', required=True),
+)
+
+# Options describing a subnet, shared by theforeman_subnet and
+# theforeman_subnets_bulk
+THEFOREMAN_SUBNET_SPEC = dict(
+    name=dict(type='str', required=True),
+    description=dict(type='str', default=''),
+    network_type=dict(type='str', required=True,
+                      choices=['IPv4', 'IPv6']),
+    network=dict(type='str', required=True),
+    mask=dict(type='str', required=True),
+    gateway=dict(type='str', required=False, default=''),
+    dns_primary=dict(type='str', required=False, default=''),
+    dns_secondary=dict(type='str', required=False, default=''),
+    ipam=dict(type='str', required=False,
+              choices=['DHCP', 'Internal DB', 'None'],
+              default='DHCP'),
+    ip_from=dict(type='str', required=False, default=''),
+    ip_to=dict(type='str', required=False, default=''),
+    vlanid=dict(type='str', required=False, default=''),
+    boot_mode=dict(type='str', required=False,
+                   choices=['DHCP', 'Static'], default='DHCP'),
+    dhcp_proxy=dict(type='str', required=False, default=None),
+    dns_proxy=dict(type='str', required=False, default=None),
+    tftp_proxy=dict(type='str', required=False, default=None),
+    domains=dict(type='list', required=False, default=[]),
+    locations=dict(type='list', required=False, default=[]),
+    # Accepted for existing playbooks, subnet payloads carry no organizations
+    organizations=dict(type='list', required=False, default=[]),
+)
+
+
+# Apply the defaults and checks of an option spec to a resource definition,
+# kind names the resource type in error messages
+def theforeman_item_params(module, argument_spec, item, kind):
+    params = {}
+
+    for key in item:
+        if key not in argument_spec:
+            module.fail_json(
+                msg="Unsupported %s parameter %s for %s %s" % (
+                    kind, key, kind, item.get('name'))
+            )
+
+    for key, spec in argument_spec.items():
+        value = item.get(key)
+        if value is None:
+            if spec.get('required'):
+                module.fail_json(
+                    msg="Missing required %s parameter %s for %s %s"
+                        % (kind, key, kind, item.get('name'))
+                )
+            value = spec.get('default')
+            if isinstance(value, list):
+                value = list(value)
+        elif spec.get('type') == 'str':
+            value = str(value)
+        elif spec.get('type') == 'list' and not isinstance(value, list):
+            value = [i.strip() for i in str(value).split(',')]
+
+        if 'choices' in spec and value is not None and \
+                value not in spec['choices']:
+            module.fail_json(
+                msg="%s parameter %s of %s %s must be one of %s" % (
+                    kind.capitalize(), key, kind, item.get('name'),
+                    ', '.join(spec['choices']))
+            )
+
+        params[key] = value
+
+    return params
+
+
+# Apply THEFOREMAN_SUBNET_SPEC defaults and checks to a subnet definition
+def theforeman_subnet_params(module, subnet):
+    return theforeman_item_params(module, THEFOREMAN_SUBNET_SPEC, subnet,
+                                  'subnet')
+
+
+# Generate the Foreman API payload of a subnet
+def theforeman_subnet_data(name, description, network_type, network, mask,
+                           gateway, dns_primary, dns_secondary, ipam,
+                           ip_from, ip_to, vlanid, boot_mode, dhcp_proxy_id,
+                           dns_proxy_id, tftp_proxy_id, set_domains,
+                           set_locations):
+    return {
+        'subnet': {
+          "name": name,
+          "description": description,
+          "network_type": network_type,
+          "network": network,
+          "mask": mask,
+          "gateway": gateway,
+          "dns_primary": dns_primary,
+          "dns_secondary": dns_secondary,
+          "ipam": ipam,
+          "from": ip_from,
+          "to": ip_to,
+          "vlanid": vlanid,
+          "boot_mode": boot_mode,
+          "dhcp_id": dhcp_proxy_id,
+          "dns_id": dns_proxy_id,
+          "tftp_id": tftp_proxy_id,
+          "domains": set_domains,
+          "locations": set_locations,
+        }
+    }
+
+
+# Generate the Foreman API payload of an architecture
+def theforeman_architecture_data(name, set_operatingsystems):
+    return {
+        "architecture": {
+          "name": name,
+          "operatingsystems": set_operatingsystems
+        }
+    }
+
+
+# Generate the Foreman API payload of a domain
+def theforeman_domain_data(name, fullname, set_locations):
+    return {
+        "domain": {
+          "name": name,
+          "fullname": fullname,
+          "locations": set_locations
+        }
+    }
+
+
+# Generate the Foreman API payload of a location
+def theforeman_location_data(name, description):
+    return {
+        "location": {
+          "name": name,
+          "description": description,
+        }
+    }
+
+
+# Generate the Foreman API payload of a smart-proxy
+def theforeman_smart_proxy_data(name, smart_proxy_url):
+    return {
+        "smart_proxy": {
+          "name": name,
+          "url": smart_proxy_url
+        }
+    }
+
+
+# Resource types managed by the theforeman_* modules in dependency order,
+# referenced resources come first
+THEFOREMAN_RESOURCE_ORDER = [
+    'locations', 'smart_proxies', 'domains', 'architectures', 'subnets',
+]
+
+# Description of each managed resource type: the key of its payload, the
+# option spec of its module, the record fields its payload is compared
+# against, the module options referencing other resources (with the
+# resource type and field they are looked up by) and whether association
+# fields are only returned by detail requests
+THEFOREMAN_RESOURCES = {
+    'architectures': dict(
+        key='architecture',
+        spec=THEFOREMAN_ARCHITECTURE_SPEC,
+        fields=('name', 'operatingsystems'),
+        references=dict(operatingsystems=('operatingsystems', 'description')),
+        details=True,
+    ),
+    'domains': dict(
+        key='domain',
+        spec=THEFOREMAN_DOMAIN_SPEC,
+        fields=('name', 'fullname', 'locations'),
+        references=dict(locations=('locations', 'name')),
+        details=True,
+    ),
+    'locations': dict(
+        key='location',
+        spec=THEFOREMAN_LOCATION_SPEC,
+        fields=('name', 'title', 'description'),
+        references=dict(),
+        details=False,
+    ),
+    'smart_proxies': dict(
+        key='smart_proxy',
+        spec=THEFOREMAN_SMART_PROXY_SPEC,
+        fields=('name', 'url'),
+        references=dict(),
+        details=False,
+    ),
+    'subnets': dict(
+        key='subnet',
+        spec=THEFOREMAN_SUBNET_SPEC,
+        fields=('name', 'description', 'network_type', 'network', 'mask',
+                'gateway', 'dns_primary', 'dns_secondary', 'ipam', 'from',
+                'to', 'vlanid', 'boot_mode', 'dhcp_id', 'dns_id', 'tftp_id',
+                'domains', 'locations'),
+        references=dict(
+            domains=('domains', 'name'),
+            locations=('locations', 'name'),
+            dhcp_proxy=('smart_proxies', 'name'),
+            dns_proxy=('smart_proxies', 'name'),
+            tftp_proxy=('smart_proxies', 'name'),
+        ),
+        details=True,
+    ),
+}
+
+
+# Generate the Foreman API payload of a resource from its module options,
+# resolve(resource_type, field, value) returns the ID of a referenced
+# resource (None if it can't be found)
+def theforeman_resource_data(resource_type, params, resolve):
+    references = THEFOREMAN_RESOURCES[resource_type]['references']
+
+    def ids(key):
+        (referenced, field) = references[key]
+        return [{"id": resolve(referenced, field, i)} for i in params[key]]
+
+    def id(key):
+        (referenced, field) = references[key]
+        if not params[key]:
+            return None
+        return resolve(referenced, field, params[key])
+
+    if resource_type == 'architectures':
+        return theforeman_architecture_data(params['name'],
+                                            ids('operatingsystems'))
+    if resource_type == 'domains':
+        return theforeman_domain_data(params['name'], params['fullname'],
+                                      ids('locations'))
+    if resource_type == 'locations':
+        return theforeman_location_data(params['name'],
+                                        params['description'])
+    if resource_type == 'smart_proxies':
+        return theforeman_smart_proxy_data(params['name'],
+                                           params['smart_proxy_url'])
+
+    return theforeman_subnet_data(
+        params['name'], params['description'], params['network_type'],
+        params['network'], params['mask'], params['gateway'],
+        params['dns_primary'], params['dns_secondary'], params['ipam'],
+        params['ip_from'], params['ip_to'], params['vlanid'],
+        params['boot_mode'], id('dhcp_proxy'), id('dns_proxy'),
+        id('tftp_proxy'), ids('domains'), ids('locations')
+    )
+
+
+# Apply the option spec of its resource type to every resource of a
+# desired state document (resource type to list of module options, each
+# with an optional state), returns a new document. Resources with state
+# absent only require a name.
+def theforeman_desired_params(module, desired):
+    params = {}
+
+    for resource_type, items in desired.items():
+        if resource_type not in THEFOREMAN_RESOURCES:
+            module.fail_json(
+                msg="Unsupported resource type %s, supported are %s" % (
+                    resource_type, ', '.join(THEFOREMAN_RESOURCE_ORDER))
+            )
+
+        spec = dict(THEFOREMAN_RESOURCES[resource_type]['spec'])
+        spec['state'] = dict(type='str', default='present',
+                             choices=['present', 'absent'])
+        kind = THEFOREMAN_RESOURCES[resource_type]['key'].replace('_', '-')
+        # Absent resources are only looked up by name
+        absent_spec = dict(
+            (k, v if k == 'name' else dict(v, required=False))
+            for k, v in spec.items()
+        )
+
+        params[resource_type] = []
+        names = set()
+        for i in items or []:
+            if not isinstance(i, dict):
+                module.fail_json(
+                    msg="Every item of %s must be a dict" % (resource_type)
+                )
+            item = theforeman_item_params(
+                module, absent_spec if i.get('state') == 'absent' else spec,
+                i, kind
+            )
+            if item['name'] in names:
+                module.fail_json(
+                    msg="%s %s is listed more than once" % (
+                        kind.capitalize(), item['name'])
+                )
+            names.add(item['name'])
+            params[resource_type].append(item)
+
+    return params
+
+
+# Version of the snapshot file format
+THEFOREMAN_SNAPSHOT_VERSION = 2
+
+# Resource types read into a snapshot by default, the managed ones and the
+# ones they reference
+THEFOREMAN_SNAPSHOT_RESOURCES = [
+    'locations', 'domains', 'subnets', 'architectures', 'smart_proxies',
+    'operatingsystems',
+]
+
+
+# Fetch the detail record of a collection record
+def theforeman_detail_record(module, url, record):
+    myurl = url + "/%s" % (record['id'])
+    (json_out, info) = theforeman_send(module, myurl, {}, 'GET')
+
+    if info['status'] != 200:
+        module.fail_json(msg="%s \n %s" % (info['msg'], info['body']))
+
+    return json_out
+
+
+# Resource types of the records Foreman audits by auditable type
+THEFOREMAN_AUDIT_TYPES = {
+    'Architecture': 'architectures',
+    'Domain': 'domains',
+    'Location': 'locations',
+    'Operatingsystem': 'operatingsystems',
+    'SmartProxy': 'smart_proxies',
+    'Subnet': 'subnets',
+    'Subnet::Ipv4': 'subnets',
+    'Subnet::Ipv6': 'subnets',
+}
+
+
+# Obtain the ID of the latest Foreman audit, returns None if audits can't
+# be read
+def theforeman_audit_id(module, url):
+    myurl = url + "/api/audits"
+    params = 'page=1&per_page=1&order=' + quote('id DESC', safe='')
+    (json_out, info) = theforeman_send(module, myurl + '?' + params, {},
+                                       'GET')
+
+    if info['status'] != 200 or not isinstance(json_out, dict):
+        return None
+
+    results = json_out.get('results') or [{'id': 0}]
+    return results[0]['id']
+
+
+# Obtain the records audited after the given audit ID as a set of (resource
+# type, record ID) along with the ID of the latest audit, returns None if
+# audits can't be read
+def theforeman_audited_records(module, url, audit_id):
+    myurl = url + "/api/audits"
+    params = 'order=%s&search=%s' % (quote('id ASC', safe=''),
+                                     quote('id > %d' % (audit_id), safe=''))
+    records = set()
+
+    try:
+        for audit in theforeman_iter_results(module, myurl, params,
+                                             strict=False):
+            # Association changes are audited on the associated record too
+            for (type_key, id_key) in (('auditable_type', 'auditable_id'),
+                                       ('associated_type', 'associated_id')):
+                resource_type = THEFOREMAN_AUDIT_TYPES.get(
+                    audit.get(type_key))
+                if resource_type and audit.get(id_key):
+                    records.add((resource_type, audit[id_key]))
+            audit_id = max(audit_id, audit['id'])
+    except TheForemanRequestError:
+        return None
+
+    return audit_id, records
+
+
+# Fetch the detail record of a resource by ID, returns None if it doesn't
+# exist anymore
+def theforeman_refresh_record(module, url, resource_id):
+    myurl = url + "/%s" % (resource_id)
+    (json_out, info) = theforeman_send(module, myurl, {}, 'GET')
+
+    if info['status'] == 404:
+        return None
+    if info['status'] != 200:
+        module.fail_json(msg="%s \n %s" % (info['msg'], info['body']))
+
+    return json_out
+
+
+# Read the collections of the given resource types into record stores, with
+# the detail records of resource types whose associations are only returned
+# by detail requests. The ID of the latest audit is kept so the snapshot can
+# be refreshed with theforeman_snapshot_refresh.
+def theforeman_snapshot(module, url, resource_types):
+    # Changes made while the collections are read are audited after this
+    audit_id = theforeman_audit_id(module, url)
+    resources = {}
+
+    for resource_type in resource_types:
+        myurl = url + "/api/" + resource_type
+        store = theforeman_store(resource_type)
+        details = THEFOREMAN_RESOURCES.get(resource_type, {}).get('details')
+
+        # Only keep a page worth of full records around at once
+        pending = []
+        for i in theforeman_iter_results(module, myurl):
+            if not details:
+                store.add(i)
+                continue
+            pending.append(i)
+            if len(pending) >= THEFOREMAN_PER_PAGE:
+                theforeman_store_details(module, myurl, store, pending)
+                pending = []
+        theforeman_store_details(module, myurl, store, pending)
+
+        resources[resource_type] = store
+
+    return {
+        'version': THEFOREMAN_SNAPSHOT_VERSION,
+        'url': url,
+        'time': time.time(),
+        'audit_id': audit_id,
+        'resources': resources,
+    }
+
+
+# Add the detail records of the given collection records to a store
+def theforeman_store_details(module, url, store, records):
+    for i in theforeman_run_concurrently(module, [
+        (theforeman_detail_record, (url, i)) for i in records
+    ]):
+        store.add(i)
+
+
+# Bring a snapshot up to date with the changes Foreman audited since it was
+# taken, only the audited records are fetched again and records that don't
+# exist anymore are removed along with the associations referring to them
+# and their cached IDs. Returns the number of refreshed and removed records,
+# or None if the snapshot has to be taken again as audits can't be read.
+def theforeman_snapshot_refresh(module, url, snapshot):
+    if snapshot.get('audit_id') is None or snapshot.get('url') != url:
+        return None
+
+    audited = theforeman_audited_records(module, url, snapshot['audit_id'])
+    if audited is None:
+        return None
+
+    (audit_id, audited) = audited
+    resources = snapshot['resources']
+    changes = sorted(i for i in audited if i[0] in resources)
+
+    records = theforeman_run_concurrently(module, [
+        (theforeman_refresh_record,
+         (url + "/api/" + resource_type, resource_id))
+        for (resource_type, resource_id) in changes
+    ])
+
+    refreshed = {}
+    removed = {}
+    for (resource_type, resource_id), record in zip(changes, records):
+        if record is None:
+            resources[resource_type].remove(resource_id)
+            removed.setdefault(resource_type, set()).add(resource_id)
+        else:
+            resources[resource_type].add(record)
+            refreshed.setdefault(resource_type, set()).add(resource_id)
+
+    for resource_type in set(refreshed) | set(removed):
+        # Renamed and removed records may have stale cached IDs
+        theforeman_cache_forget(module, url + "/api/" + resource_type,
+                                refreshed.get(resource_type, set()) |
+                                removed.get(resource_type, set()))
+
+    # Foreman drops the associations of removed records
+    for resource_type, gone in removed.items():
+        if resource_type in THEFOREMAN_ASSOCIATIONS:
+            for store in resources.values():
+                store.discard_associations(resource_type, gone)
+
+    snapshot['audit_id'] = audit_id
+    snapshot['time'] = time.time()
+
+    return (sum(len(i) for i in refreshed.values()),
+            sum(len(i) for i in removed.values()))
+
+
+# Write a snapshot to a file, replacing it atomically
+def theforeman_snapshot_save(path, snapshot):
+    data = dict(snapshot)
+    data['resources'] = dict(
+        (k, v.dump()) for k, v in snapshot['resources'].items()
+    )
+
+    tmp_path = '%s.%s.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(theforeman_json_encode(data))
+    os.rename(tmp_path, path)
+
+
+# Load a snapshot file, returns None if it can't be read
+def theforeman_snapshot_load(path):
+    try:
+        with open(path, 'rb') as f:
+            snapshot = theforeman_json_decode(f.read())
+    except (IOError, OSError, ValueError):
+        return None
+
+    if not isinstance(snapshot, dict) or \
+            snapshot.get('version') != THEFOREMAN_SNAPSHOT_VERSION:
+        return None
+
+    resources = snapshot['resources']
+    for resource_type in list(resources):
+        resources[resource_type] = theforeman_store_load(
+            resources.pop(resource_type))
+
+    return snapshot
+
+
+# Look up a record of a snapshot by resource type and field value, returns
+# None if it can't be found
+def theforeman_snapshot_get(snapshot, resource_type, field, value):
+    store = snapshot['resources'].get(resource_type)
+    if store is None or not store.indexed(field):
+        return None
+
+    return store.get(field, value)
+
+
+# Compute the changes needed to reach a desired state document (as
+# returned by theforeman_desired_params) from a snapshot, without any
+# request to Foreman. Returns the list of actions in the order they can be
+# applied, every action has the resource type, name and action (create,
+# update or delete) and, depending on the action, the ID of the existing
+# record, the payload to send (data) and the current values of the changed
+# fields (before). References to resources created by the plan itself are
+# listed in depends_on, references that can't be resolved in unresolved.
+# Also returns the number of resources per action (including unchanged).
+def theforeman_plan(snapshot, desired):
+    summary = dict(create=0, update=0, delete=0, unchanged=0)
+    created = set()
+    plan = []
+    deletes = []
+
+    for resource_type in THEFOREMAN_RESOURCE_ORDER:
+        key = THEFOREMAN_RESOURCES[resource_type]['key']
+
+        for params in desired.get(resource_type, []):
+            name = params['name']
+            record = theforeman_snapshot_get(snapshot, resource_type, 'name',
+                                             name)
+
+            if params['state'] == 'absent':
+                if record:
+                    deletes.append({
+                        'resource': resource_type, 'name': name,
+                        'action': 'delete', 'id': record['id'],
+                    })
+                else:
+                    summary['unchanged'] = summary['unchanged'] + 1
+                continue
+
+            depends_on = []
+            unresolved = []
+
+            def resolve(referenced, field, value):
+                found = theforeman_snapshot_get(snapshot, referenced, field,
+                                                value)
+                if found:
+                    return found['id']
+                reference = '%s/%s' % (referenced, value)
+                if (referenced, field, value) in created:
+                    depends_on.append(reference)
+                else:
+                    unresolved.append(reference)
+                return None
+
+            data = theforeman_resource_data(resource_type, params, resolve)
+
+            if record:
+                diff = theforeman_diff_record(
+                    data[key], record, THEFOREMAN_NORMALIZERS.get(key)
+                )
+                if not diff:
+                    summary['unchanged'] = summary['unchanged'] + 1
+                    continue
+                action = {
+                    'resource': resource_type, 'name': name,
+                    'action': 'update', 'id': record['id'],
+                    'data': {key: diff},
+                    'before': dict((i, record.get(i)) for i in diff),
+                }
+            else:
+                created.add((resource_type, 'name', name))
+                action = {
+                    'resource': resource_type, 'name': name,
+                    'action': 'create', 'data': data,
+                }
+
+            if depends_on:
+                action['depends_on'] = depends_on
+            if unresolved:
+                action['unresolved'] = unresolved
+            summary[action['action']] = summary[action['action']] + 1
+            plan.append(action)
+
+    # Remove dependents before the resources they reference
+    order = dict((v, i) for i, v in enumerate(THEFOREMAN_RESOURCE_ORDER))
+    deletes.sort(key=lambda i: -order[i['resource']])
+    summary['delete'] = len(deletes)
+
+    return plan + deletes, summary
+
+
+# Obtain the desired state document of a module from its desired or
+# desired_file option
+def theforeman_desired_document(module):
+    if not module.params.get('desired_file'):
+        return module.params['desired']
+
+    try:
+        with open(module.params['desired_file'], 'rb') as f:
+            desired = theforeman_json_decode(f.read())
+    except (IOError, OSError, ValueError) as e:
+        module.fail_json(msg="Unable to read desired state %s: %s" % (
+            module.params['desired_file'], e))
+
+    if not isinstance(desired, dict):
+        module.fail_json(msg="Desired state %s must be a dict" % (
+            module.params['desired_file']))
+
+    return desired
+
+
+# Read the records of a desired state document and of the resources it
+# references into a snapshot, looking every resource type up by the names
+# it is referenced by instead of reading whole collections
+def theforeman_desired_snapshot(module, url, desired):
+    lookups = {}
+    for resource_type, items in desired.items():
+        references = THEFOREMAN_RESOURCES[resource_type]['references']
+        for params in items:
+            lookups.setdefault((resource_type, 'name'), set()).add(
+                params['name'])
+            if params['state'] == 'absent':
+                continue
+            for key, (referenced, field) in references.items():
+                values = params[key]
+                if not isinstance(values, list):
+                    values = [values]
+                lookups.setdefault((referenced, field), set()).update(
+                    [i for i in values if i])
+
+    lookups = sorted(lookups.items())
+    results = theforeman_run_concurrently(module, [
+        (theforeman_resolve_resources,
+         (url + "/api/" + resource_type, {}, 'GET', field, sorted(values)))
+        for ((resource_type, field), values) in lookups
+    ])
+
+    resources = dict((i, {}) for i in THEFOREMAN_SNAPSHOT_RESOURCES)
+    for ((resource_type, field), values), found in zip(lookups, results):
+        for value, record in found.items():
+            if record:
+                resources.setdefault(resource_type, {})[record['id']] = record
+
+    # The ID cache only returns IDs, and association fields only come with
+    # detail records
+    names = dict((k, set(i['name'] for i in v if i['state'] == 'present'))
+                 for k, v in desired.items())
+    details = []
+    for resource_type, records in resources.items():
+        spec = THEFOREMAN_RESOURCES.get(resource_type, {})
+        for record in records.values():
+            if 'name' not in record or spec.get('details') and \
+                    record['name'] in names.get(resource_type, ()):
+                details.append((resource_type, record))
+
+    records = theforeman_run_concurrently(module, [
+        (theforeman_detail_record, (url + "/api/" + resource_type, record))
+        for (resource_type, record) in details
+    ])
+    for (resource_type, record), detail in zip(details, records):
+        resources[resource_type][record['id']] = detail
+
+    return {
+        'version': THEFOREMAN_SNAPSHOT_VERSION,
+        'url': url,
+        'time': time.time(),
+        'resources': dict(
+            (k, theforeman_store_records(k, v.values()))
+            for k, v in resources.items()
+        ),
+    }
+
+
+# Group the actions of a plan into levels, every action only depends on
+# actions of earlier levels so the actions of a level can run concurrently.
+# Deletes come last, one level per resource type.
+def theforeman_plan_levels(plan):
+    levels = []
+    level_of = {}
+    deleted = None
+
+    for action in plan:
+        if action['action'] == 'delete':
+            if action['resource'] != deleted:
+                levels.append([])
+                deleted = action['resource']
+            levels[-1].append(action)
+            continue
+
+        level = 0
+        for i in action.get('depends_on', []):
+            level = max(level, level_of[i] + 1)
+        level_of['%s/%s' % (action['resource'], action['name'])] = level
+
+        while len(levels) <= level:
+            levels.append([])
+        levels[level].append(action)
+
+    return levels
+
+
+# Send the request of a planned action, returns the ID of the resource
+def theforeman_apply_action(module, url, action, data):
+    myurl = url + "/api/" + action['resource']
+
+    if action['action'] == 'create':
+        (query_out, info) = theforeman_query(module, myurl, data, 'POST')
+        if info['status'] == 404 or not isinstance(query_out, dict):
+            module.fail_json(msg="Unable to create %s %s: %s" % (
+                action['resource'], action['name'], info['msg']))
+        return query_out['id']
+
+    myurl = myurl + "/%s" % (action['id'])
+    if action['action'] == 'update':
+        theforeman_query(module, myurl, data, 'PUT')
+    else:
+        theforeman_query(module, myurl, {}, 'DELETE')
+
+    return action['id']
+
+
+# Apply a plan computed by theforeman_plan one level after another, running
+# the actions of a level on at most workers threads. IDs of created
+# resources are fed into the payloads of the actions depending on them.
+# Returns the applied actions with the ID of their resource and level.
+def theforeman_apply_plan(module, url, plan, snapshot, desired,
+                          workers=None):
+    params = dict(((resource_type, i['name']), i)
+                  for resource_type, items in desired.items()
+                  for i in items)
+    created = {}
+
+    def resolve(referenced, field, value):
+        found = theforeman_snapshot_get(snapshot, referenced, field, value)
+        if found:
+            return found['id']
+        return created.get((referenced, value))
+
+    results = []
+    for n, level in enumerate(theforeman_plan_levels(plan)):
+        calls = []
+        for action in level:
+            data = action.get('data')
+            if action.get('depends_on'):
+                resource_type = action['resource']
+                key = THEFOREMAN_RESOURCES[resource_type]['key']
+                data = theforeman_resource_data(
+                    resource_type, params[(resource_type, action['name'])],
+                    resolve
+                )
+                if action['action'] == 'update':
+                    data = {key: dict((i, data[key][i])
+                                      for i in action['data'][key])}
+            calls.append((theforeman_apply_action, (url, action, data)))
+
+        ids = theforeman_run_concurrently(module, calls, workers)
+
+        for action, resource_id in zip(level, ids):
+            if action['action'] == 'create':
+                created[(action['resource'], action['name'])] = resource_id
+            results.append(dict(resource=action['resource'],
+                                name=action['name'],
+                                action=action['action'],
+                                id=resource_id, level=n))
+
+    return results
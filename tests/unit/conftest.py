@@ -0,0 +1,126 @@
+# This code is part of Ansible, but is an independent component.
+
+"""Fixtures loading the modules the way Ansible does and a mock Foreman."""
+
+import importlib.util
+import json
+import os
+import sys
+
+from urllib.request import Request, urlopen
+
+import pytest
+
+pytest.importorskip('ansible')
+
+import ansible.module_utils # NOQA
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from mock_foreman import start_server # NOQA
+
+
+class ModuleFailure(Exception):
+    pass
+
+
+class FakeModule(object):
+    """Minimal stand-in for AnsibleModule."""
+
+    def __init__(self, check_mode=False, **params):
+        self.params = dict(url_username='admin', url_password='changeme',
+                           force_basic_auth=True, validate_certs=False)
+        self.params.update(params)
+        self.check_mode = check_mode
+        self.tmpdir = None
+
+    def fail_json(self, **kwargs):
+        raise ModuleFailure(kwargs.get('msg'))
+
+    def exit_json(self, **kwargs):
+        pass
+
+
+def load_source(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+
+    return module
+
+
+@pytest.fixture
+def utils():
+    utils = load_source('ansible.module_utils.theforeman_utils',
+                        os.path.join(ROOT, 'module_utils',
+                                     'theforeman_utils.py'))
+    ansible.module_utils.theforeman_utils = utils
+    yield utils
+    for client in utils.THEFOREMAN_CLIENTS.values():
+        client.close()
+
+
+@pytest.fixture
+def library(utils):
+    def load(name):
+        return load_source('test_' + name,
+                           os.path.join(ROOT, 'library', name + '.py'))
+    return load
+
+
+@pytest.fixture
+def fake_module():
+    return FakeModule
+
+
+@pytest.fixture(scope='module')
+def foreman():
+    process, url = start_server(50)
+    yield url
+    process.terminate()
+    process.join()
+
+
+@pytest.fixture(scope='module')
+def slow_foreman():
+    process, url = start_server(10, latency=0.2)
+    yield url
+    process.terminate()
+    process.join()
+
+
+@pytest.fixture(scope='module')
+def busy_foreman():
+    # Requests beyond the one in flight are rejected with 503
+    process, url = start_server(10, latency=0.3, capacity=1)
+    yield url
+    process.terminate()
+    process.join()
+
+
+@pytest.fixture
+def foreman_requests():
+    def requests(url):
+        return stats(url)['requests']
+
+    def reset(url):
+        urlopen(Request(url + '/__reset', data=b'', method='POST')).read()
+
+    def stats(url):
+        return json.loads(urlopen(url + '/__stats').read())
+
+    def rejected(url):
+        return stats(url)['rejected']
+
+    def expire_sessions(url):
+        urlopen(Request(url + '/__sessions', method='DELETE')).read()
+
+    requests.reset = reset
+    requests.stats = stats
+    requests.rejected = rejected
+    requests.expire_sessions = expire_sessions
+    return requests
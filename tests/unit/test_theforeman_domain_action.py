@@ -0,0 +1,84 @@
+# This code is part of Ansible, but is an independent component.
+
+import os
+
+import pytest
+
+from conftest import ROOT, load_source
+
+
+class Task(object):
+    _uuid = 'task'
+    action = 'theforeman_domain'
+    args = {'name': 'example.com'}
+
+
+class PlayContext(object):
+    check_mode = False
+
+
+@pytest.fixture
+def action(monkeypatch, tmp_path):
+    from ansible.plugins.action import ActionBase
+    import ansible.constants as C
+
+    plugin = load_source('test_theforeman_domain_action_plugin',
+                         os.path.join(ROOT, 'action_plugins',
+                                      'theforeman_domain.py'))
+    monkeypatch.setattr(C, 'DEFAULT_LOCAL_TMP', str(tmp_path))
+    monkeypatch.setattr(ActionBase, 'run', lambda self, tmp, task_vars: {})
+
+    def create(results):
+        action = object.__new__(plugin.ActionModule)
+        action._task = Task()
+        action._play_context = PlayContext()
+        action.runs = 0
+
+        def execute(**kwargs):
+            action.runs += 1
+            return dict(results.pop(0))
+        action._execute_module = execute
+        return action
+    return create
+
+
+def test_successful_result_is_shared(action):
+    first = action([{'changed': True, 'domain': {'id': 1}}])
+    assert first.run(task_vars={})['changed']
+
+    other = action([])
+    result = other.run(task_vars={})
+    assert other.runs == 0
+    assert result['deduplicated']
+    assert not result['changed']
+    assert result['domain'] == {'id': 1}
+
+
+@pytest.mark.parametrize('failure', [
+    {'failed': True, 'msg': 'Connection reset'},
+    {'unreachable': True, 'msg': 'No route to host'},
+])
+def test_failed_result_is_not_shared(action, failure):
+    first = action([failure])
+    assert first.run(task_vars={})['msg'] == failure['msg']
+
+    other = action([{'changed': True, 'domain': {'id': 1}}])
+    result = other.run(task_vars={})
+    assert other.runs == 1
+    assert 'deduplicated' not in result
+    assert result['changed']
+
+
+def test_result_is_not_shared_across_batches(action):
+    first = action([{'changed': True, 'domain': {'id': 1}}])
+    first.run(task_vars={'ansible_play_batch': ['a', 'b']})
+
+    same = action([])
+    assert same.run(task_vars={'ansible_play_batch': ['b', 'a']})[
+        'deduplicated']
+
+    later = action([{'changed': True, 'domain': {'id': 1}}])
+    result = later.run(task_vars={'ansible_play_batch': ['c', 'd']})
+    assert later.runs == 1
+    assert 'deduplicated' not in result
+    assert result['changed']
@@ -0,0 +1,665 @@
+# -*- coding: utf-8 -*-
+# This code is part of Ansible, but is an independent component.
+
+import json
+import os
+import random
+import threading
+import time
+
+import pytest
+import yaml
+
+
+@pytest.mark.parametrize('name', [u'Zürich', u'Zürich "quoted"'])
+def test_byte_string_values_match_decoded_names(utils, fake_module, foreman,
+                                                tmp_path, name):
+    # Python 2 passes module parameters as byte strings
+    url = foreman + '/api/locations'
+    module = fake_module(url=foreman, cache_dir=str(tmp_path))
+    utils.theforeman_query(module, url, {'location': {'name': name}},
+                           'POST')
+    value = name.encode('utf-8')
+
+    for i in range(2):
+        utils.THEFOREMAN_MEMO.clear()
+        record = utils.theforeman_obtain_resource(module, url, {}, 'GET',
+                                                  'name', value)
+        assert record['name'] == name
+        assert utils.theforeman_obtain_resource_id(
+            module, url, {}, 'GET', 'name', value) == record['id']
+
+
+def test_stale_cached_id_is_resolved_again(utils, library, fake_module,
+                                           foreman, tmp_path):
+    location = library('theforeman_location')
+    module = fake_module(url=foreman, cache_dir=str(tmp_path))
+    other = fake_module(url=foreman)
+
+    (rc, record, changed) = location.create(module, 'stale-location', '',
+                                            foreman)
+    assert changed
+    # Converged run, the ID stays cached
+    (rc, record, changed) = location.create(module, 'stale-location', '',
+                                            foreman)
+    assert not changed
+
+    utils.theforeman_query(other, foreman + '/api/locations/%s' % (
+        record['id']), {}, 'DELETE')
+    utils.THEFOREMAN_MEMO.clear()
+
+    (rc, created, changed) = location.create(module, 'stale-location', '',
+                                             foreman)
+    assert changed
+    assert created['id'] != record['id']
+    assert created['name'] == 'stale-location'
+
+
+def test_renamed_cached_id_is_resolved_again(utils, fake_module, foreman,
+                                             tmp_path):
+    url = foreman + '/api/locations'
+    module = fake_module(url=foreman, cache_dir=str(tmp_path))
+    other = fake_module(url=foreman)
+
+    record = utils.theforeman_obtain_resource(module, url, {}, 'GET', 'name',
+                                              'location-1')
+    utils.theforeman_query(other, url + '/%s' % (record['id']), {
+        'location': {'name': 'renamed-location'}}, 'PUT')
+    utils.THEFOREMAN_MEMO.clear()
+
+    assert utils.theforeman_cache_get(module, url, 'name', ['location-1'])
+    assert utils.theforeman_obtain_resource(module, url, {}, 'GET', 'name',
+                                            'location-1') is None
+    assert not utils.theforeman_cache_get(module, url, 'name',
+                                          ['location-1'])
+
+
+def test_cached_referenced_ids_are_checked(utils, fake_module, foreman,
+                                           tmp_path):
+    url = foreman + '/api/locations'
+    module = fake_module(url=foreman, cache_dir=str(tmp_path))
+    other = fake_module(url=foreman)
+    names = ['location-3', 'location-4', 'location-5']
+
+    ids = utils.theforeman_resolve_resource_ids(module, url, {}, 'GET',
+                                                'name', names)
+    utils.theforeman_query(other, url + '/%s' % (ids['location-3']), {
+        'location': {'name': 'renamed-location-3'}}, 'PUT')
+    utils.theforeman_query(other, url + '/%s' % (ids['location-4']), {},
+                           'DELETE')
+    created = utils.theforeman_query(other, url, {
+        'location': {'name': 'location-3'}}, 'POST')[0]
+    utils.THEFOREMAN_MEMO.clear()
+
+    assert utils.theforeman_generate_ids_dict(
+        module, foreman, 'locations', 'name', names) == [
+        {'id': created['id']}, {'id': ''}, {'id': ids['location-5']}]
+    assert utils.theforeman_cache_get(module, url, 'name', names) == {
+        'location-3': created['id'], 'location-5': ids['location-5']}
+
+
+def test_body_cache_only_stores_collection_pages(utils, fake_module, foreman,
+                                                 tmp_path):
+    module = fake_module(url=foreman, cache_dir=str(tmp_path))
+    responses = tmp_path / 'responses'
+    responses.mkdir()
+    unused = responses / 'unused'
+    unused.write_bytes(b'')
+    os.utime(str(unused), (0, 0))
+
+    record = utils.theforeman_obtain_resource(
+        module, foreman + '/api/locations', {}, 'GET', 'name', 'location-2')
+    utils.theforeman_send(module, foreman + '/api/locations/%s' % (
+        record['id']), {}, 'GET')
+
+    stored = [i.name for i in responses.iterdir()]
+    assert stored == [os.path.basename(utils.theforeman_body_cache_path(
+        module, foreman + '/api/locations?page=1&per_page=250&search=' +
+        'name%20%3D%20%22location-2%22'))]
+    assert utils.theforeman_body_cache_path(
+        module, foreman + '/api/locations/1') is None
+
+
+def test_scanned_collection_is_kept_when_scanned_again(utils, fake_module,
+                                                       foreman):
+    url = foreman + '/api/locations'
+    module = fake_module(url=foreman)
+    quoted = 'quoted "location"'
+    utils.theforeman_query(module, url, {'location': {'name': quoted}},
+                           'POST')
+
+    def resolve(*values):
+        return utils.theforeman_resolve_resources(module, url, {}, 'GET',
+                                                  'name', values)
+
+    # Values with quotes can't be searched for, the collection is scanned
+    # and the scan stops once every value was found
+    assert resolve(quoted)[quoted]['name'] == quoted
+    assert not utils.THEFOREMAN_SCANNED
+    assert not utils.THEFOREMAN_STORES
+
+    # A value that does not exist is only known after the whole collection
+    assert resolve('missing "location"') == {'missing "location"': None}
+    assert url in utils.THEFOREMAN_SCANNED
+    assert not utils.THEFOREMAN_STORES
+
+    # Scanned again, it is kept even though every value is found
+    assert resolve(quoted)[quoted]['name'] == quoted
+    assert url in utils.THEFOREMAN_STORES
+    assert resolve('location-2')['location-2']['name'] == 'location-2'
+
+    utils.theforeman_memo_invalidate(url)
+    assert not utils.THEFOREMAN_SCANNED
+    assert not utils.THEFOREMAN_STORES
+
+
+def test_session_path_does_not_depend_on_password(utils, fake_module,
+                                                  tmp_path):
+    url = 'https://foreman.example.com'
+    module = fake_module(url=url, cache_dir=str(tmp_path))
+
+    path = utils.theforeman_session_path(module, url, 'admin')
+    assert os.path.dirname(path) == str(tmp_path / 'sessions')
+    assert path != utils.theforeman_session_path(module, url, 'other')
+
+    clients = [utils.TheForemanClient(fake_module(
+        url=url, cache_dir=str(tmp_path), session_cache=True,
+        url_password=password), url) for password in ('changeme', 'other')]
+    assert clients[0].session_path == path
+    assert clients[1].session_path == path
+
+
+def test_rate_limit_path_is_private(utils, fake_module, tmp_path,
+                                    monkeypatch):
+    url = 'https://foreman.example.com/api/domains'
+    monkeypatch.setattr(utils.tempfile, 'tempdir', str(tmp_path))
+
+    path = utils.theforeman_rate_limit_path(fake_module(url=url), url)
+    directory = os.path.dirname(path)
+    assert directory == str(tmp_path / ('theforeman-%s' % os.getuid()))
+    assert os.stat(directory).st_mode & 0o777 == 0o700
+
+    module = fake_module(url=url, cache_dir=str(tmp_path / 'cache'))
+    path = utils.theforeman_rate_limit_path(module, url)
+    assert os.path.dirname(path) == str(tmp_path / 'cache' / 'ratelimit')
+
+    os.chmod(directory, 0o777)
+    with pytest.raises(Exception, match='only accessible by the user'):
+        utils.theforeman_rate_limit_path(fake_module(url=url), url)
+
+    os.rmdir(directory)
+    os.symlink(str(tmp_path / 'cache' / 'ratelimit'), directory)
+    with pytest.raises(Exception, match='only accessible by the user'):
+        utils.theforeman_rate_limit_path(fake_module(url=url), url)
+
+
+def test_plan_example_with_absent_resources(utils, library, fake_module,
+                                            foreman):
+    plan = library('theforeman_plan')
+    desired = yaml.safe_load(plan.EXAMPLES)[0]['theforeman_plan']['desired']
+    desired['smart_proxies'] = [{'name': 'proxy-3', 'state': 'absent'}]
+    module = fake_module(url=foreman)
+
+    snapshot = utils.theforeman_snapshot(module, foreman,
+                                         utils.THEFOREMAN_SNAPSHOT_RESOURCES)
+    (actions, summary) = utils.theforeman_plan(
+        snapshot, utils.theforeman_desired_params(module, desired))
+
+    deletes = [(i['resource'], i['name']) for i in actions
+               if i['action'] == 'delete']
+    assert deletes == [('smart_proxies', 'proxy-3')]
+    assert summary['create'] == 3
+    assert summary['unchanged'] == 1
+
+    desired['smart_proxies'] = [{'name': 'proxy-3'}]
+    with pytest.raises(Exception, match='smart_proxy_url'):
+        utils.theforeman_desired_params(module, desired)
+
+
+RESPONSE = {
+    'total': 1.5,
+    'subtotal': 2e5,
+    'page': -1,
+    'search': 'name = "x\\u00e9\\"y"',
+    'results': [
+        {'id': 1, 'name': u'café ☃', 'mask': '255.255.255.0',
+         'ratio': -0.25e-3, 'vlanid': None, 'managed': True,
+         'domains': [{'id': 10, 'name': 'a'}, {'id': 11, 'name': 'b'}]},
+        {'id': 2, 'name': 'escaped \\"quote\\"', 'ratio': 12.5E+2,
+         'managed': False, 'domains': []},
+        12345,
+    ],
+    'sort': {'by': None, 'order': None},
+}
+
+
+def decode(utils, chunks, fields=None):
+    decoder = utils.TheForemanResultsDecoder(iter(chunks), fields)
+    records = list(decoder)
+    return decoder, records
+
+
+@pytest.mark.parametrize('indent', [None, 2])
+def test_results_decoder_any_split(utils, indent):
+    content = json.dumps(RESPONSE, indent=indent).encode('utf-8')
+    meta = dict((k, v) for k, v in RESPONSE.items() if k != 'results')
+
+    for n in range(len(content) + 1):
+        (decoder, records) = decode(utils, [content[:n], content[n:]])
+        assert records == RESPONSE['results'], n
+        assert decoder.meta == meta, n
+        assert decoder.complete
+
+    (decoder, records) = decode(utils, [content[i:i + 1]
+                                        for i in range(len(content))])
+    assert records == RESPONSE['results']
+    assert decoder.meta == meta
+
+
+def test_results_decoder_split_numbers(utils):
+    for chunks in ([b'{"total": 1.', b'5, "results": []}'],
+                   [b'{"total": 1e', b'5, "results": []}'],
+                   [b'{"total": 1', b'.5e-', b'2, "results": [3.2', b'5]}']):
+        (decoder, records) = decode(utils, chunks)
+        expected = json.loads(b''.join(chunks).decode('utf-8'))
+        assert decoder.meta['total'] == expected['total']
+        assert records == expected['results']
+
+
+def test_results_decoder_random_floats(utils):
+    generator = random.Random(17)
+    for i in range(300):
+        values = [generator.uniform(-1e6, 1e6) * 10 ** generator.randint(
+            -20, 20) for j in range(5)]
+        content = json.dumps({'total': values[0],
+                              'results': values[1:]}).encode('utf-8')
+        cuts = sorted(generator.sample(range(len(content)), 3))
+        chunks = [content[a:b] for a, b in zip([0] + cuts,
+                                               cuts + [len(content)])]
+        (decoder, records) = decode(utils, chunks)
+        assert decoder.meta['total'] == values[0]
+        assert records == values[1:]
+
+
+def test_results_decoder_projection(utils):
+    response = dict(RESPONSE, results=RESPONSE['results'][:2])
+    content = json.dumps(response).encode('utf-8')
+    (decoder, records) = decode(utils, [content[:100], content[100:]],
+                                ('id', 'name'))
+    assert records == [{'id': 1, 'name': u'café ☃'},
+                       {'id': 2, 'name': 'escaped \\"quote\\"'}]
+
+
+@pytest.mark.parametrize('content', [
+    b'{"total": 1, "results": [{"id": 1}',
+    b'{"total": 1, "results": [{"id": 1}, ]}',
+    b'{"total": 1.}',
+    b'[]',
+])
+def test_results_decoder_invalid(utils, content):
+    with pytest.raises(ValueError):
+        decode(utils, [content[:7], content[7:]])
+
+
+def test_compare_values_returns_only_changed_fields(utils, fake_module):
+    module = fake_module(url='https://foreman.example.com')
+    current = {'id': 7, 'name': 'dmz', 'description': 'DMZ',
+               'network': '10.0.0.0', 'mask': '255.255.255.0',
+               'vlanid': 12, 'domains': [{'id': 1, 'name': 'a'}]}
+    query_data = {'subnet': {'name': 'dmz', 'description': 'Public',
+                             'network': '10.0.0.0', 'mask': '255.255.255.0',
+                             'vlanid': 12, 'domains': [{'id': 1}]}}
+
+    (diff_val, diff_data) = utils.theforeman_compare_values(
+        module, 'https://foreman.example.com', query_data, current)
+    assert diff_val == 1
+    assert diff_data == {'subnet': {'description': 'Public'}}
+
+    query_data['subnet'].update(description='DMZ',
+                                domains=[{'id': 1}, {'id': 2}])
+    assert utils.theforeman_compare_values(
+        module, 'https://foreman.example.com', query_data, current) == (
+        1, {'subnet': {'domains': [{'id': 1}, {'id': 2}]}})
+
+    query_data['subnet']['domains'] = [{'id': 1}]
+    assert utils.theforeman_compare_values(
+        module, 'https://foreman.example.com', query_data, current) == (
+        0, {'subnet': {}})
+
+
+@pytest.mark.parametrize('desired, current, diff', [
+    # An empty domains list leaves the domains of the record untouched
+    ({'domains': []}, {'domains': [{'id': 1}]}, {}),
+    # while an empty locations list clears them
+    ({'locations': []}, {'locations': [{'id': 1}]}, {'locations': []}),
+    ({'locations': []}, {'locations': []}, {}),
+    # Order and the names Foreman lists along the IDs do not matter
+    ({'locations': [{'id': 2}, {'id': 1}]},
+     {'locations': [{'id': 1, 'name': 'a'}, {'id': 2, 'name': 'b'}]}, {}),
+    ({'locations': [{'id': 1}]}, {'locations': [{'id': 1}, {'id': 2}]},
+     {'locations': [{'id': 1}]}),
+    ({'locations': [{'id': 1}]}, {}, {'locations': [{'id': 1}]}),
+    # Plain lists of IDs
+    ({'domains': [1, 2]}, {'domains': [2, 1]}, {}),
+    ({'name': 'a', 'description': 'b'}, {'name': 'a', 'description': 'c'},
+     {'description': 'b'}),
+])
+def test_diff_record(utils, desired, current, diff):
+    assert utils.theforeman_diff_record(desired, current) == diff
+
+
+@pytest.mark.parametrize('field, desired, current', [
+    ('gateway', '', None),
+    ('gateway', None, ''),
+    ('description', ' ', None),
+    ('vlanid', '12', 12),
+    ('vlanid', 12, '12'),
+    ('vlanid', '', None),
+    ('mask', '255.255.255.0', '255.255.255.0'),
+    ('mask', '/24', '255.255.255.0'),
+    ('mask', '24', '255.255.255.0'),
+    ('mask', 'ffff:ffff:ffff:ffff::', '64'),
+    ('network', '2001:db8:0::0', '2001:db8::'),
+])
+def test_normalized_values_are_equal(utils, field, desired, current):
+    normalizers = utils.THEFOREMAN_NORMALIZERS['subnet']
+    assert utils.theforeman_diff_record({field: desired},
+                                        {field: current}, normalizers) == {}
+
+
+@pytest.mark.parametrize('field, desired, current', [
+    ('gateway', '10.0.0.1', None),
+    ('vlanid', '12', 13),
+    ('vlanid', '12', None),
+    ('mask', '/25', '255.255.255.0'),
+    ('mask', '255.255.0.0', '255.255.255.0'),
+    ('mask', 'ffff:ffff:ffff:ff00::', '64'),
+])
+def test_normalized_values_differ(utils, field, desired, current):
+    normalizers = utils.THEFOREMAN_NORMALIZERS['subnet']
+    assert utils.theforeman_diff_record({field: desired},
+                                        {field: current}, normalizers) == {
+        field: desired}
+
+
+def test_identical_gets_in_flight_are_sent_once(utils, fake_module,
+                                                slow_foreman,
+                                                foreman_requests):
+    module = fake_module(url=slow_foreman)
+    location_id = utils.theforeman_obtain_resource_id(
+        module, slow_foreman + '/api/locations', {}, 'GET', 'name',
+        'location-1')
+    url = slow_foreman + '/api/locations/%s' % (location_id)
+    barrier = threading.Barrier(8)
+    results = []
+
+    def get():
+        barrier.wait()
+        results.append(utils.theforeman_request(module, url, {}, 'GET'))
+
+    foreman_requests.reset(slow_foreman)
+    threads = [threading.Thread(target=get) for i in range(8)]
+    for i in threads:
+        i.start()
+    for i in threads:
+        i.join()
+
+    assert foreman_requests(slow_foreman) == 1
+    assert len(utils.THEFOREMAN_API_MEMO_HITS) == 7
+    assert [i[0] for i in results] == [results[0][0]] * 8
+    assert results[0][0]['name'] == 'location-1'
+
+
+def test_get_racing_a_write_is_not_memoized(utils, fake_module, foreman,
+                                            foreman_requests):
+    url = foreman + '/api/locations'
+    module = fake_module(url=foreman)
+    record = utils.theforeman_query(module, url, {
+        'location': {'name': 'memo-location'}}, 'POST')[0]
+    myurl = url + '/%s' % (record['id'])
+
+    # A GET answered before a write finished is not memoized
+    (memoized, event, writes) = utils.theforeman_memo_claim(myurl)
+    assert memoized is None
+    (stale, info) = utils.theforeman_send(module, myurl, {}, 'GET')
+    utils.theforeman_query(module, myurl, {
+        'location': {'description': 'changed'}}, 'PUT')
+    utils.theforeman_memo_set(myurl, writes, stale, info)
+    utils.theforeman_memo_done(myurl, event)
+    assert myurl not in utils.THEFOREMAN_MEMO
+
+    foreman_requests.reset(foreman)
+    for i in range(2):
+        current = utils.theforeman_query(module, myurl, {}, 'GET')[0]
+        assert current['description'] == 'changed'
+    assert foreman_requests(foreman) == 1
+
+    # A write drops memoized responses of its resource type
+    utils.theforeman_query(module, myurl, {
+        'location': {'description': 'changed again'}}, 'PUT')
+    current = utils.theforeman_query(module, myurl, {}, 'GET')[0]
+    assert current['description'] == 'changed again'
+    assert foreman_requests(foreman) == 3
+
+
+@pytest.fixture
+def overloaded(utils, fake_module, busy_foreman, foreman_requests,
+               monkeypatch):
+    # Keeps the only request slot of the mock busy, sleeping between
+    # retries is recorded and waits for the slot to be released on demand
+    module = fake_module(url=busy_foreman)
+    sleep = time.sleep
+    delays = []
+    busy = []
+
+    def occupy():
+        thread = threading.Thread(target=utils.theforeman_send, args=(
+            module, busy_foreman + '/api/locations', {}, 'GET'))
+        thread.start()
+        busy.append(thread)
+        sleep(0.1)
+
+    def release():
+        for i in busy:
+            i.join()
+
+    def record(delay):
+        delays.append(delay)
+        if len(delays) == module.params.get('release_after'):
+            release()
+
+    foreman_requests.reset(busy_foreman)
+    monkeypatch.setattr(utils.time, 'sleep', record)
+    yield module, occupy, delays
+    release()
+
+
+def test_overloaded_get_is_retried(utils, overloaded, busy_foreman,
+                                   foreman_requests):
+    (module, occupy, delays) = overloaded
+    module.params.update(release_after=2)
+
+    occupy()
+    (json_out, info) = utils.theforeman_send(
+        module, busy_foreman + '/api/architectures', {}, 'GET')
+
+    assert info['status'] == 200
+    assert info['retries'] == 2
+    # The Retry-After of the 503 responses is honoured
+    assert delays == [1, 1]
+    assert foreman_requests.rejected(busy_foreman) == 2
+
+
+def test_retries_are_capped(utils, overloaded, busy_foreman,
+                            foreman_requests):
+    (module, occupy, delays) = overloaded
+    module.params.update(max_retries=2)
+
+    occupy()
+    (json_out, info) = utils.theforeman_send(
+        module, busy_foreman + '/api/architectures', {}, 'GET')
+
+    assert info['status'] == 503
+    assert info['retries'] == 2
+    assert delays == [1, 1]
+    assert foreman_requests.rejected(busy_foreman) == 3
+
+
+def test_overloaded_post_is_not_sent_again(utils, overloaded, busy_foreman,
+                                           foreman_requests):
+    (module, occupy, delays) = overloaded
+
+    occupy()
+    (json_out, info) = utils.theforeman_send(
+        module, busy_foreman + '/api/architectures', {
+            'architecture': {'name': 'retried-architecture'}}, 'POST')
+
+    assert info['status'] == 503
+    assert info['retries'] == 0
+    assert delays == []
+    assert foreman_requests.rejected(busy_foreman) == 1
+
+
+def test_expired_session_is_replaced(utils, fake_module, foreman,
+                                     foreman_requests, tmp_path):
+    url = foreman + '/api/architectures'
+    module = fake_module(url=foreman, cache_dir=str(tmp_path),
+                         session_cache=True)
+    client = utils.theforeman_client(module, url)
+
+    utils.theforeman_query(module, url, {}, 'GET')
+    session = client.cookies['_session_id']
+    assert utils.theforeman_session_load(client.session_path) == {
+        '_session_id': session}
+
+    foreman_requests.expire_sessions(foreman)
+    foreman_requests.reset(foreman)
+    (record, info) = utils.theforeman_query(module, url, {
+        'architecture': {'name': 'session-architecture'}}, 'POST')
+
+    # Rejected with the expired cookie, sent once more with credentials
+    stats = foreman_requests.stats(foreman)
+    assert info['status'] == 201
+    assert stats['endpoints'] == {'POST /api/architectures': 2}
+    assert stats['authentications'] == 1
+    assert client.cookies['_session_id'] != session
+    assert utils.theforeman_session_load(client.session_path) == \
+        client.cookies
+
+    found = utils.theforeman_query(module, url, {}, 'GET',
+                                   utils.theforeman_search_params(
+                                       'name', ['session-architecture']))
+    assert [i['id'] for i in found[0]['results']] == [record['id']]
+
+
+def test_apply_plan_feeds_created_ids_to_dependents(utils, fake_module,
+                                                    foreman, monkeypatch):
+    module = fake_module(url=foreman)
+    desired = utils.theforeman_desired_params(module, {
+        'locations': [
+            {'name': 'apply-location'},
+            {'name': 'location-41', 'state': 'absent'},
+        ],
+        'domains': [
+            {'name': 'apply.example.com', 'locations': ['apply-location']},
+            {'name': 'domain-40.example.com', 'state': 'absent'},
+        ],
+    })
+    snapshot = utils.theforeman_desired_snapshot(module, foreman, desired)
+    (plan, summary) = utils.theforeman_plan(snapshot, desired)
+
+    levels = [[(i['resource'], i['action'], i['name']) for i in level]
+              for level in utils.theforeman_plan_levels(plan)]
+    assert levels == [
+        [('locations', 'create', 'apply-location')],
+        [('domains', 'create', 'apply.example.com')],
+        # Dependents are removed before the resources they reference
+        [('domains', 'delete', 'domain-40.example.com')],
+        [('locations', 'delete', 'location-41')],
+    ]
+
+    sent = []
+    apply_action = utils.theforeman_apply_action
+
+    def record(module, url, action, data):
+        sent.append((action['name'], data))
+        return apply_action(module, url, action, data)
+    monkeypatch.setattr(utils, 'theforeman_apply_action', record)
+
+    results = utils.theforeman_apply_plan(module, foreman, plan, snapshot,
+                                          desired)
+    assert [i['name'] for i in results] == [i[0] for i in sent]
+    assert [(i['name'], i['level']) for i in results] == [
+        ('apply-location', 0), ('apply.example.com', 1),
+        ('domain-40.example.com', 2), ('location-41', 3)]
+
+    location_id = results[0]['id']
+    assert sent[1][1]['domain']['locations'] == [{'id': location_id}]
+    domain = utils.theforeman_query(module, foreman + '/api/domains/%s' % (
+        results[1]['id']), {}, 'GET')[0]
+    assert [i['id'] for i in domain['locations']] == [location_id]
+
+
+def test_snapshot_refresh_fetches_audited_records(utils, fake_module,
+                                                  foreman, monkeypatch):
+    module = fake_module(url=foreman)
+    snapshot = utils.theforeman_snapshot(module, foreman,
+                                         ['locations', 'domains'])
+    (domains, locations) = (snapshot['resources']['domains'],
+                            snapshot['resources']['locations'])
+    changed = domains.get('name', 'domain-20.example.com')
+    untouched = domains.get('name', 'domain-21.example.com')
+    location_id = locations.get('name', 'location-21')['id']
+    assert location_id in [i['id'] for i in untouched['locations']]
+
+    utils.theforeman_query(module, foreman + '/api/domains/%s' % (
+        changed['id']), {'domain': {'fullname': 'Refreshed'}}, 'PUT')
+    utils.theforeman_query(module, foreman + '/api/locations/%s' % (
+        location_id), {}, 'DELETE')
+
+    fetched = []
+    refresh_record = utils.theforeman_refresh_record
+
+    def record(module, url, resource_id):
+        fetched.append((url.rsplit('/', 1)[1], resource_id))
+        return refresh_record(module, url, resource_id)
+    monkeypatch.setattr(utils, 'theforeman_refresh_record', record)
+
+    audit_id = snapshot['audit_id']
+    assert utils.theforeman_snapshot_refresh(module, foreman,
+                                             snapshot) == (1, 1)
+    assert sorted(fetched) == [('domains', changed['id']),
+                               ('locations', location_id)]
+    assert snapshot['audit_id'] > audit_id
+
+    assert domains.get('id', changed['id'])['fullname'] == 'Refreshed'
+    assert locations.get('id', location_id) is None
+    # The removed location is dropped from a domain that was not fetched
+    assert location_id not in [
+        i['id'] for i in domains.get('id', untouched['id'])['locations']]
+
+    # Nothing was audited since
+    fetched[:] = []
+    assert utils.theforeman_snapshot_refresh(module, foreman,
+                                             snapshot) == (0, 0)
+    assert fetched == []
+
+
+def test_subnets_bulk_does_not_look_up_organizations(utils, library,
+                                                     fake_module, foreman,
+                                                     foreman_requests):
+    bulk = library('theforeman_subnets_bulk')
+    module = fake_module(url=foreman)
+    subnets = [utils.theforeman_subnet_params(module, {
+        'name': 'bulk-subnet', 'network_type': 'IPv4',
+        'network': '192.168.7.0', 'mask': '255.255.255.0',
+        'domains': ['domain-30.example.com'], 'locations': ['location-30'],
+        'organizations': ['organization-1'],
+    })]
+
+    foreman_requests.reset(foreman)
+    (rc, results, changed) = bulk.create(module, subnets, foreman)
+    assert results == [dict(name='bulk-subnet', changed=True,
+                            action='created')]
+    endpoints = foreman_requests.stats(foreman)['endpoints']
+    assert not [i for i in endpoints if 'organizations' in i]